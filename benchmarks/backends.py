@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+    backends
+    ~~~~~~~~
+
+    Compares spatial index backends of radius and nearest searches on
+    convthreads spread evenly and on convthreads crowded in downtowns.
+
+        $ python -m benchmarks.backends --convthreads 100000
+
+"""
+
+import time
+import argparse
+
+import numpy as np
+
+from benchmarks import synthetic
+from server.metrics import Metrics
+from server.search import SPATIAL_INDEX_BACKENDS
+from server.spatialindex import SpatialIndexPoint, SpatialIndex
+
+def build(name, convthreads):
+    """Bulk-loads convthreads into a new index of backend ``name``. Returns
+    the index and seconds it took.
+    """
+    start = time.time()
+    if 'geohash' == name:
+        index = SpatialIndex(2000)
+    else:
+        index = SPATIAL_INDEX_BACKENDS[name]()
+    index.add_points(convthreads["lat"].values, convthreads["lng"].values,
+                     convthreads["convthread_id"].values,
+                     np.arange(len(convthreads)))
+    return index, time.time() - start
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument("--convthreads", type=int, default=100000)
+    parser.add_argument("--clusters", type=int, default=20,
+                        help="the number of downtowns of clustered data")
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--radius", type=int, action="append",
+                        help="radii to search. 500 and 2000 by default.")
+    parser.add_argument("--k", type=int, action="append",
+                        help="the number of nearest convthreads. 10 and 100 "
+                             "by default.")
+    args = parser.parse_args(argv)
+
+    print "%d convthreads, %d queries" % (args.convthreads, args.queries)
+    print "%-10s %-8s %-12s %12s %12s %10s" % (
+        "data", "backend", "search", "candidates", "exact", "ms/query")
+    for data, clusters in [("uniform", 0), ("clustered", args.clusters)]:
+        dfs = synthetic.generate(args.convthreads, 0, 1, clusters=clusters)
+        points = [SpatialIndexPoint(lat, lng) for lat, lng in
+                  synthetic.query_locations(dfs, args.queries)]
+
+        expected = {}
+        for name in sorted(SPATIAL_INDEX_BACKENDS):
+            index, seconds = build(name, dfs["convthreads"])
+            print "%-10s %-8s %-12s %12s %12s %10.3f" % (
+                data, name, "build", "", "", 1000 * seconds)
+
+            searches = [("within %d" % radius, index.get_within_refs,
+                         radius) for radius in args.radius or [500, 2000]]
+            searches += [("nearest %d" % k, index.get_k_nearest_arrays, k)
+                         for k in args.k or [10, 100]]
+            for search, function, argument in searches:
+                metrics = Metrics()
+                start = time.time()
+                results = [function(point, argument, metrics=metrics)
+                           for point in points]
+                seconds = time.time() - start
+                if search.startswith("within"):
+                    results = [sorted(refs) for refs in results]
+                    stage = "distance"
+                else:
+                    results = [distances for _, distances in results]
+                    stage = "nearest"
+                if search in expected:
+                    assert all(np.allclose(a, b) if "nearest" == stage
+                               else a == b for a, b in
+                               zip(expected[search], results))
+                expected[search] = results
+                print "%-10s %-8s %-12s %12d %12d %10.3f" % (
+                    data, name, search, metrics.examined[stage].sum,
+                    metrics.examined["exact"].sum if "distance" == stage
+                    else metrics.examined[stage].sum,
+                    1000 * seconds / len(points))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+    build
+    ~~~~~
+
+    Measures build time of spatial indexers by the number of worker
+    processes, against indexing convthreads one point at a time.
+
+        $ python -m benchmarks.build --convthreads 1000000 --tags 5000
+
+"""
+
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+import numpy as np
+
+from benchmarks import synthetic
+from server.data import Database
+from server.search import Search, RADIUS_SIZES
+from server.spatialindex import SpatialIndexPoint, SpatialIndex
+
+def create_point_indexers(data):
+    """Creates spatial indexers by adding convthreads one point at a time,
+    which is the build before partitions.
+    """
+    spatial_indexers = {}
+    for size in RADIUS_SIZES:
+        spatial_indexers[size] = SpatialIndex(size)
+    for uid, [convthread_id, lat, lng, title] in enumerate(
+            data.convthreads()):
+        point = SpatialIndexPoint(lat, lng, ref=convthread_id, uid=uid)
+        for size in RADIUS_SIZES:
+            spatial_indexers[size].add_point(point)
+    for index in spatial_indexers.values():
+        index.get_columns()
+    return spatial_indexers
+
+def create_bulk_indexers(data):
+    """Creates spatial indexers by adding all convthreads at once with 
+    :meth:`SpatialIndex.add_points`.
+    """
+    convthreads = data.convthreads()
+    spatial_indexers = {}
+    for size in RADIUS_SIZES:
+        spatial_indexers[size] = SpatialIndex(size)
+        spatial_indexers[size].add_points(
+            convthreads[:, 1], convthreads[:, 2], convthreads[:, 0],
+            np.arange(len(convthreads)))
+    return spatial_indexers
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument("--convthreads", type=int, default=1000000)
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--tags", type=int, default=5000)
+    parser.add_argument("--workers", default=None,
+                        help="comma separated worker counts. 1, 2, 4, ... "
+                             "up to the number of cores by default.")
+    parser.add_argument("--skip-points", action="store_true",
+                        help="skip the point at a time build")
+    args = parser.parse_args(argv)
+
+    if None == args.workers:
+        workers_list = [1]
+        while workers_list[-1] * 2 <= multiprocessing.cpu_count():
+            workers_list.append(workers_list[-1] * 2)
+    else:
+        workers_list = [int(workers) for workers in args.workers.split(',')]
+
+    datapath = tempfile.mkdtemp()
+    try:
+        synthetic.write(datapath, synthetic.generate(
+            args.convthreads, args.messages, args.tags))
+        data = Database(datapath)
+    finally:
+        shutil.rmtree(datapath)
+
+    print "%d convthreads, %d tags, %d cores" % (
+        args.convthreads, args.tags, multiprocessing.cpu_count())
+    print "%-24s %10s %8s" % ("build", "seconds", "speedup")
+    baseline = None
+    if not args.skip_points:
+        start = time.time()
+        create_point_indexers(data)
+        baseline = time.time() - start
+        print "%-24s %10.2f %8.2f" % ("point at a time", baseline, 1.0)
+
+    start = time.time()
+    create_bulk_indexers(data)
+    seconds = time.time() - start
+    if None == baseline:
+        baseline = seconds
+    print "%-24s %10.2f %8.2f" % ("add_points", seconds, baseline / seconds)
+
+    search = Search(data)
+    for workers in workers_list:
+        start = time.time()
+        search.create_spatial_indexers(data, workers)
+        seconds = time.time() - start
+        if None == baseline:
+            baseline = seconds
+        print "%-24s %10.2f %8.2f" % ("%d workers" % workers, seconds,
+                                      baseline / seconds)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+    clusters
+    ~~~~~~~~
+
+    Compares clusters of maps summed from totals kept in cells of the
+    spatial index against aggregating all convthreads, at each precision
+    and after updates of convthreads.
+
+        $ python -m benchmarks.clusters --convthreads 100000
+
+"""
+
+import time
+import shutil
+import argparse
+import tempfile
+
+import pandas as pd
+
+from benchmarks import synthetic
+from benchmarks.suite import quiet
+from server.data import Database
+from server.search import Search
+from server.spatialindex import CODE_PRECISION
+
+def aggregate(search, precision):
+    """Aggregates all convthreads of the finest spatial indexer by hash
+    codes, which is the overview without cell totals.
+    """
+    index = search.spatial_indexers[min(search.spatial_indexers)]
+    _, _, columns = index.get_columns()
+    df = pd.DataFrame({
+        'cell': columns['codes'] >> (5 * (CODE_PRECISION - precision)),
+        'lat': columns['latitudes'],
+        'lng': columns['longitudes'],
+        'popularity': search.get_popularity_bounds().max_popularities[
+            columns['uids']],
+    })
+    groups = df.groupby('cell')
+    return groups.size(), groups.mean(), groups['popularity'].max()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument("--convthreads", type=int, default=100000)
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--clusters", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    dfs = synthetic.generate(args.convthreads, args.messages, 1,
+                             clusters=args.clusters)
+    datapath = tempfile.mkdtemp()
+    try:
+        synthetic.write(datapath, dfs)
+        del dfs
+        with quiet():
+            data = Database(datapath)
+    finally:
+        shutil.rmtree(datapath)
+    search = Search(data)
+    search.clusters(1)
+
+    print "%d convthreads, %d messages, %d clusters, %d repeats" % (
+        args.convthreads, args.messages, args.clusters, args.repeat)
+    print "%-10s %8s %12s %12s %12s" % ("precision", "cells", "all (ms)",
+                                        "totals (ms)", "cached (ms)")
+    for precision in range(1, search.cluster_precision(12) + 1):
+        start = time.time()
+        for _ in range(args.repeat):
+            counts, _, _ = aggregate(search, precision)
+        all_seconds = (time.time() - start) / args.repeat
+
+        start = time.time()
+        for _ in range(args.repeat):
+            # totals of cells are summed again after each update
+            for index in search.spatial_indexers.values():
+                index.cell_totals = {}
+            clusters = search.clusters(precision)
+        totals_seconds = (time.time() - start) / args.repeat
+        assert len(counts) == len(clusters)
+        assert counts.sum() == sum(cluster['count'] for cluster in clusters)
+
+        start = time.time()
+        for _ in range(args.repeat):
+            search.clusters(precision)
+        cached_seconds = (time.time() - start) / args.repeat
+        print "%-10d %8d %12.3f %12.3f %12.3f" % (
+            precision, len(clusters), 1000 * all_seconds,
+            1000 * totals_seconds, 1000 * cached_seconds)
+
+if __name__ == '__main__':
+    main()
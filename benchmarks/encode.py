@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+    encode
+    ~~~~~~
+
+    Compares responses of searches assembled from JSON fragments encoded at
+    load time against printing message records and encoding them with 
+    ``jsonify`` for each request.
+
+        $ python -m benchmarks.encode --convthreads 100000 --count 50
+
+"""
+
+import time
+import shutil
+import argparse
+import tempfile
+
+from flask import jsonify
+
+from benchmarks import synthetic
+from benchmarks.suite import create_app, quiet
+from server.api import messages_json
+from server.data import Database
+from server.messages import message_fragments
+from server.search import Search
+
+def encode_records(popular_messages):
+    """Encodes message records of a search, which is the response before
+    fragments.
+    """
+    print popular_messages
+    return jsonify({'messages': popular_messages}).get_data()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument("--convthreads", type=int, default=100000)
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--radius", type=int, default=2000)
+    parser.add_argument("--count", type=int, action="append",
+                        help="the number of messages. 10 and 100 by "
+                             "default.")
+    args = parser.parse_args(argv)
+
+    dfs = synthetic.generate(args.convthreads, args.messages, 1)
+    locations = synthetic.query_locations(dfs, args.queries)
+    datapath = tempfile.mkdtemp()
+    try:
+        synthetic.write(datapath, dfs)
+        del dfs
+        with quiet():
+            data = Database(datapath)
+    finally:
+        shutil.rmtree(datapath)
+    search = Search(data)
+    app = create_app(data, search)
+
+    store = data.messages
+    start = time.time()
+    message_fragments(store.message_ids.tolist(), 
+                      store.message_titles.tolist(), store.popularities)
+    print "%d convthreads, %d messages, %d queries" % (
+        args.convthreads, args.messages, args.queries)
+    print "fragments: %.2f s to encode at load, %.1f MB" % (
+        time.time() - start, 
+        (store.fragments.pool.nbytes + store.fragments.offsets.nbytes +
+         store.convthread_fragments.pool.nbytes + 
+         store.convthread_fragments.offsets.nbytes) / 1e6)
+
+    print "%-6s %-10s %10s %12s %10s" % ("count", "response", "ms/query", 
+                                         "MB/s", "speedup")
+    client = app.test_client()
+    for count in args.count or [10, 100]:
+        # searches are measured together, as records and fragments are 
+        # created by them.
+        with app.test_request_context(), quiet():
+            start = time.time()
+            size = sum(len(encode_records(search.popular_messages_nearby(
+                location, args.radius, count))) for location in locations)
+            record_seconds = time.time() - start
+
+            start = time.time()
+            fragment_size = sum(len(messages_json(
+                search.popular_messages_nearby(location, args.radius, count,
+                                               encoded=True)))
+                for location in locations)
+            seconds = time.time() - start
+
+        print "%-6d %-10s %10.3f %12.1f %10.2f" % (
+            count, "records", 1000 * record_seconds / len(locations), 
+            size / record_seconds / 1e6, 1.0)
+        print "%-6d %-10s %10.3f %12.1f %10.2f" % (
+            count, "fragments", 1000 * seconds / len(locations), 
+            fragment_size / seconds / 1e6, record_seconds / seconds)
+
+        urls = ["/search?lat=%r&lng=%r&radius=%d&count=%d" % (
+            lat, lng, args.radius, count) for lat, lng in locations]
+        start = time.time()
+        size = sum(len(client.get(url).data) for url in urls)
+        seconds = time.time() - start
+        print "%-6d %-10s %10.3f %12.1f" % (
+            count, "/search", 1000 * seconds / len(locations), 
+            size / seconds / 1e6)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+    ingest
+    ~~~~~~
+
+    Measures peak memory and build time of a database by the chunk size and
+    the format of datafiles. Each build runs in a fresh process.
+
+        $ python -m benchmarks.ingest --messages 1000000 --format .csv
+
+"""
+
+import sys
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+from benchmarks import synthetic
+from server.data import Database
+
+def measure(datapath, chunksize):
+    """Builds a database in this process. Returns peak RSS in megabytes and
+    seconds.
+    """
+    start = time.time()
+    Database(datapath, chunksize=chunksize)
+    seconds = time.time() - start
+    # ru_maxrss is in kilobytes on linux
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return rss, seconds
+
+def measure_in_process(datapath, chunksize):
+    output = subprocess.check_output([
+        sys.executable, "-m", "benchmarks.ingest",
+        "--measure", datapath, "--chunksize", str(chunksize)])
+    rss, seconds = output.split()[-2:]
+    return float(rss), float(seconds)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument("--convthreads", type=int, default=100000)
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--format", default=".csv",
+                        choices=[".pkl", ".csv", ".jsonl"])
+    parser.add_argument("--chunksizes", default="10000,100000,1000000")
+    parser.add_argument("--measure", metavar="DATAPATH",
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--chunksize", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.measure:
+        print "%.1f %.3f" % measure(args.measure, args.chunksize)
+        return
+
+    datapath = tempfile.mkdtemp()
+    try:
+        synthetic.write(datapath, synthetic.generate(
+            args.convthreads, args.messages), args.format)
+
+        print "%d convthreads, %d messages in %s" % (
+            args.convthreads, args.messages, args.format)
+        print "%-12s %14s %10s" % ("chunksize", "peak rss(MB)", "build(s)")
+        for chunksize in [int(size) for size in args.chunksizes.split(',')]:
+            rss, seconds = measure_in_process(datapath, chunksize)
+            print "%-12d %14.1f %10.2f" % (chunksize, rss, seconds)
+    finally:
+        shutil.rmtree(datapath)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+    lookups
+    ~~~~~~~
+
+    Compares lookups of :class:`~Database` by tag and ``convthread_id``
+    against boolean mask scans of their tables.
+
+        $ python -m benchmarks.lookups --convthreads 100000 --tags 1000
+
+"""
+
+import shutil
+import timeit
+import argparse
+import tempfile
+
+import numpy as np
+
+from benchmarks import synthetic
+from server.data import Database
+
+def scan_tag_id(data, tag):
+    df = data.dfs["tags"]
+    return df[df.tag == tag]["tag_id"].values[0]
+
+def scan_convthread(data, convthread_id):
+    df = data.dfs["convthreads"]
+    return df[df.convthread_id == convthread_id].values[0]
+
+def scan_tag_ids(data, convthread_id):
+    df = data.dfs["convthreads_with_tags"]
+    return df[df.convthread_id == convthread_id]["tag_id"].values
+
+def per_lookup(function, data, keys, repeat):
+    """Returns the best seconds of a lookup over ``repeat`` rounds.
+    """
+    def run():
+        for key in keys:
+            function(data, key)
+    return min(timeit.repeat(run, number=1, repeat=repeat)) / len(keys)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument("--convthreads", type=int, default=100000)
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--tags", type=int, default=1000)
+    parser.add_argument("--lookups", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    datapath = tempfile.mkdtemp()
+    try:
+        synthetic.write(datapath, synthetic.generate(
+            args.convthreads, args.messages, args.tags))
+        data = Database(datapath)
+    finally:
+        shutil.rmtree(datapath)
+
+    random = np.random.RandomState(0)
+    tags = data.dfs["tags"]["tag"].values
+    tags = tags[random.randint(len(tags), size=args.lookups)].tolist()
+    convthread_ids = data.dfs["convthreads"]["convthread_id"].values
+    convthread_ids = convthread_ids[random.randint(
+        len(convthread_ids), size=args.lookups)].tolist()
+
+    # creates lookup dictionaries ahead, as they are created once.
+    data.tag_id(tags[0])
+    data.convthread(convthread_ids[0])
+    data.tag_ids(convthread_ids[0])
+
+    print "%d convthreads, %d tags" % (args.convthreads, args.tags)
+    print "%-24s %12s %12s %10s" % ("lookup", "scan(us)", "lookup(us)",
+                                    "speedup")
+    for name, scan, lookup, keys in [
+            ("tag_id(tag)", scan_tag_id, Database.tag_id, tags),
+            ("convthread(id)", scan_convthread, Database.convthread,
+             convthread_ids),
+            ("tag_ids(id)", scan_tag_ids, Database.tag_ids, convthread_ids)]:
+        for key in keys:
+            assert np.all(scan(data, key) == lookup(data, key))
+        scan_seconds = per_lookup(scan, data, keys, args.repeat)
+        lookup_seconds = per_lookup(lookup, data, keys, args.repeat)
+        print "%-24s %12.1f %12.1f %9.0fx" % (
+            name, scan_seconds * 1e6, lookup_seconds * 1e6,
+            scan_seconds / lookup_seconds)
+
+if __name__ == '__main__':
+    main()
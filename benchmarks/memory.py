@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+    memory
+    ~~~~~~
+
+    Compares memory and build time of the shared spatial indexers with tag
+    postings against one spatial indexer per tag and radius size.
+
+        $ python -m benchmarks.memory --convthreads 20000 --tags 1000
+
+"""
+
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+from benchmarks import synthetic
+from server.data import Database
+from server.search import Search, RADIUS_SIZES
+from server.spatialindex import SpatialIndexPoint, SpatialIndex, CELL_COLUMNS
+
+def index_nbytes(index):
+    """Estimates bytes of a spatial index. Referenced objects such as
+    convthread ids are shared with the database, thus they are not counted.
+    """
+    nbytes = sys.getsizeof(index) + sys.getsizeof(index.data)
+    for key, cell in index.data.items():
+        cell.compact()
+        nbytes += sys.getsizeof(key) + sys.getsizeof(cell)
+        nbytes += sum(getattr(cell, name).nbytes for name in CELL_COLUMNS)
+    return nbytes
+
+def create_per_tag_indexers(data):
+    """Creates one spatial indexer per radius size and ``tag_id``, which is
+    the layout before tag postings.
+    """
+    convthread_tag_ids = {}
+    for convthread_id, tag_id in data.taggings():
+        convthread_tag_ids.setdefault(convthread_id, []).append(tag_id)
+
+    spatial_indexers = {}
+    for size in RADIUS_SIZES:
+        spatial_indexers[size] = SpatialIndex(size)
+    for tag_id in data.tag_ids():
+        spatial_indexers[tag_id] = {}
+        for size in RADIUS_SIZES:
+            spatial_indexers[tag_id][size] = SpatialIndex(size)
+
+    for [convthread_id, lat, lng, title] in data.convthreads():
+        point = SpatialIndexPoint(lat, lng, ref=convthread_id)
+        for size in RADIUS_SIZES:
+            spatial_indexers[size].add_point(point)
+            for tag_id in convthread_tag_ids.get(convthread_id, []):
+                spatial_indexers[tag_id][size].add_point(point)
+
+    for index in iter_indexes(spatial_indexers):
+        for cell in index.data.values():
+            cell.compact()
+    return spatial_indexers
+
+def iter_indexes(spatial_indexers):
+    for value in spatial_indexers.values():
+        if isinstance(value, SpatialIndex):
+            yield value
+        else:
+            for index in value.values():
+                yield index
+
+def check_results(search, per_tag_indexers, center, spread, seed=0):
+    """Asserts that both layouts return the same convthreads.
+    """
+    random = np.random.RandomState(seed)
+    tag_ids = sorted(search.tag_postings)
+    for _ in xrange(100):
+        point = SpatialIndexPoint(center[0] + spread * random.normal(),
+                                  center[1] + spread * random.normal())
+        tag_id = tag_ids[random.randint(len(tag_ids))]
+        for size in RADIUS_SIZES:
+            refs, _ = per_tag_indexers[tag_id][size].get_nearest_arrays(
+                point, size)
+            shared_refs, _ = search.spatial_indexers[size].get_nearest_arrays(
+                point, size, search.tag_postings[tag_id])
+            assert sorted(refs) == sorted(shared_refs)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument("--convthreads", type=int, default=20000)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--tags", type=int, default=1000)
+    parser.add_argument("--tags-per-convthread", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    spread = 0.05
+    center = (59.33258, 18.06490)
+    datapath = tempfile.mkdtemp()
+    try:
+        synthetic.write(datapath, synthetic.generate(
+            args.convthreads, args.messages, args.tags,
+            args.tags_per_convthread, center, spread))
+        data = Database(datapath)
+    finally:
+        shutil.rmtree(datapath)
+
+    start = time.time()
+    per_tag_indexers = create_per_tag_indexers(data)
+    per_tag_seconds = time.time() - start
+    per_tag_nbytes = sum(index_nbytes(index)
+                         for index in iter_indexes(per_tag_indexers))
+
+    start = time.time()
+    search = Search(data)
+    for index in search.spatial_indexers.values():
+        for cell in index.data.values():
+            cell.compact()
+    shared_seconds = time.time() - start
+    shared_nbytes = sum(index_nbytes(index)
+                        for index in search.spatial_indexers.values())
+    shared_nbytes += sum(sys.getsizeof(tag_id) + uids.nbytes
+                         for tag_id, uids in search.tag_postings.items())
+
+    check_results(search, per_tag_indexers, center, spread)
+
+    print "%d convthreads, %d tags, %d taggings" % (
+        args.convthreads, args.tags, len(data.taggings()))
+    print "%-24s %12s %10s" % ("layout", "bytes", "build(s)")
+    print "%-24s %12d %10.2f" % ("per tag indexers", per_tag_nbytes,
+                                 per_tag_seconds)
+    print "%-24s %12d %10.2f" % ("shared with postings", shared_nbytes,
+                                 shared_seconds)
+    print "saving: %.1fx" % (float(per_tag_nbytes) / shared_nbytes)
+
+if __name__ == '__main__':
+    main()
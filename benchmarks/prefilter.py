@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+    prefilter
+    ~~~~~~~~~
+
+    Compares exact distance calculations of spatial searches with and
+    without the bounding box prefilter and whole cell acceptance.
+
+        $ python -m benchmarks.prefilter --convthreads 100000 --radius 2000
+
+"""
+
+import time
+import argparse
+
+import numpy as np
+
+from benchmarks import synthetic
+from server.metrics import Metrics
+from server.search import RADIUS_SIZES
+from server.spatialindex import SpatialIndexPoint, SpatialIndex
+from server.spatialindex import distances_to, gather_columns
+
+def exact_refs(index, center_point, radius):
+    """Finds points within ``radius`` by exact distances of all candidates,
+    which is the search before prefilters.
+    """
+    columns = gather_columns(index.get_near_columns(center_point, radius))
+    distances = distances_to(center_point, columns)
+    return columns['refs'][distances <= radius], len(distances)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument("--convthreads", type=int, default=100000)
+    parser.add_argument("--clusters", type=int, default=20)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--radius", type=int, action="append",
+                        help="radii to search. 100, 500 and 2000 by "
+                             "default.")
+    args = parser.parse_args(argv)
+
+    dfs = synthetic.generate(args.convthreads, 0, 1, clusters=args.clusters)
+    locations = synthetic.query_locations(dfs, args.queries)
+    convthreads = dfs["convthreads"]
+
+    indexers = {}
+    for size in RADIUS_SIZES:
+        indexers[size] = SpatialIndex(size)
+        indexers[size].add_points(convthreads["lat"].values,
+                                  convthreads["lng"].values,
+                                  convthreads["convthread_id"].values,
+                                  np.arange(len(convthreads)))
+
+    print "%d convthreads, %d clusters, %d queries" % (
+        args.convthreads, args.clusters, args.queries)
+    print "%-8s %-12s %12s %12s %10s" % ("radius", "search", "candidates",
+                                         "exact", "ms/query")
+    for radius in args.radius or [100, 500, 2000]:
+        index = indexers[500 if radius < 500 else 2000]
+        points = [SpatialIndexPoint(lat, lng) for lat, lng in locations]
+
+        start = time.time()
+        exact_calls = 0
+        expected = []
+        for point in points:
+            refs, calls = exact_refs(index, point, radius)
+            expected.append(sorted(refs))
+            exact_calls += calls
+        seconds = time.time() - start
+        print "%-8d %-12s %12d %12d %10.3f" % (
+            radius, "all exact", exact_calls, exact_calls,
+            1000 * seconds / len(points))
+
+        for name in ["nearest", "within"]:
+            metrics = Metrics()
+            start = time.time()
+            for point, refs in zip(points, expected):
+                if "nearest" == name:
+                    found, _ = index.get_nearest_arrays(point, radius,
+                                                        metrics=metrics)
+                else:
+                    found = index.get_within_refs(point, radius,
+                                                  metrics=metrics)
+                assert refs == sorted(found)
+            seconds = time.time() - start
+            candidates = metrics.examined["distance"].sum
+            exact = metrics.examined["exact"].sum
+            print "%-8d %-12s %12d %12d %10.3f  (%.1f%% of trig calls)" % (
+                radius, name, candidates, exact, 1000 * seconds / len(points),
+                100.0 * exact / max(exact_calls, 1))
+
+if __name__ == '__main__':
+    main()
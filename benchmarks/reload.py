@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+    reload
+    ~~~~~~
+
+    Measures latencies of searches while the dataset is reloaded. Reloads 
+    rebuild a snapshot in a child process, either the one of 
+    ``SNAPSHOT_PATH`` or a temporary one.
+
+        $ python -m benchmarks.reload --convthreads 100000
+
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+from functools import partial
+
+import numpy as np
+
+from benchmarks import synthetic
+from benchmarks.suite import PERCENTILES, create_app, quiet
+from server.app import install_dataset, load_dataset, reload_dataset
+from server.reload import Reloader
+
+def measure(client, urls, reloader=None):
+    """Searches ``urls`` in turn until a reload finishes, or once each if 
+    ``reloader`` is not set. Returns latencies in milliseconds.
+    """
+    latencies = []
+    if None != reloader:
+        reloader.reload()
+    with quiet():
+        while True:
+            for url in urls:
+                start = time.time()
+                client.get(url)
+                latencies.append(1000 * (time.time() - start))
+            if None == reloader or not reloader.running:
+                break
+    return np.array(latencies)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument("--convthreads", type=int, default=100000)
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--radius", type=int, default=2000)
+    args = parser.parse_args(argv)
+
+    dfs = synthetic.generate(args.convthreads, args.messages, 100)
+    locations = synthetic.query_locations(dfs, args.queries)
+    urls = ["/search?lat=%r&lng=%r&radius=%d&count=10" % (lat, lng, 
+                                                         args.radius)
+            for lat, lng in locations]
+
+    path = tempfile.mkdtemp()
+    try:
+        datapath = os.path.join(path, "data")
+        os.mkdir(datapath)
+        synthetic.write(datapath, dfs)
+        del dfs
+
+        print "%d convthreads, %d messages, %d queries" % (
+            args.convthreads, args.messages, args.queries)
+        print "%-10s %10s %8s %8s %8s %8s" % (
+            "reload", "seconds", "searches", "p50 ms", "p90 ms", "p99 ms")
+        for mode, snapshot_path in [("temporary", None), 
+                                    ("snapshot", os.path.join(path, "snap"))]:
+            with quiet():
+                data, search = load_dataset({
+                    'SNAPSHOT_PATH': None, 'INGEST_CHUNK_SIZE': 100000, 
+                    'SEARCH_BUILD_WORKERS': 1}, datapath)
+            app = create_app(data, search)
+            app.config['SNAPSHOT_PATH'] = snapshot_path
+            app.config['RELOAD_SNAPSHOT_PATH'] = os.path.join(path, "reload")
+            app.reloader = Reloader(
+                partial(reload_dataset, app.config, datapath), 
+                partial(install_dataset, app))
+            client = app.test_client()
+
+            for name, reloader in [("none", None), (mode, app.reloader)]:
+                if "none" == name and "snapshot" == mode:
+                    continue
+                start = time.time()
+                latencies = measure(client, urls, reloader)
+                seconds = time.time() - start
+                print "%-10s %10.2f %8d %s" % (
+                    name, seconds, len(latencies), " ".join(
+                        "%8.2f" % np.percentile(latencies, percentile) 
+                        for percentile in PERCENTILES))
+                assert None == reloader or None == reloader.error
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    main()
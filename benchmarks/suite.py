@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+    suite
+    ~~~~~
+
+    Measures startup time, index memory, and latency and throughput of
+    searches on a synthetic city with dense downtowns and sparse suburbs.
+    Results are written as JSON, so that runs can be compared for
+    regressions.
+
+        $ python -m benchmarks.suite --output before.json
+        $ python -m benchmarks.suite --output after.json --compare before.json
+
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+from flask import Flask
+
+from benchmarks import synthetic
+from server.app import configure_settings, configure_blueprints
+from server.data import Database
+from server.search import Search
+from server.spatialindex import CELL_COLUMNS
+
+#: Percentiles of latencies to report
+PERCENTILES = (50, 90, 99)
+
+@contextmanager
+def quiet():
+    """Discards what the server prints, e.g. debug prints of preprocessing,
+    while it is measured.
+    """
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+def index_nbytes(search):
+    """Returns bytes of columns of spatial indexers and tag postings. Cells
+    are slices of shared columns, thus each column is counted once.
+    """
+    arrays = {}
+    for index in search.spatial_indexers.values():
+        for cell in index.data.values():
+            cell.compact()
+            for name in CELL_COLUMNS:
+                array = getattr(cell, name)
+                while isinstance(array.base, np.ndarray):
+                    array = array.base
+                arrays[id(array)] = array
+    for uids in search.tag_postings.values():
+        arrays[id(uids)] = uids
+    return sum(array.nbytes for array in arrays.values())
+
+def measure(function, arguments):
+    """Calls ``function`` with each of ``arguments``. Returns a dictionary of
+    latency percentiles in milliseconds and throughput in calls per second.
+    """
+    latencies = np.empty(len(arguments))
+    with quiet():
+        start = time.time()
+        for i, argument in enumerate(arguments):
+            call_start = time.time()
+            function(*argument)
+            latencies[i] = time.time() - call_start
+        seconds = time.time() - start
+
+    result = dict(("p%d_ms" % percentile,
+                   1000 * np.percentile(latencies, percentile))
+                  for percentile in PERCENTILES)
+    result["mean_ms"] = 1000 * latencies.mean()
+    result["throughput"] = len(arguments) / seconds
+    return result
+
+def create_app(data, search):
+    """Creates an app that serves ``data`` and ``search``. See
+    :func:`server.app.create_app`.
+    """
+    app = Flask("server.app")
+    configure_settings(app, {'DEBUG': False})
+    configure_blueprints(app)
+    app.data = data
+    app.search = search
+    return app
+
+def run(args):
+    dfs = synthetic.generate(args.convthreads, args.messages, args.tags,
+                             args.tags_per_convthread, seed=args.seed,
+                             clusters=args.clusters)
+    locations = synthetic.query_locations(dfs, args.queries, seed=args.seed)
+
+    datapath = tempfile.mkdtemp()
+    try:
+        synthetic.write(datapath, dfs)
+        del dfs
+        with quiet():
+            start = time.time()
+            data = Database(datapath)
+            database_seconds = time.time() - start
+            start = time.time()
+            search = Search(data)
+            search_seconds = time.time() - start
+    finally:
+        shutil.rmtree(datapath)
+
+    app = create_app(data, search)
+    client = app.test_client()
+    nearby_queries = [(location, args.radius) for location in locations]
+    with app.app_context():
+        convthread_ids = [(search.convthreads_nearby_user(*query), args.count)
+                          for query in nearby_queries]
+        latency = {
+            "convthreads_nearby_user": measure(
+                search.convthreads_nearby_user, nearby_queries),
+            "popular_messages": measure(search.popular_messages,
+                                        convthread_ids),
+        }
+    latency["/search"] = measure(client.get, [
+        ("/search?lat=%r&lng=%r&radius=%d&count=%d" % (
+            lat, lng, args.radius, args.count),)
+        for lat, lng in locations])
+
+    return {
+        "dataset": {
+            "convthreads": args.convthreads,
+            "messages": args.messages,
+            "tags": args.tags,
+            "tags_per_convthread": args.tags_per_convthread,
+            "clusters": args.clusters,
+            "seed": args.seed,
+        },
+        "queries": {
+            "count": args.queries,
+            "radius": args.radius,
+            "result_count": args.count,
+            "mean_candidates": float(np.mean([len(ids)
+                                              for ids, _ in convthread_ids])),
+        },
+        "startup": {
+            "database_seconds": database_seconds,
+            "search_seconds": search_seconds,
+        },
+        "memory": {
+            "index_bytes": index_nbytes(search),
+            # ru_maxrss is in kilobytes on linux
+            "peak_rss_bytes": resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss * 1024,
+        },
+        "latency": latency,
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+    }
+
+def flatten(result, prefix=""):
+    """Flattens numbers of nested dictionaries into dotted keys.
+    """
+    values = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, prefix + key + "."))
+        elif isinstance(value, (int, long, float)):
+            values[prefix + key] = value
+    return values
+
+def report(result, previous=None):
+    values = flatten(result)
+    previous_values = flatten(previous) if None != previous else {}
+    for section in ["startup", "memory", "latency"]:
+        print
+        print "%-48s %14s %14s %8s" % (section, "value", "previous", "ratio")
+        for key in sorted(values):
+            if not key.startswith(section + "."):
+                continue
+            value = values[key]
+            previous_value = previous_values.get(key)
+            if None == previous_value:
+                print "%-48s %14.3f" % (key[len(section) + 1:], value)
+            else:
+                print "%-48s %14.3f %14.3f %8.2f" % (
+                    key[len(section) + 1:], value, previous_value,
+                    float(value) / previous_value if previous_value else
+                    float('nan'))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument("--convthreads", type=int, default=100000)
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--tags", type=int, default=1000)
+    parser.add_argument("--tags-per-convthread", type=int, default=2)
+    parser.add_argument("--clusters", type=int, default=20,
+                        help="the number of downtowns. 0 spreads "
+                             "convthreads evenly.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--radius", type=int, default=2000)
+    parser.add_argument("--count", type=int, default=50)
+    parser.add_argument("--output", help="a path to write results as JSON")
+    parser.add_argument("--compare",
+                        help="a path of results of a previous run")
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    previous = None
+    if args.compare:
+        with open(args.compare) as previous_file:
+            previous = json.load(previous_file)
+    report(result, previous)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(result, output_file, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+    synthetic
+    ~~~~~~~~~
+
+    Generates synthetic datafiles in the format of ``data/create_testdata.py``
+    for benchmarks.
+
+"""
+
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+from server.data import DATAFILES
+
+def generate(convthread_count=10000, message_count=100000, tag_count=100,
+             tags_per_convthread=2, center=(59.33258, 18.06490), spread=0.05,
+             seed=0, clusters=0, cluster_share=0.7, cluster_spread=0.003):
+    """Generates a dictionary of datafiles as dataframes.
+
+    : param convthread_count: the number of convthreads
+    : param message_count: the number of messages
+    : param tag_count: the number of tags
+    : param tags_per_convthread: the average number of tags of a convthread
+    : param center: a center of convthread locations
+    : param spread: a standard deviation of convthread locations in degree
+    : param seed: a random seed
+    : param clusters: the number of dense clusters such as downtowns. If it 
+                      is 0, convthreads are spread evenly around ``center``.
+    : param cluster_share: a share of convthreads in clusters. The others 
+                           are spread as sparse suburbs.
+    : param cluster_spread: a standard deviation of convthread locations 
+                            within a cluster in degree
+    """
+    random = np.random.RandomState(seed)
+
+    convthread_ids = np.array(['c%015d' % i for i in xrange(convthread_count)],
+                              dtype=object)
+    if 0 == clusters:
+        lats = center[0] + spread * random.normal(size=convthread_count)
+        lngs = center[1] + spread * random.normal(size=convthread_count)
+    else:
+        lats, lngs = skewed_locations(random, convthread_count, center, 
+                                      spread, clusters, cluster_share, 
+                                      cluster_spread)
+    convthreads = pd.DataFrame({
+        'convthread_id': convthread_ids,
+        'title': ['thread %d' % i for i in xrange(convthread_count)],
+        'lat': lats,
+        'lng': lngs,
+    }, columns=['convthread_id', 'lat', 'lng', 'title'])
+
+    messages = pd.DataFrame({
+        'convthread_id': convthread_ids[
+            random.randint(0, convthread_count, message_count)],
+        'message': ['message %d' % i for i in xrange(message_count)],
+        'message_id': ['m%015d' % i for i in xrange(message_count)],
+        'popularity': random.uniform(0, 1, message_count),
+    }, columns=['convthread_id', 'message', 'message_id', 'popularity'])
+
+    tag_ids = np.array(['t%015d' % i for i in xrange(tag_count)], dtype=object)
+    tags = pd.DataFrame({
+        'tag': ['tag%d' % i for i in xrange(tag_count)],
+        'tag_id': tag_ids,
+    }, columns=['tag', 'tag_id'])
+
+    tagging_count = convthread_count * tags_per_convthread
+    taggings = pd.DataFrame({
+        'convthread_id': convthread_ids[
+            random.randint(0, convthread_count, tagging_count)],
+        'tag_id': tag_ids[random.randint(0, tag_count, tagging_count)],
+    }, columns=['convthread_id', 'tag_id'])
+    taggings = taggings.drop_duplicates(['convthread_id', 'tag_id'])
+    taggings['tagging_id'] = ['g%015d' % i for i in xrange(len(taggings))]
+
+    return {
+        "messages": messages,
+        "convthreads": convthreads,
+        "taggings": taggings,
+        "tags": tags,
+    }
+
+def skewed_locations(random, count, center, spread, clusters, cluster_share,
+                     cluster_spread):
+    """Returns latitudes and longitudes of ``count`` points. A share of them 
+    are in dense clusters, whose sizes follow a power law as downtowns of a 
+    city do, and the others are spread over suburbs.
+    """
+    cluster_centers = (np.array(center) + 
+                       spread * random.normal(size=(clusters, 2)))
+    weights = 1.0 / np.arange(1, clusters + 1)
+    weights /= weights.sum()
+
+    clustered = random.uniform(size=count) < cluster_share
+    cluster_count = np.count_nonzero(clustered)
+    lats = center[0] + 2 * spread * random.normal(size=count)
+    lngs = center[1] + 2 * spread * random.normal(size=count)
+    assigned = random.choice(clusters, size=cluster_count, p=weights)
+    lats[clustered] = (cluster_centers[assigned, 0] + 
+                       cluster_spread * random.normal(size=cluster_count))
+    lngs[clustered] = (cluster_centers[assigned, 1] + 
+                       cluster_spread * random.normal(size=cluster_count))
+    return lats, lngs
+
+def query_locations(dfs, count, spread=0.001, seed=0):
+    """Returns ``count`` locations of users. Users are where convthreads 
+    are, thus queries are as skewed as convthreads.
+
+    : param dfs: datafiles generated by :func:`generate`
+    : param count: the number of locations
+    : param spread: a standard deviation of users around convthreads in 
+                    degree
+    : param seed: a random seed
+    """
+    random = np.random.RandomState(seed)
+    convthreads = dfs["convthreads"]
+    positions = random.randint(0, len(convthreads), count)
+    lats = (convthreads["lat"].values[positions] + 
+            spread * random.normal(size=count))
+    lngs = (convthreads["lng"].values[positions] + 
+            spread * random.normal(size=count))
+    return zip(lats.tolist(), lngs.tolist())
+
+def write(datapath, dfs, extension='.pkl'):
+    """Writes datafiles generated by :func:`generate` into ``datapath``.
+
+    : param extension: a format of datafiles. One of ``.pkl``, ``.csv`` and
+                       ``.jsonl``. See :mod:`~server.ingest`.
+    """
+    if not os.path.isdir(datapath):
+        os.makedirs(datapath)
+    for key in DATAFILES:
+        filepath = os.path.join(datapath, key + extension)
+        if '.csv' == extension:
+            dfs[key].to_csv(filepath, index=False)
+        elif '.jsonl' == extension:
+            # json keeps floats exactly unlike ``DataFrame.to_json``
+            columns = dfs[key].columns.tolist()
+            with open(filepath, 'w') as jsonl_file:
+                for values in zip(*[dfs[key][column].values.tolist() 
+                                    for column in columns]):
+                    jsonl_file.write(json.dumps(dict(zip(columns, values))) 
+                                     + '\n')
+        else:
+            dfs[key].to_pickle(filepath)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+    tags
+    ~~~~
+
+    Measures tagged searches by the number of tags, against scanning 
+    candidates once for each tag.
+
+        $ python -m benchmarks.tags --convthreads 100000 --tags 100
+
+"""
+
+import time
+import shutil
+import argparse
+import tempfile
+
+from numpy.random import RandomState
+
+from benchmarks import synthetic
+from benchmarks.suite import create_app, quiet
+from server.data import Database
+from server.search import Search
+from server.spatialindex import SpatialIndexPoint
+
+def scan_each_tag(search, user_location, radius, tags):
+    """Finds convthreads with any of ``tags`` by a scan for each tag, which 
+    is the search before tag unions.
+    """
+    user_point = SpatialIndexPoint(user_location[0], user_location[1])
+    index = search.spatial_indexers[500 if radius < 500 else 2000]
+    convthread_ids = set()
+    for tag_id in search.tag_ids(tags):
+        convthread_ids |= set(index.get_within_refs(
+            user_point, radius, search.tag_postings[tag_id]))
+    return convthread_ids
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument("--convthreads", type=int, default=100000)
+    parser.add_argument("--tags", type=int, default=100)
+    parser.add_argument("--tags-per-convthread", type=int, default=5)
+    parser.add_argument("--clusters", type=int, default=20)
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--radius", type=int, default=2000)
+    args = parser.parse_args(argv)
+
+    dfs = synthetic.generate(args.convthreads, 0, args.tags, 
+                             args.tags_per_convthread, clusters=args.clusters)
+    locations = synthetic.query_locations(dfs, args.queries)
+    tags = list(dfs["tags"]["tag"])
+    datapath = tempfile.mkdtemp()
+    try:
+        synthetic.write(datapath, dfs)
+        del dfs
+        with quiet():
+            data = Database(datapath)
+    finally:
+        shutil.rmtree(datapath)
+    search = Search(data)
+
+    print "%d convthreads, %d tags, %d tags per convthread, %d queries" % (
+        args.convthreads, args.tags, args.tags_per_convthread, args.queries)
+    print "%-6s %14s %14s %10s" % ("tags", "each (ms)", "union (ms)", 
+                                   "threads")
+    random = RandomState(0)
+    with create_app(data, search).app_context():
+        tag_count = 1
+        while tag_count <= len(tags):
+            queries = [(location, args.radius, 
+                        list(random.choice(tags, tag_count, replace=False)))
+                       for location in locations]
+
+            start = time.time()
+            expected = [scan_each_tag(search, *query) for query in queries]
+            each_seconds = time.time() - start
+
+            start = time.time()
+            found = [search.convthreads_nearby_user(*query) 
+                     for query in queries]
+            seconds = time.time() - start
+            assert expected == [set(convthread_ids) 
+                                for convthread_ids in found]
+
+            print "%-6d %14.3f %14.3f %10d" % (
+                tag_count, 1000 * each_seconds / len(queries),
+                1000 * seconds / len(queries), 
+                sum(len(convthread_ids) for convthread_ids in found))
+            tag_count *= 2
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+    topk
+    ~~~~
+
+    Compares popular messages of nearby convthreads found by merging all of
+    them against the search that visits cells by their popularity bounds
+    and stops early.
+
+        $ python -m benchmarks.topk --convthreads 100000 --radius 2000
+
+"""
+
+import time
+import shutil
+import argparse
+import tempfile
+
+from benchmarks import synthetic
+from benchmarks.suite import create_app, quiet
+from server.data import Database
+from server.metrics import Metrics, NO_METRICS
+from server.search import Search
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument("--convthreads", type=int, default=100000)
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--clusters", type=int, default=20)
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--radius", type=int, action="append",
+                        help="radii to search. 500 and 2000 by default.")
+    parser.add_argument("--count", type=int, action="append",
+                        help="the number of messages. 10 and 100 by "
+                             "default.")
+    args = parser.parse_args(argv)
+
+    dfs = synthetic.generate(args.convthreads, args.messages, 1, 
+                             clusters=args.clusters)
+    locations = synthetic.query_locations(dfs, args.queries)
+    datapath = tempfile.mkdtemp()
+    try:
+        synthetic.write(datapath, dfs)
+        del dfs
+        with quiet():
+            data = Database(datapath)
+    finally:
+        shutil.rmtree(datapath)
+    search = Search(data)
+
+    print "%d convthreads, %d messages, %d clusters, %d queries" % (
+        args.convthreads, args.messages, args.clusters, args.queries)
+    print "%-8s %-6s %12s %12s %10s %10s %8s" % (
+        "radius", "count", "all (ms)", "top-k (ms)", "threads", "examined",
+        "cells")
+    with create_app(data, search).app_context():
+        # creates popularity bounds of all cells before measuring
+        for location in locations:
+            search.popular_messages_nearby(location, 
+                                           max(args.radius or [2000]))
+
+        for radius in args.radius or [500, 2000]:
+            for count in args.count or [10, 100]:
+                start = time.time()
+                threads = 0
+                expected = []
+                for location in locations:
+                    convthread_ids = search.convthreads_nearby_user(location, 
+                                                                    radius)
+                    threads += len(convthread_ids)
+                    expected.append(search.popular_messages(convthread_ids, 
+                                                            count))
+                all_seconds = time.time() - start
+
+                search.metrics = Metrics()
+                start = time.time()
+                for location, messages in zip(locations, expected):
+                    assert messages == search.popular_messages_nearby(
+                        location, radius, count)
+                seconds = time.time() - start
+                metrics, search.metrics = search.metrics, NO_METRICS
+
+                cells = metrics.examined["cells"].sum
+                print "%-8d %-6d %12.3f %12.3f %10d %10d %7.1f%%" % (
+                    radius, count, 1000 * all_seconds / len(locations),
+                    1000 * seconds / len(locations), threads, 
+                    metrics.examined["distance"].sum,
+                    100.0 * metrics.accepted["cells"].sum / max(cells, 1))
+
+if __name__ == '__main__':
+    main()
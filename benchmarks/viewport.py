@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+    viewport
+    ~~~~~~~~
+
+    Compares searches of map viewports by boxes against circles that cover
+    the viewports and are filtered by them afterwards.
+
+        $ python -m benchmarks.viewport --convthreads 100000
+
+"""
+
+import time
+import argparse
+
+import numpy as np
+
+from benchmarks import synthetic
+from server.metrics import Metrics
+from server.search import RADIUS_SIZES
+from server.spatialindex import SpatialIndexPoint, SpatialIndex
+from server.spatialindex import DISTANCE_COEFFICIENT, bounds_mask
+from server.spatialindex import box_precision
+
+def viewport(location, width):
+    """Returns a box of ``width`` meters wide and a half as high around
+    ``location``.
+    """
+    lat, lng = location
+    height_angle = width / 4.0 / DISTANCE_COEFFICIENT
+    width_angle = height_angle * 2 / np.cos(np.radians(lat))
+    return (lat - height_angle, lng - width_angle, lat + height_angle,
+            lng + width_angle)
+
+def circle_refs(index, bounds, columns, metrics):
+    """Finds points of a box by the circle around the box, which is how
+    clients searched viewports before boxes.
+    """
+    south, west, north, east = bounds
+    center = SpatialIndexPoint((south + north) / 2.0, (west + east) / 2.0)
+    radius = max(center.distance_to(SpatialIndexPoint(latitude, longitude))
+                 for latitude in [south, north] for longitude in [west, east])
+    refs = index.get_within_refs(center, radius, metrics=metrics)
+    positions = np.searchsorted(columns['refs'], refs)
+    mask = bounds_mask(bounds, columns['latitudes'][positions],
+                       columns['longitudes'][positions])
+    return refs[mask]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument("--convthreads", type=int, default=100000)
+    parser.add_argument("--clusters", type=int, default=20)
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--width", type=int, action="append",
+                        help="widths of viewports in meters. 200, 1000, "
+                             "5000 and 20000 by default.")
+    args = parser.parse_args(argv)
+
+    dfs = synthetic.generate(args.convthreads, 0, 1, clusters=args.clusters)
+    locations = synthetic.query_locations(dfs, args.queries)
+    convthreads = dfs["convthreads"]
+
+    indexers = {}
+    for size in RADIUS_SIZES:
+        indexers[size] = SpatialIndex(size)
+        indexers[size].add_points(convthreads["lat"].values,
+                                  convthreads["lng"].values,
+                                  np.arange(len(convthreads)),
+                                  np.arange(len(convthreads)))
+    _, _, columns = indexers[min(RADIUS_SIZES)].get_columns()
+    order = np.argsort(columns['refs'])
+    columns = dict((name, columns[name][order]) for name in columns)
+
+    print "%d convthreads, %d clusters, %d queries" % (
+        args.convthreads, args.clusters, args.queries)
+    print "%-8s %-8s %10s %12s %12s %12s %12s" % (
+        "width", "index", "found", "circle cands", "box cands",
+        "circle (ms)", "box (ms)")
+    for width in args.width or [200, 1000, 5000, 20000]:
+        boxes = [viewport(location, width) for location in locations]
+        for size in RADIUS_SIZES:
+            index = indexers[size]
+            metrics = Metrics()
+            start = time.time()
+            expected = [sorted(circle_refs(index, bounds, columns, metrics))
+                        for bounds in boxes]
+            circle_seconds = time.time() - start
+
+            start = time.time()
+            for bounds, refs in zip(boxes, expected):
+                assert refs == sorted(index.get_box_refs(bounds,
+                                                         metrics=metrics))
+            box_seconds = time.time() - start
+            print "%-8d %-8d %10d %12d %12d %12.3f %12.3f" % (
+                width, size, sum(len(refs) for refs in expected),
+                metrics.examined["distance"].sum,
+                metrics.examined["box"].sum,
+                1000 * circle_seconds / len(boxes),
+                1000 * box_seconds / len(boxes))
+        print "%-8d precisions of boxes: %s" % (width, sorted(set(
+            box_precision(bounds) for bounds in boxes)))
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 
 import math
-from flask import Blueprint, current_app, jsonify, request
+from flask import Blueprint, Response, current_app, json, jsonify, request
+from flask import stream_with_context
 
 api = Blueprint('api', __name__)
 
@@ -17,6 +18,12 @@ def search():
     :param lat: latitude of user location for spatial search
     :param lng: longitude of user location for spatial search
     :param radius: a search radius for spatial search
+    :param nearest: an optional number of nearest conversation threads to 
+                    search instead of the ones within ``radius``. ``radius`` 
+                    is not required if it is set.
+    :param bbox: an optional box ``west,south,east,north`` such as the 
+                 viewport of a map to search instead of the circle. ``lat``, 
+                 ``lng`` and ``radius`` are not required if it is set.
     :param tags: an optional value that allows user to narrow search. If tags 
                  are provided, a convthread needs to have at least one of them to be 
                  considered a candidate.
@@ -49,23 +56,309 @@ def search():
     lat = request.args.get('lat', float('nan'), float)
     lng = request.args.get('lng', float('nan'), float)
     radius = request.args.get('radius', 0, int) # unit : meter
+    nearest = request.args.get('nearest', 0, int)
+    bbox = request.args.get('bbox', "", str)
     tags = request.args.get('tags', "", str)
     count = request.args.get('count', -1, int)
 
+    bounds = None
+    if "" != bbox:
+        bounds, error = parse_bbox(bbox)
+        if None == error and count <= 0:
+            error = "Too small count : %d" % count
+    else:
+        error = query_error(lat, lng, radius, count, nearest)
+    if None != error:
+        return jsonify({'error' : error})
+
+    user_pos = (lat, lng)
+    tags = tags.split(",") if "" != tags else None
+
+    # the search is taken once, so that a reload never changes it in the 
+    # middle of a request.
+    search = current_app.search
+    with search.metrics.stage("search"):
+        if None != bounds:
+            convthread_ids = search.convthreads_in_box(bounds, tags)
+            popular_messages = search.popular_messages(convthread_ids, count,
+                                                       encoded=True)
+        elif 0 < nearest:
+            convthread_ids = search.convthreads_nearest_user(user_pos, 
+                                                             nearest, tags)
+            popular_messages = search.popular_messages(convthread_ids, count,
+                                                       encoded=True)
+        else:
+            popular_messages = search.popular_messages_nearby(
+                user_pos, radius, count, tags, encoded=True)
+
+    return Response(messages_json(popular_messages), 
+                    mimetype='application/json')
+
+@api.route('/search/batch', methods=['POST'])
+def search_batch():
+    """
+    Spatial searches for many user locations at once. Queries that share 
+    geohash cells share their candidates.
+
+    POST
+
+    The request body is a JSON object that has a list of queries. Each query 
+    has the same parameters as :func:`search`. ``tags`` can be either a 
+    comma-separated string or a list.
+
+    e.g.)
+    {
+        'queries': [
+            {'lat': 59.33258, 'lng': 18.0649, 'radius': 500, 'count': 10},
+            {'lat': 59.33, 'lng': 18.06, 'radius': 2000, 'tags': 'cafe', 
+             'count': 5},
+            ...
+        ]
+    }
+
+    Returns results of each query in order. A result is either 
+    ``{'messages': [...]}`` as :func:`search` returns or ``{'error': ...}`` 
+    if the query is invalid. Results are streamed as soon as they are found.
+
+    e.g.)
+    {
+        'results': [
+            {'messages': [...]},
+            {'error': 'Too small count : 0'},
+            ...
+        ]
+    }
+
+    """
+
+    body = request.get_json(force=True, silent=True)
+    queries = body.get('queries') if isinstance(body, dict) else None
+    if not isinstance(queries, list):
+        return jsonify({'error' : "queries is not a list"})
+    if current_app.config['SEARCH_BATCH_LIMIT'] < len(queries):
+        return jsonify({'error' : "Too many queries : %d" % len(queries)})
+
+    parsed_queries = [parse_query(query) for query in queries]
+    search_queries = [search_query for search_query, error in parsed_queries 
+                      if None == error]
+
+    search = current_app.search
+    def generate():
+        results = search.batch_nearby(search_queries, encoded=True)
+        yield '{"results": ['
+        for i, (search_query, error) in enumerate(parsed_queries):
+            if 0 < i:
+                yield ', '
+            if None == error:
+                yield messages_json(next(results))
+            else:
+                yield json.dumps({'error': error})
+        yield ']}'
+
+    return Response(stream_with_context(generate()), 
+                    mimetype='application/json')
+
+@api.route('/clusters', methods=['GET'])
+def clusters():
+    """
+    Counts of conversation threads in geohash cells for an overview of a map. 
+    Cells are finer as the map is zoomed in.
+
+    GET
+
+    :param zoom: a zoom level of the map, which chooses a precision of cells. 
+                 See :func:`zoom_precision`.
+    :param bbox: an optional bounding box of the map as 
+                 ``west,south,east,north``. If it is set, only cells whose 
+                 centroids are within it are returned.
+
+    Returns cells that have conversation threads with their centroid and the 
+    maximum popularity of their messages.
+
+    e.g.)
+    {
+        'precision': 5,
+        'clusters': [
+            {
+                'hash': 'u6sce',
+                'count': 120,
+                'lat': 59.33511207580566,
+                'lng': 18.06341361999512,
+                'popularity': 0.98
+            },
+            ...
+        ]
+    }
+
+    """
+
+    zoom = request.args.get('zoom', -1, int)
+    bbox = request.args.get('bbox', "", str)
+    if zoom < 0:
+        return jsonify({'error' : "Too small zoom : %d" % zoom})
+    bounds = None
+    if "" != bbox:
+        bounds, error = parse_bbox(bbox)
+        if None != error:
+            return jsonify({'error' : error})
+
+    search = current_app.search
+    precision = search.cluster_precision(zoom_precision(zoom))
+    with search.metrics.stage("search"):
+        cells = search.clusters(precision, bounds)
+    return jsonify({'precision': precision, 'clusters': cells})
+
+@api.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Latencies of each stage of searches and the number of candidates they 
+    examine and accept in the Prometheus text format. It is served only if 
+    ``METRICS_ENABLED`` is set.
+
+    GET
+
+    Stages are ``search`` for a whole search, ``tags`` for resolving tags, 
+    ``candidates`` for fetching candidates from geohash cells, ``distance`` 
+    for filtering candidates by exact distance, ``nearest`` for nearest 
+    searches, ``box`` for filtering candidates by boxes, ``popularity`` for 
+    merging popular messages and ``clusters`` for summing cells of maps. 
+    Candidates of ``cells`` are cells that cover search areas and the ones 
+    visited until the most popular messages are found, and the ones of 
+    ``clusters`` are cells of maps and the ones within their bounding boxes.
+
+    e.g.)
+    # TYPE search_stage_duration_seconds histogram
+    search_stage_duration_seconds_bucket{stage="distance",le="0.0001"} 3
+    ...
+    search_candidates_examined_sum{stage="distance"} 5230.0
+    ...
+
+    """
+
+    search = current_app.search
+    if not search.metrics.enabled:
+        return Response("metrics are disabled\n", status=404, 
+                        mimetype='text/plain')
+
+    counters = {}
+    reloader = getattr(current_app, 'reloader', None)
+    if None != reloader:
+        counters['search_reloads_total'] = reloader.generation
+    cache = search.cache
+    if None != cache:
+        counters['search_cache_hits_total'] = cache.hits
+        counters['search_cache_misses_total'] = cache.misses
+    return Response(search.metrics.render(counters), 
+                    mimetype='text/plain; version=0.0.4')
+
+@api.route('/admin/reload', methods=['GET', 'POST'])
+def reload():
+    """
+    Reloads datafiles without downtime. The current dataset keeps serving 
+    searches until the new one is built. It is served only if 
+    ``RELOAD_ENDPOINT_ENABLED`` is set.
+
+    GET returns the state of reloads, and POST starts a reload unless one is 
+    running.
+
+    e.g.)
+    {
+        'started': true,
+        'running': true,
+        'generation': 0,
+        'error': null,
+        'seconds': null
+    }
+
+    """
+
+    if not current_app.config['RELOAD_ENDPOINT_ENABLED']:
+        return Response("reload is disabled\n", status=404, 
+                        mimetype='text/plain')
+
+    reloader = current_app.reloader
+    started = 'POST' == request.method and reloader.reload()
+    status = reloader.status()
+    status['started'] = started
+    return jsonify(status)
+
+def messages_json(messages):
+    """Returns the JSON of a result of searches from JSON of each message.
+    """
+    return '{"messages": [%s]}' % ', '.join(messages)
+
+def query_error(lat, lng, radius, count, nearest=0):
+    """Returns an error message of invalid search parameters or ``None``. 
+    ``radius`` is not checked if ``nearest`` is set.
+    """
     if math.isnan(lat) or abs(lat) > 180:
-        return jsonify({'error' : "lat is a nan or more than abs(180)"})
+        return "lat is a nan or more than abs(180)"
     if math.isnan(lng) or abs(lng) > 90:
-        return jsonify({'error' : "lng is a nan or more than abs(90)"})
-    if radius <= 0: 
-        return jsonify({'error' : "Too small radius : %d" % radius})
+        return "lng is a nan or more than abs(90)"
+    if nearest < 0:
+        return "Too small nearest : %d" % nearest
+    if 0 == nearest and radius <= 0: 
+        return "Too small radius : %d" % radius
     if count <= 0: 
-        return jsonify({'error' : "Too small count : %d" % count})
+        return "Too small count : %d" % count
+    return None
 
-    user_pos = (lat, lng)
-    tags = tags.split(",") if "" != tags else None
+def zoom_precision(zoom):
+    """Returns a geohash precision of cells for a map at ``zoom`` level. A 
+    tile of 256 pixels spans 360 / 2 ** zoom degrees of longitude, and a cell 
+    of precision ``p`` spans 360 / 2 ** ceil(5 * p / 2) degrees, thus cells 
+    are about 64 pixels wide.
+    """
+    return max(1, int(round(2 * (zoom + 2) / 5.0)))
+
+def parse_bbox(bbox):
+    """Parses a bounding box ``west,south,east,north`` in degrees. Returns a 
+    tuple of ``(south, west, north, east)`` and an error message. Either of 
+    them is ``None``. ``west`` greater than ``east`` is a box across the 
+    antimeridian.
+    """
+    try:
+        west, south, east, north = [float(value) for value in bbox.split(",")]
+    except ValueError:
+        return None, "bbox is not west,south,east,north : %s" % bbox
+    if any(math.isnan(value) for value in [west, south, east, north]):
+        return None, "bbox has a nan"
+    if 90 < abs(south) or 90 < abs(north) or north < south:
+        return None, "Invalid latitudes of bbox : %r, %r" % (south, north)
+    if 180 < abs(west) or 180 < abs(east):
+        return None, "Invalid longitudes of bbox : %r, %r" % (west, east)
+    return (south, west, north, east), None
+
+def parse_query(query):
+    """Parses a query of :func:`search_batch`. Returns a tuple of a query for 
+    :meth:`Search.batch_nearby` and an error message. Either of them is 
+    ``None``.
+    """
+    if not isinstance(query, dict):
+        return None, "query is not an object"
+
+    def get(key, default, type):
+        try:
+            return type(query.get(key, default))
+        except (TypeError, ValueError):
+            return default
+
+    lat = get('lat', float('nan'), float)
+    lng = get('lng', float('nan'), float)
+    radius = get('radius', 0, int) # unit : meter
+    count = get('count', -1, int)
+    error = query_error(lat, lng, radius, count)
+    if None != error:
+        return None, error
 
-    convthread_ids = current_app.search.convthreads_nearby_user(user_pos, radius, tags)
-    popular_messages = current_app.search.popular_messages(convthread_ids, count)
+    tags = query.get('tags') or None
+    if isinstance(tags, basestring):
+        tags = tags.split(",")
+    if None != tags:
+        if not isinstance(tags, list) or not all(
+                isinstance(tag, basestring) for tag in tags):
+            return None, "tags is not a list of strings"
+        tags = [tag.encode('utf-8') if isinstance(tag, unicode) else tag 
+                for tag in tags]
 
-    print popular_messages
-    return jsonify({'messages': popular_messages})
+    return ((lat, lng), radius, tags, count), None
@@ -1,47 +1,146 @@
 # -*- coding: utf-8 -*-
 
 import os
+import atexit
+import shutil
+import tempfile
+from functools import partial
 from flask import Flask
 from server.api import api
-from server.search import Search
+from server.search import QueryCache, Search
+from server.metrics import Metrics
 from server.data import Database
+from server.reload import Reloader
+from server import snapshot
+from server.snapshot import SnapshotError
+
+#: A directory of datafiles
+DATAPATH = "./data/"
 
 def create_app(settings_overrides=None):
     app = Flask(__name__)
     configure_settings(app, settings_overrides)
     configure_blueprints(app)
 
-    import cPickle as pickle
-
-#    path = "./data.pkl"
-#    if False == os.path.isfile(path):
-#        print "data preprocessing work. it will take about 60 seconds..."
-#        with open(path, 'wb') as pkl_file :
-#            db = Database("./data/")
-#            pickle.dump(db, pkl_file, -1)
-#    with open(path, 'rb') as pkl_file :
-#        app.data = pickle.load(pkl_file)
-#
-#    path = "./search.pkl"
-#    if False == os.path.isfile(path):
-#        print "spatial search preprocessing. it will take about 60 seconds..."
-#        with open(path, 'wb') as pkl_file :
-#            pickle.dump(Search(app.data), pkl_file, -1)
-#    with open(path, 'rb') as pkl_file :
-#        app.search = pickle.load(pkl_file)
-
-    app.data = Database("./data/")
-    app.search = Search(app.data)
+    data, search = load_dataset(app.config)
+    install_dataset(app, data, search)
+
+    app.reloader = Reloader(partial(reload_dataset, app.config), 
+                            partial(install_dataset, app))
+    if None != app.config['RELOAD_SIGNAL']:
+        app.reloader.install_signal(app.config['RELOAD_SIGNAL'])
 
     return app
 
+def load_dataset(config, datapath=DATAPATH):
+    """Returns a database and a search from a snapshot if it is up to date, 
+    or from datafiles.
+    """
+    snapshot_path = config.get('SNAPSHOT_PATH')
+    if None != snapshot_path:
+        try:
+            return snapshot.load(snapshot_path, datapath)
+        except SnapshotError as e:
+            import warnings
+            warnings.warn("Snapshot is not used. %s" % e, Warning)
+
+    data = Database(datapath, chunksize=config['INGEST_CHUNK_SIZE'])
+    return data, Search(data, workers=config['SEARCH_BUILD_WORKERS'])
+
+def reload_dataset(config, datapath=DATAPATH):
+    """Returns a database and a search of datafiles as they are now. A 
+    snapshot is rebuilt in a child process if it is out of date and loaded, 
+    so that preprocessing does not slow down searches of this process. 
+    Without ``SNAPSHOT_PATH``, the snapshot is kept in 
+    ``RELOAD_SNAPSHOT_PATH``.
+    """
+    snapshot_path = config.get('SNAPSHOT_PATH')
+    if None == snapshot_path:
+        snapshot_path = reload_snapshot_path(config)
+
+    try:
+        data, search = snapshot.load(snapshot_path, datapath)
+    except SnapshotError:
+        snapshot.build_in_process(snapshot_path, datapath, 
+                                  config['INGEST_CHUNK_SIZE'],
+                                  config['SEARCH_BUILD_WORKERS'],
+                                  config['RELOAD_NICENESS'])
+        data, search = snapshot.load(snapshot_path, datapath)
+
+    # tables are read from the snapshot on first use, but the next rebuild 
+    # replaces its files.
+    for name in list(data.dfs):
+        data.dfs[name]
+    return data, search
+
+def reload_snapshot_path(config):
+    """Returns ``RELOAD_SNAPSHOT_PATH``. If it is not set, it is set to a 
+    temporary directory that is removed at exit.
+    """
+    snapshot_path = config.get('RELOAD_SNAPSHOT_PATH')
+    if None == snapshot_path:
+        path = tempfile.mkdtemp(prefix="reload-")
+        atexit.register(shutil.rmtree, path, True)
+        snapshot_path = config['RELOAD_SNAPSHOT_PATH'] = os.path.join(
+            path, "snapshot")
+    return snapshot_path
+
+def install_dataset(app, data, search):
+    """Makes ``data`` and ``search`` current. Requests take ``app.search`` 
+    once when they start, thus the assignment swaps the dataset of new 
+    requests at once. Metrics are carried over from the current search, and 
+    the backend of ``SPATIAL_INDEX_BACKEND`` is loaded before the swap.
+    """
+    search.set_backend(app.config['SPATIAL_INDEX_BACKEND'])
+    if 0 < app.config['SEARCH_CACHE_SIZE']:
+        search.cache = QueryCache(app.config['SEARCH_CACHE_SIZE'], 
+                                  app.config['SEARCH_CACHE_PRECISION'])
+    current = getattr(app, 'search', None)
+    if None != current:
+        search.metrics = current.metrics
+    elif app.config['METRICS_ENABLED']:
+        search.metrics = Metrics()
+
+    app.search = search
+    app.data = data
+
 def configure_settings(app, settings_override):
     parent = os.path.dirname(__file__)
     data_path = os.path.join(parent, '..', 'data')
     app.config.update({
         'DEBUG': True,
         'TESTING': False,
-        'DATA_PATH': data_path
+        'DATA_PATH': data_path,
+        # a snapshot built by ``python -m server.snapshot``. if it is missing
+        # or out of date, datafiles are preprocessed at startup.
+        'SNAPSHOT_PATH': None,
+        # the maximum number of queries of a batch search
+        'SEARCH_BATCH_LIMIT': 1000,
+        # the maximum number of cached searches. 0 disables the cache.
+        'SEARCH_CACHE_SIZE': 0,
+        # a geohash precision of cells that share cached searches
+        'SEARCH_CACHE_PRECISION': 7,
+        # the number of rows of datafiles to preprocess at once. it bounds
+        # peak memory at startup.
+        'INGEST_CHUNK_SIZE': 100000,
+        # the number of processes to build spatial indexers at startup
+        'SEARCH_BUILD_WORKERS': 1,
+        # a backend of radius and nearest searches, ``geohash`` or 
+        # ``kdtree``. see ``SPATIAL_INDEX_BACKENDS`` of ``server.search``.
+        'SPATIAL_INDEX_BACKEND': 'geohash',
+        # observes latencies of stages of searches and serves them at
+        # ``/metrics``
+        'METRICS_ENABLED': False,
+        # a name of a signal that reloads datafiles, e.g. ``SIGHUP``
+        'RELOAD_SIGNAL': None,
+        # reloads datafiles on ``POST /admin/reload``
+        'RELOAD_ENDPOINT_ENABLED': False,
+        # an increment of the niceness of the process that rebuilds a 
+        # snapshot on reload
+        'RELOAD_NICENESS': 10,
+        # a snapshot rebuilt on reload if ``SNAPSHOT_PATH`` is not set. a 
+        # temporary directory by default.
+        'RELOAD_SNAPSHOT_PATH': None,
     })
     if settings_override:
         app.config.update(settings_override)
@@ -7,75 +7,102 @@
 
 """
 
+import bisect
 import pandas as pd
 import numpy as np
-
-DATAFILES = {
-    "messages": "messages.pkl",
-    "convthreads": "convthreads.pkl",
-    "taggings": "taggings.pkl",
-    "tags" : "tags.pkl"
-}
+from itertools import izip
+from server.messages import CONVTHREAD_FIELDS, POPULARITY_DTYPE, MessageStore
+from server.ingest import CHUNK_SIZE, DATAFILES, read_database
 
 class Database(object):
-    def __init__(self,datapath):
+    def __init__(self, datapath, tables=None, messages=None, 
+                 chunksize=CHUNK_SIZE):
+        """
+        : param datapath: a directory that contains datafiles
+        : param tables: an optional mapping of prebuilt tables such as a 
+                        snapshot. If set, datafiles are not read at all.
+        : param messages: an optional prebuilt :class:`~MessageStore`. It is 
+                          created from the ``messages`` table of ``tables`` 
+                          if it is not set.
+        : param chunksize: the number of rows of datafiles to process at 
+                           once. See :mod:`~server.ingest`.
+        """
+        if None == tables:
+            tables, messages = self.create_table(datapath, chunksize)
+
         #: A dataframe that contains database from datafiles 
-        self.dfs = self.create_table(datapath)
+        self.dfs = tables
 
-    def create_table(self, datapath):
-        """Create database class with pkl files. 
-        """
-        dfs = {}
+        #: Refined messages of each convthread. See :class:`~MessageStore`.
+        if None == messages:
+            messages = MessageStore.from_dataframes(self.dfs["convthreads"], 
+                                                    self.dfs["messages"])
+        self.messages = messages
+
+        #: A counter that is incremented whenever the data changes. Results 
+        #: derived from the data, e.g. cached search results, are valid 
+        #: only while it stays the same. 
+        self.version = 0
 
-        for key, filepath in DATAFILES.items():
-            try :
-                buf = '%s/%s' % (datapath, filepath)
-            except IOError as e :
-                assert False, "I/O error({0}): {1}".format(e.errno, e.strerror)
-            except:
-                import sys
-                assert False, "Unexpected error: %s" % sys.exc_info()[0]
-            print buf
-            df = pd.read_pickle(buf)
-            dfs[key] = df
+        #: Lookup dictionaries of tables, which are created on first use. 
+        #: See :meth:`lookup`.
+        self.lookups = {}
+
+    def create_table(self, datapath, chunksize=CHUNK_SIZE):
+        """Create database class with datafiles. Returns a dictionary of 
+        tables and refined messages. The raw ``messages`` table is streamed 
+        in chunks of ``chunksize`` rows and not kept.
+        """
+        dfs, messages = read_database(datapath, chunksize)
 
         # Following codes require a bit of explanation: the basic idea is to 
         # make a refined database to boost search performance and to select 
-        # database for time-consuming queries in advance. 
-
-        # data preprocessing for "messages" datatable.
-        messages_df = dfs["messages"]
-        # - sorts messages by "popularity" feature in ascending order
-        messages_df = messages_df.sort(['popularity'],ascending=[True])
+        # database for time-consuming queries in advance. Messages of each 
+        # convthread are refined by :class:`~MessageStore`.
 
-        # data preprocessing for "convthreads" datatable
-        # - selects messages for each convthread beforehand
-        #   and adds "easy to read/access" convthread information for each message
-        convthreads_df = dfs["convthreads"]
-        for convthread_id in convthreads_df["convthread_id"].values:
-            # get all messages of this convthread
-            convthread_messages = messages_df[messages_df.convthread_id == convthread_id].values
-            refined_convthread_messages = []
-            for convthread_message in convthread_messages:
-                convthread_message = list(convthread_message)
-                del convthread_message[1]
-                convthread_df = convthreads_df[convthreads_df.convthread_id == convthread_id]
-                convthread_record = convthread_df.head(0).values.tolist()[0]
-                
-                record = dict(zip(["message_id","title","popularity","convthread_id"],
-                    convthread_message + 
-                    [dict(zip(["convthread_id", "lat", "lng", "title"], convthread_record))] 
-                    ))
-
-                refined_convthread_messages.append(record)
-            dfs[convthread_id] = refined_convthread_messages
         # - creates refined database merging convthreads with tags
+        convthreads_df = dfs["convthreads"]
         convthreads_with_tags = convthreads_df.merge(dfs["taggings"], on="convthread_id")
 
-        print convthreads_with_tags
         dfs["convthreads_with_tags"] = convthreads_with_tags
 
-        return dfs
+        return dfs, messages
+
+    def lookup(self, name):
+        """Returns a lookup dictionary. It is created on first use and kept 
+        up to date by updates.
+
+        : param name: ``"tags"`` maps a tag to a list of its ``tag_ids``, 
+                      ``"convthreads"`` maps a ``convthread_id`` to a list of 
+                      its records and ``"convthread_tag_ids"`` maps a 
+                      ``convthread_id`` to an array of its ``tag_ids``. 
+        """
+        lookup = self.lookups.get(name)
+        if None != lookup:
+            return lookup
+
+        lookup = {}
+        if "tags" == name:
+            df = self.dfs["tags"]
+            for tag, tag_id in izip(df["tag"].values.tolist(), 
+                                    df["tag_id"].values.tolist()):
+                lookup.setdefault(tag, []).append(tag_id)
+        elif "convthreads" == name:
+            df = self.dfs["convthreads"]
+            for convthread_id, record in izip(
+                    df["convthread_id"].values.tolist(), df.values):
+                lookup.setdefault(convthread_id, []).append(record)
+        elif "convthread_tag_ids" == name:
+            df = self.dfs["convthreads_with_tags"]
+            tag_ids = df["tag_id"].values
+            for convthread_id, positions in df.groupby(
+                    "convthread_id").indices.items():
+                lookup[convthread_id] = tag_ids[positions]
+        else:
+            raise KeyError(name)
+
+        self.lookups[name] = lookup
+        return lookup
 
     def convthreads(self,tag_id=None):
         """Returns convthreads from datatable. 
@@ -93,10 +120,9 @@ class Database(object):
         """Returns convthread by ``convthread_id````. 
         """
 
-        df = self.dfs["convthreads"]
-        tag_records = df[df.id == convthread_id]
+        tag_records = self.lookup("convthreads").get(convthread_id, [])
         if 1 == len(tag_records): 
-            return tag_records.values[0]
+            return tag_records[0]
         elif 1 < len(tag_records): 
             raise Exception("More than one record exist by convthread_id")
         else :
@@ -113,19 +139,25 @@ class Database(object):
         if None == convthread_id:
             return [tag[0] for tag in self.dfs["tags"][["tag_id"]].values]
         else :
-            df = self.dfs["convthreads_with_tags"]
-            tag_records = df[df.convthread_id == convthread_id]
-            return tag_records["tag_id"].values
+            tag_ids = self.lookup("convthread_tag_ids").get(convthread_id)
+            if tag_ids is None:
+                return self.dfs["convthreads_with_tags"]["tag_id"].values[:0]
+            return tag_ids
+
+    def taggings(self):
+        """Returns pairs of ``convthread_id`` and ``tag_id`` of all taggings. 
+        """
+        df = self.dfs["convthreads_with_tags"]
+        return df[["convthread_id", "tag_id"]].values
 
     def tag_id(self, tag):
         """Returns ``tag_ids`` of ``tag``. 
         """
         assert isinstance(tag, str)
 
-        df = self.dfs["tags"]
-        tag_records = df[df.tag == tag]
+        tag_records = self.lookup("tags").get(tag, [])
         if 1 == len(tag_records): 
-            return tag_records["id"].values[0]
+            return tag_records[0]
         elif 1 < len(tag_records): 
             raise Exception("More than one record exist by tag")
         else :
@@ -135,13 +167,135 @@ class Database(object):
             return None
 
     def popular_messages(self, convthread_id):
-        """Returns popular convthreads of ``convthread_id``. 
-        It is sorted in ascending order.
+        """Returns popular messages of ``convthread_id`` as 
+        :class:`~Messages`. It is sorted in ascending order.
         """
-        if self.dfs.has_key(convthread_id):
-            return self.dfs[convthread_id]
+        messages = self.messages.get(convthread_id)
+        if messages is not None:
+            return messages
         else:
             import warnings
             warnings.warn("No record matched with convthread_id", Warning)
             return []
 
+    def popular_messages_of(self, convthread_ids):
+        """Returns popular messages of each of ``convthread_ids`` at once. 
+        See :meth:`popular_messages`. 
+        """
+        results = self.messages.get_many(convthread_ids)
+        if any(messages is None for messages in results):
+            import warnings
+            warnings.warn("No record matched with convthread_id", Warning)
+            results = [[] if messages is None else messages 
+                       for messages in results]
+        return results
+
+    def max_popularities(self, convthread_ids):
+        """Returns an array of the maximum popularity of messages of each of 
+        ``convthread_ids``. See :meth:`MessageStore.max_popularities`. 
+        """
+        return self.messages.max_popularities(convthread_ids)
+
+    def upsert_convthread(self, convthread_id, lat, lng, title, 
+                          tag_ids=None):
+        """Adds a convthread or updates it. Messages of the convthread are 
+        kept. The raw ``taggings`` table is left as it is loaded.
+
+        : param convthread_id: a convthread id
+        : param lat: latitude of the convthread
+        : param lng: longitude of the convthread
+        : param title: title of the convthread
+        : param tag_ids: if set, ``tag_ids`` of the convthread. Otherwise 
+                         the current tags are kept.
+        """
+        convthread_record = dict(zip(CONVTHREAD_FIELDS, 
+                                     [convthread_id, lat, lng, title]))
+
+        if tag_ids is None:
+            tag_ids = self.tag_ids(convthread_id)
+        convthread_df = pd.DataFrame([convthread_record], 
+                                     columns=CONVTHREAD_FIELDS)
+        taggings_df = pd.DataFrame({"convthread_id": convthread_id, 
+                                    "tag_id": list(tag_ids)},
+                                   columns=["convthread_id", "tag_id"])
+        tagged_df = convthread_df.merge(taggings_df, on="convthread_id")
+
+        df = self.dfs["convthreads_with_tags"]
+        self.dfs["convthreads_with_tags"] = pd.concat(
+            [df[df.convthread_id != convthread_id], tagged_df],
+            ignore_index=True)[df.columns]
+
+        df = self.dfs["convthreads"]
+        convthread_df = convthread_df[df.columns]
+        self.dfs["convthreads"] = pd.concat(
+            [df[df.convthread_id != convthread_id], convthread_df], 
+            ignore_index=True)
+
+        self.update_lookups(convthread_id, {
+            "convthreads": [convthread_df.values[0]],
+            "convthread_tag_ids": tagged_df["tag_id"].values,
+        })
+
+        messages = self.messages.get(convthread_id)
+        columns = ([], [], []) if messages is None else messages.columns()
+        self.messages.put(convthread_id, convthread_record, *columns)
+        self.version += 1
+
+    def upsert_message(self, convthread_id, message_id, title, popularity):
+        """Adds a message to a convthread or updates it. The message is 
+        inserted by a binary search, so that messages of the convthread stay 
+        sorted by popularity. The raw ``messages`` table is left as it is 
+        loaded.
+
+        : param convthread_id: an existing convthread id
+        : param message_id: a message id
+        : param title: title of the message
+        : param popularity: popularity of the message
+        """
+        messages = self.messages.get(convthread_id)
+        if messages is None:
+            raise KeyError("No convthread : %s" % convthread_id)
+
+        message_ids, titles, popularities = messages.columns()
+        if message_id in message_ids:
+            position = message_ids.index(message_id)
+            for column in [message_ids, titles, popularities]:
+                del column[position]
+
+        popularity = float(POPULARITY_DTYPE(popularity))
+        position = bisect.bisect_right(popularities, popularity)
+        message_ids.insert(position, message_id)
+        titles.insert(position, title)
+        popularities.insert(position, popularity)
+        self.messages.put(convthread_id, messages.convthread_record(), 
+                          message_ids, titles, popularities)
+        self.version += 1
+
+    def delete_convthread(self, convthread_id):
+        """Removes a convthread with its messages and tags. Returns ``True`` 
+        if it is removed.
+
+        : param convthread_id: a convthread id
+        """
+        if convthread_id not in self.messages:
+            return False
+        self.messages.delete(convthread_id)
+        for name in ["convthreads", "convthreads_with_tags"]:
+            df = self.dfs[name]
+            self.dfs[name] = df[df.convthread_id != convthread_id]
+        self.update_lookups(convthread_id, {})
+        self.version += 1
+        return True
+
+    def update_lookups(self, convthread_id, values):
+        """Sets values of ``convthread_id`` in created lookup dictionaries 
+        or removes them if a value is not given.
+        """
+        for name in ["convthreads", "convthread_tag_ids"]:
+            lookup = self.lookups.get(name)
+            if None == lookup:
+                continue
+            if name in values:
+                lookup[convthread_id] = values[name]
+            else:
+                lookup.pop(convthread_id, None)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+    ingest
+    ~~~~~~
+
+    Streams datafiles into the database in chunks, so that peak memory of
+    preprocessing is bounded by the size of a chunk rather than the size
+    of the datafiles.
+
+    Each table is read from the first datafile found in a data directory
+    among ``<table>.parquet``, ``<table>.csv``, ``<table>.jsonl`` and
+    ``<table>.pkl``. Pickles cannot be streamed, so they are read at once
+    and then processed in chunks.
+
+"""
+
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+from server.messages import MessageStoreBuilder
+
+DATAFILES = {
+    "messages": "messages.pkl",
+    "convthreads": "convthreads.pkl",
+    "taggings": "taggings.pkl",
+    "tags" : "tags.pkl"
+}
+
+#: Extensions of datafiles in order of preference
+DATAFILE_EXTENSIONS = ('.parquet', '.csv', '.jsonl', '.pkl')
+
+#: Columns of each table
+TABLE_COLUMNS = {
+    "messages": ["message_id", "convthread_id", "message", "popularity"],
+    "convthreads": ["convthread_id", "lat", "lng", "title"],
+    "taggings": ["tagging_id", "convthread_id", "tag_id"],
+    "tags": ["tag_id", "tag"],
+}
+
+#: Columns of each table that are read as strings from text datafiles
+STRING_COLUMNS = {
+    "messages": ["message_id", "convthread_id", "message"],
+    "convthreads": ["convthread_id", "title"],
+    "taggings": ["tagging_id", "convthread_id", "tag_id"],
+    "tags": ["tag_id", "tag"],
+}
+
+#: Columns of each table that are read as strings from text datafiles and
+#: converted to floats afterwards, so that values written with ``repr``
+#: are read back exactly
+FLOAT_COLUMNS = {
+    "messages": ["popularity"],
+    "convthreads": ["lat", "lng"],
+    "taggings": [],
+    "tags": [],
+}
+
+#: The default number of rows of a chunk
+CHUNK_SIZE = 100000
+
+def find_datafile(datapath, name):
+    """Returns a path of the datafile of table ``name`` in ``datapath``.
+
+    : param datapath: a directory that contains datafiles
+    : param name: a table name. See :data:`DATAFILES`.
+    """
+    for extension in DATAFILE_EXTENSIONS:
+        path = os.path.join(datapath, name + extension)
+        if os.path.isfile(path):
+            return path
+    raise IOError("No datafile of %s in %s" % (name, datapath))
+
+def read_chunks(path, name, chunksize=CHUNK_SIZE):
+    """Yields dataframes of at most ``chunksize`` rows of a datafile. The
+    format is chosen by the extension of ``path``.
+
+    : param path: a path of the datafile
+    : param name: a table name. See :data:`DATAFILES`.
+    : param chunksize: the number of rows of a chunk
+    """
+    extension = os.path.splitext(path)[1]
+    if '.csv' == extension:
+        return read_csv_chunks(path, name, chunksize)
+    elif '.jsonl' == extension:
+        return read_jsonl_chunks(path, chunksize)
+    elif '.parquet' == extension:
+        return read_parquet_chunks(path, chunksize)
+    else:
+        return read_pickle_chunks(path, chunksize)
+
+def read_csv_chunks(path, name, chunksize):
+    # the float parser of pandas may be off by the last digit
+    dtype = dict((column, str) for column in 
+                 STRING_COLUMNS[name] + FLOAT_COLUMNS[name])
+    for chunk in pd.read_csv(path, chunksize=chunksize, dtype=dtype,
+                             keep_default_na=False):
+        for column in FLOAT_COLUMNS[name]:
+            chunk[column] = chunk[column].astype(np.float64)
+        yield chunk
+
+def read_jsonl_chunks(path, chunksize):
+    with open(path) as jsonl_file:
+        rows = []
+        for line in jsonl_file:
+            if not line.strip():
+                continue
+            rows.append(json.loads(line))
+            if chunksize <= len(rows):
+                yield pd.DataFrame(rows)
+                rows = []
+        if rows:
+            yield pd.DataFrame(rows)
+
+def read_parquet_chunks(path, chunksize):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise IOError("pyarrow is required to read %s" % path)
+
+    # a row group is the smallest unit of a parquet file to read
+    parquet_file = pq.ParquetFile(path)
+    for i in xrange(parquet_file.num_row_groups):
+        df = parquet_file.read_row_group(i).to_pandas()
+        for start in xrange(0, len(df), chunksize):
+            yield df.iloc[start:start + chunksize]
+
+def read_pickle_chunks(path, chunksize):
+    df = pd.read_pickle(path)
+    for start in xrange(0, len(df), chunksize):
+        yield df.iloc[start:start + chunksize]
+
+def read_table(datapath, name, chunksize=CHUNK_SIZE):
+    """Reads a whole table of ``name`` from ``datapath``.
+    """
+    path = find_datafile(datapath, name)
+    chunks = list(read_chunks(path, name, chunksize))
+    if not chunks:
+        return pd.DataFrame(columns=TABLE_COLUMNS[name])
+    return pd.concat(chunks, ignore_index=True)
+
+def read_database(datapath, chunksize=CHUNK_SIZE):
+    """Reads datafiles of ``datapath``. The ``messages`` table is refined
+    chunk by chunk and never kept as a whole. Returns a dictionary of the
+    other tables and a :class:`~MessageStore`.
+
+    : param datapath: a directory that contains datafiles
+    : param chunksize: the number of rows of a chunk
+    """
+    dfs = {}
+    for name in ["convthreads", "taggings", "tags"]:
+        dfs[name] = read_table(datapath, name, chunksize)
+
+    builder = MessageStoreBuilder(dfs["convthreads"])
+    path = find_datafile(datapath, "messages")
+    for chunk in read_chunks(path, "messages", chunksize):
+        builder.add(chunk)
+    return dfs, builder.build()
@@ -0,0 +1,462 @@
+# -*- coding: utf-8 -*-
+"""
+    kdtree
+    ~~~~~~
+
+    Implements a spatial index backend of a static KD-tree packed in arrays.
+
+    Points are ordered once, so that every node of a balanced tree is a
+    contiguous range of the columns, and nodes are kept in heap order with
+    their bounding boxes. Nodes split at medians, thus leaves have the same
+    number of points however skewed the points are, unlike geohash cells of
+    :class:`~SpatialIndex`. Points added later are kept aside and removed
+    points are masked until the tree is rebuilt.
+
+"""
+
+import numpy as np
+from server.metrics import NO_METRICS
+from server.spatialindex import SpatialIndexPoint
+from server.spatialindex import EMPTY_CELL_COLUMNS, BOX_MARGIN, CELL_MARGIN
+from server.spatialindex import EARTH_HALF_CIRCUMFERENCE
+from server.spatialindex import NEAREST_INITIAL_RADIUS, NEAREST_RADIUS_GROWTH
+from server.spatialindex import bounding_box, box_mask, distances_to
+from server.spatialindex import distance_columns, gather_columns, in_sorted
+from server.spatialindex import object_array, point_codes, point_columns
+from server.spatialindex import select_columns
+
+# The maximum number of points of a leaf
+LEAF_SIZE = 64
+
+# Searches visit every ``LEVEL_STEP``-th level of the tree, so that a few
+# vectorized passes over many small nodes replace a pass for each level.
+LEVEL_STEP = 4
+
+# The tree is rebuilt once points added or removed since it was built are
+# more than this fraction of it, or than ``REBUILD_MINIMUM`` points.
+REBUILD_FRACTION = 0.05
+REBUILD_MINIMUM = 256
+
+def range_positions(starts, stops):
+    """Returns positions of all ranges as an array.
+
+    : param starts: an array of the starts of ranges
+    : param stops: an array of the stops of ranges
+    """
+    lengths = stops - starts
+    total = int(lengths.sum())
+    if 0 == total:
+        return np.empty(0, dtype=np.int64)
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return offsets + np.arange(total)
+
+def tree_order(latitudes, longitudes, depth):
+    """Returns an order of points such that every node of a tree of
+    ``depth`` levels is a contiguous range. Node ``j`` of level ``l`` is the
+    range from ``(j * n) >> l`` to ``((j + 1) * n) >> l``, and it is split
+    at its median along its longer side.
+
+    : param latitudes: an array of latitudes
+    : param longitudes: an array of longitudes
+    : param depth: the number of levels above leaves
+    """
+    n = len(latitudes)
+    order = np.arange(n)
+    for level in xrange(depth):
+        for j in xrange(1 << level):
+            start = (j * n) >> level
+            stop = ((j + 1) * n) >> level
+            middle = ((2 * j + 1) * n) >> (level + 1)
+            segment = order[start:stop]
+            segment_latitudes = latitudes[segment]
+            segment_longitudes = longitudes[segment]
+            # a degree of longitude is shorter at higher latitudes
+            width = segment_longitudes.ptp() * np.cos(
+                np.radians(segment_latitudes.mean()))
+            if segment_latitudes.ptp() < width:
+                values = segment_longitudes
+            else:
+                values = segment_latitudes
+            order[start:stop] = segment[
+                np.argpartition(values, middle - start)]
+    return order
+
+class KDTreeIndex(object):
+    """ Implements spatial search with a packed KD-tree. It is a backend of
+    radius and nearest searches with the same methods as
+    :class:`~SpatialIndex`: :meth:`add_point`, :meth:`add_points` to
+    bulk-load, :meth:`remove_point`, :meth:`get_within_refs`,
+    :meth:`get_nearest_arrays` and :meth:`get_k_nearest_arrays`.
+
+            index = KDTreeIndex()
+            index.add_points(latitudes, longitudes, refs, uids)
+            refs = index.get_within_refs(SpatialIndexPoint(59.33, 18.06), 500)
+
+    """
+
+    def __init__(self, leaf_size=LEAF_SIZE):
+        """
+        : param leaf_size: the maximum number of points of a leaf
+        """
+        self.leaf_size = leaf_size
+
+        #: Columns of points of the tree in the order of nodes. See
+        #: :data:`CELL_COLUMNS`.
+        self.columns = EMPTY_CELL_COLUMNS
+        #: The number of levels above leaves
+        self.depth = 0
+        #: Bounding boxes of nodes in heap order, i.e. children of node
+        #: ``i`` are ``2 * i + 1`` and ``2 * i + 2``.
+        self.souths = np.array([np.inf])
+        self.norths = np.array([-np.inf])
+        self.wests = np.array([np.inf])
+        self.easts = np.array([-np.inf])
+        #: A boolean mask of points of the tree which are not removed, or
+        #: ``None`` if no point is removed.
+        self.alive = None
+        #: The number of points removed from the tree
+        self.removed = 0
+        #: Columns of points added after the tree is built
+        self.added = EMPTY_CELL_COLUMNS
+
+    def __len__(self):
+        return (len(self.columns['refs']) - self.removed +
+                len(self.added['refs']))
+
+    def build(self, columns):
+        """Replaces all points with points of ``columns`` and builds the
+        tree of them.
+
+        : param columns: a dictionary of columns. See :data:`CELL_COLUMNS`.
+        """
+        n = len(columns['refs'])
+        depth = 0
+        while self.leaf_size < (n >> depth):
+            depth += 1
+        order = tree_order(columns['latitudes'], columns['longitudes'],
+                           depth)
+        self.columns = select_columns(columns, order)
+        self.depth = depth
+        self.alive = None
+        self.removed = 0
+        self.added = EMPTY_CELL_COLUMNS
+
+        node_count = (2 << depth) - 1
+        self.souths = np.empty(node_count)
+        self.souths.fill(np.inf)
+        self.norths = -self.souths
+        self.wests = self.souths.copy()
+        self.easts = -self.souths
+        if 0 == n:
+            return
+
+        leaves = (1 << depth) - 1
+        starts = (np.arange(1 << depth) * n) >> depth
+        for boxes, function, name in [(self.souths, np.minimum, 'latitudes'),
+                                      (self.norths, np.maximum, 'latitudes'),
+                                      (self.wests, np.minimum, 'longitudes'),
+                                      (self.easts, np.maximum, 'longitudes')]:
+            boxes[leaves:] = function.reduceat(self.columns[name], starts)
+            for level in reversed(xrange(depth)):
+                first = (1 << level) - 1
+                children = (2 << level) - 1
+                boxes[first:children] = function(
+                    boxes[children:2 * children + 1:2],
+                    boxes[children + 1:2 * children + 2:2])
+
+    def add_point(self, point):
+        """Add spatial point. It is searched with the points of the tree
+        until the tree is rebuilt.
+
+        : param point: a spatial index point
+        """
+        assert isinstance(point, SpatialIndexPoint), (
+            'Instance of point != SpatialIndexPoint.'
+        )
+        self.add_points([point.latitude], [point.longitude],
+                        object_array([point.ref]), [point.uid])
+
+    def add_points(self, latitudes, longitudes, refs, uids=None):
+        """Add spatial points in bulk. Points added to an empty index are
+        bulk-loaded into the tree at once.
+
+        : param latitudes: an array of latitudes
+        : param longitudes: an array of longitudes
+        : param refs: references to associated objects of points
+        : param uids: optional integer ids of points. -1 by default.
+        """
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        if not (isinstance(refs, np.ndarray) and object == refs.dtype):
+            refs = object_array(refs)
+        if uids is None:
+            uids = np.empty(len(latitudes), dtype=np.int64)
+            uids.fill(-1)
+        columns = point_columns(latitudes, longitudes, refs,
+                                np.asarray(uids, dtype=np.int64),
+                                point_codes(latitudes, longitudes))
+        if 0 == len(self):
+            self.build(columns)
+        else:
+            self.added = gather_columns([self.added, columns])
+            self.rebuild_if_changed()
+
+    def remove_point(self, point):
+        """Remove spatial point. Returns ``True`` if the point is removed.
+
+        : param point: a spatial index point at its indexed location. It is
+                       identified by ``uid``, or by ``ref`` if it has no
+                       ``uid``.
+        """
+        assert isinstance(point, SpatialIndexPoint), (
+            'Instance of point != SpatialIndexPoint.'
+        )
+
+        def matches(columns):
+            if 0 <= point.uid:
+                return columns['uids'] == point.uid
+            return columns['refs'] == point.ref
+
+        inner, positions = self.get_node_positions(point, 0)
+        positions = np.concatenate((inner, positions))
+        if self.alive is not None:
+            positions = positions[self.alive[positions]]
+        found = positions[matches(select_columns(self.columns, positions))]
+        if 0 < len(found):
+            if self.alive is None:
+                self.alive = np.ones(len(self.columns['refs']), dtype=bool)
+            self.alive[found[0]] = False
+            self.removed += 1
+            self.rebuild_if_changed()
+            return True
+
+        found = np.flatnonzero(matches(self.added) & box_mask(point, 0,
+                                                              self.added))
+        if 0 == len(found):
+            return False
+        self.added = select_columns(self.added, np.delete(
+            np.arange(len(self.added['refs'])), found[0]))
+        return True
+
+    def move_point(self, point, latitude, longitude):
+        """Move spatial point to a new location. Returns the moved point.
+
+        : param point: a spatial index point at its indexed location
+        : param latitude: a new latitude
+        : param longitude: a new longitude
+        """
+        self.remove_point(point)
+        moved_point = SpatialIndexPoint(latitude, longitude, ref=point.ref,
+                                        uid=point.uid)
+        self.add_point(moved_point)
+        return moved_point
+
+    def rebuild_if_changed(self):
+        """Rebuilds the tree of all points if many points are added or
+        removed since it is built.
+        """
+        changed = self.removed + len(self.added['refs'])
+        if changed <= max(REBUILD_MINIMUM,
+                          REBUILD_FRACTION * len(self.columns['refs'])):
+            return
+        columns = self.columns
+        if self.alive is not None:
+            columns = select_columns(columns, self.alive)
+        self.build(gather_columns([columns, self.added]))
+
+    def get_node_ranges(self, nodes, level):
+        """Returns starts and stops of points of ``nodes`` of ``level``.
+        """
+        n = len(self.columns['refs'])
+        offsets = nodes - ((1 << level) - 1)
+        return (offsets * n) >> level, ((offsets + 1) * n) >> level
+
+    def get_node_positions(self, center_point, radius):
+        """Returns positions of points of the tree in nodes that intersect
+        with the bounding box of a circle. Positions of nodes entirely
+        within the circle and the others are returned separately. Removed
+        points are included.
+
+        : param center_point: a center of the circle
+        : param radius: a radius of the circle
+        """
+        south, north, longitude_angle = bounding_box(
+            center_point.latitude, center_point.longitude, radius)
+        south -= BOX_MARGIN
+        north += BOX_MARGIN
+        inner = False
+        if None != longitude_angle:
+            west = center_point.longitude - longitude_angle - BOX_MARGIN
+            east = center_point.longitude + longitude_angle + BOX_MARGIN
+            # Along a parallel or a meridian within 90 degrees of longitude
+            # from the center, the distance grows toward either end. Thus
+            # the farthest point of such a node is one of its corners.
+            inner = -180.0 <= west and east < 180.0
+
+        levels = range(self.depth % LEVEL_STEP, self.depth + 1, LEVEL_STEP)
+        nodes = np.arange((1 << levels[0]) - 1, (2 << levels[0]) - 1)
+        inner_ranges = []
+        for i, level in enumerate(levels):
+            souths = self.souths[nodes]
+            norths = self.norths[nodes]
+            wests = self.wests[nodes]
+            easts = self.easts[nodes]
+            overlap = (south <= norths) & (souths <= north)
+            if None != longitude_angle:
+                if west < -180.0:
+                    overlap &= (west + 360.0 <= easts) | (wests <= east)
+                elif 180.0 <= east:
+                    overlap &= (west <= easts) | (wests <= east - 360.0)
+                else:
+                    overlap &= (west <= easts) & (wests <= east)
+
+            candidates = []
+            if inner:
+                candidates = np.flatnonzero(
+                    overlap & (south <= souths) & (norths <= north) &
+                    (west <= wests) & (easts <= east))
+            if 0 < len(candidates):
+                corners = point_columns(
+                    np.repeat(np.column_stack((souths[candidates],
+                                               norths[candidates])), 2),
+                    np.tile(np.column_stack((wests[candidates],
+                                             easts[candidates])), 2).ravel(),
+                    None, None, None)
+                within = candidates[distances_to(
+                    center_point, corners).reshape(-1, 4).max(axis=1) <=
+                    radius - CELL_MARGIN]
+                inner_ranges.append(self.get_node_ranges(nodes[within],
+                                                         level))
+                overlap[within] = False
+
+            nodes = nodes[overlap]
+            if level < self.depth:
+                # descendants of a node at a level are contiguous
+                fanout = 1 << (levels[i + 1] - level)
+                firsts = (nodes + 1) * fanout - 1
+                nodes = range_positions(firsts, firsts + fanout)
+
+        starts, stops = self.get_node_ranges(nodes, self.depth)
+        positions = range_positions(starts, stops)
+        if not inner_ranges:
+            return np.empty(0, dtype=np.int64), positions
+        return (range_positions(
+                    np.concatenate([starts for starts, _ in inner_ranges]),
+                    np.concatenate([stops for _, stops in inner_ranges])),
+                positions)
+
+    def get_candidate_columns(self, center_point, radius, uids=None):
+        """Returns columns of points near a circle, i.e. points of nodes
+        entirely within the circle and the other points that may be within
+        it, which are points of the other nodes and points added later.
+
+        : param center_point: a center of the circle
+        : param radius: a radius of the circle
+        : param uids: if set, only points whose ``uid`` is in this sorted
+                      array are returned.
+        """
+        inner, positions = self.get_node_positions(center_point, radius)
+        if self.alive is not None:
+            inner = inner[self.alive[inner]]
+            positions = positions[self.alive[positions]]
+        inner_columns = select_columns(self.columns, inner)
+        columns = gather_columns([select_columns(self.columns, positions),
+                                  self.added])
+        if uids is not None:
+            inner_columns = select_columns(
+                inner_columns, in_sorted(inner_columns['uids'], uids))
+            columns = select_columns(columns, in_sorted(columns['uids'],
+                                                        uids))
+        return inner_columns, columns
+
+    def get_within_refs(self, center_point, radius=2000, uids=None,
+                        cache=None, metrics=NO_METRICS):
+        """Returns references of points within ``radius``. Points of nodes
+        entirely within the circle are accepted as they are, and the other
+        points are filtered by the bounding box of the circle before exact
+        distances. See :meth:`SpatialIndex.get_within_refs`.
+
+        : param center_point: a center point
+        : param radius: a radius from a center point. 2000 by default.
+        : param uids: if set, only points whose ``uid`` is in this sorted
+                      array are considered.
+        : param cache: unused. Nodes are not shared between searches.
+        : param metrics: an optional :class:`~Metrics` that observes the
+                         candidate fetch and the distance filter
+        """
+        with metrics.stage("candidates"):
+            inner_columns, columns = self.get_candidate_columns(
+                center_point, radius, uids)
+        with metrics.stage("distance"):
+            positions = np.flatnonzero(box_mask(center_point, radius,
+                                                columns))
+            distances = distances_to(center_point,
+                                     distance_columns(columns, positions))
+            refs = np.concatenate((inner_columns['refs'],
+                                   columns['refs'][positions[
+                                       distances <= radius]]))
+        metrics.observe_candidates(
+            "distance", len(inner_columns['refs']) + len(columns['refs']),
+            len(refs))
+        metrics.observe_candidates("exact", len(positions),
+                                   np.count_nonzero(distances <= radius))
+        return refs
+
+    def get_nearest_arrays(self, center_point, radius=2000, uids=None,
+                           cache=None, metrics=NO_METRICS):
+        """Returns references and distances of points within ``radius`` as
+        arrays. See :meth:`SpatialIndex.get_nearest_arrays`.
+        """
+        with metrics.stage("candidates"):
+            columns = gather_columns(list(self.get_candidate_columns(
+                center_point, radius, uids)))
+        with metrics.stage("distance"):
+            positions = np.flatnonzero(box_mask(center_point, radius,
+                                                columns))
+            distances = distances_to(center_point,
+                                     distance_columns(columns, positions))
+            within = distances <= radius
+            refs = columns['refs'][positions[within]]
+            distances = distances[within]
+        metrics.observe_candidates("distance", len(columns['refs']),
+                                   len(refs))
+        metrics.observe_candidates("exact", len(positions), len(refs))
+        return refs, distances
+
+    def get_k_nearest_arrays(self, center_point, k, uids=None,
+                             metrics=NO_METRICS):
+        """Finds ``k`` nearest points of ``center_point``. The search area
+        grows like :meth:`SpatialIndex.get_k_nearest_arrays`, but each area
+        costs only the nodes that intersect with it. Returns references and
+        distances of the points as arrays in ascending order of distance.
+
+        : param center_point: a center point
+        : param k: the number of points to find
+        : param uids: if set, only points whose ``uid`` is in this sorted
+                      array are considered.
+        : param metrics: an optional :class:`~Metrics` that observes the
+                         search
+        """
+        with metrics.stage("nearest"):
+            radius = NEAREST_INITIAL_RADIUS
+            examined = 0
+            while True:
+                columns = gather_columns(list(self.get_candidate_columns(
+                    center_point, radius, uids)))
+                columns = select_columns(columns, box_mask(center_point,
+                                                           radius, columns))
+                distances = distances_to(center_point, columns)
+                examined += len(distances)
+                if (k <= np.count_nonzero(distances <= radius) or
+                        EARTH_HALF_CIRCUMFERENCE <= radius):
+                    break
+                radius *= NEAREST_RADIUS_GROWTH
+
+            if k < len(distances):
+                nearest = np.argpartition(distances, k - 1)[:k]
+            else:
+                nearest = np.arange(len(distances))
+            nearest = nearest[np.argsort(distances[nearest],
+                                         kind='mergesort')]
+        metrics.observe_candidates("nearest", examined, len(nearest))
+        return columns['refs'][nearest], distances[nearest]
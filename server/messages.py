@@ -0,0 +1,568 @@
+# -*- coding: utf-8 -*-
+"""
+    messages
+    ~~~~~~~~
+
+    A compact columnar store of refined convthread messages.
+
+    Messages of all convthreads are kept in flat columns sorted by
+    convthread and popularity, so that messages of a convthread are a
+    contiguous slice. Strings are kept in pools of bytes, and convthread
+    information is kept once per convthread and referenced by position.
+    Message records are created only when they are read.
+
+"""
+
+import json
+import math
+from json.encoder import encode_basestring_ascii
+
+import numpy as np
+
+#: Fields of the convthread information attached to each message record
+CONVTHREAD_FIELDS = ["convthread_id", "lat", "lng", "title"]
+
+#: A type of popularity columns
+POPULARITY_DTYPE = np.float32
+
+def encode_string(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def encode_float(value):
+    """Returns the JSON of a float as ``json.dumps`` does.
+    """
+    if math.isinf(value) or math.isnan(value):
+        return json.dumps(value)
+    return repr(value)
+
+def popularity_value(popularity):
+    """Returns a float of a stored popularity. It has only the digits of 
+    :data:`POPULARITY_DTYPE`, so that ``0.4606936`` is not written as 
+    ``0.4606935977935791`` of the float64 it widens to.
+    """
+    # ``str`` of float32 keeps only 6 digits before numpy 1.14, but ``repr``
+    # keeps enough digits to round-trip.
+    return float(repr(POPULARITY_DTYPE(popularity)))
+
+def message_fragments(message_ids, titles, popularities):
+    """Returns a :class:`StringColumn` of JSON fragments of messages. A 
+    fragment has the fields of a message record but the convthread, in the 
+    order of sorted keys. See :meth:`Messages.fragment`.
+
+    : param message_ids: a list of message ids
+    : param titles: a list of message titles
+    : param popularities: popularities of the messages
+    """
+    return StringColumn.from_strings([
+        '"message_id": %s, "popularity": %s, "title": %s' % (
+            encode_basestring_ascii(message_id),
+            encode_float(popularity_value(popularity)),
+            encode_basestring_ascii(title))
+        for message_id, title, popularity in zip(
+            message_ids, titles, popularities)])
+
+def convthread_fragment(convthread):
+    """Returns the JSON of a convthread record.
+    """
+    return json.dumps(convthread, sort_keys=True)
+
+class StringColumn(object):
+    """A column of strings stored as a pool of bytes and offsets of each
+    string.
+    """
+
+    def __init__(self, pool, offsets):
+        self.pool = pool
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, values):
+        """Creates a column of ``values``. Unicode strings are encoded in
+        UTF-8.
+        """
+        values = [encode_string(value) for value in values]
+        offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in values], out=offsets[1:])
+        pool = np.frombuffer(''.join(values) or '\0', dtype=np.uint8)
+        return cls(pool, offsets)
+
+    @classmethod
+    def concatenate(cls, columns):
+        """Creates a column of strings of all ``columns`` in order.
+        """
+        pools = [np.empty(0, dtype=np.uint8)]
+        offsets = [np.zeros(1, dtype=np.int64)]
+        base = 0
+        for column in columns:
+            pools.append(column.pool)
+            offsets.append(column.offsets[1:] + base)
+            base += len(column.pool)
+        return cls(np.concatenate(pools), np.concatenate(offsets))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.pool[self.offsets[i]:self.offsets[i + 1]].tostring()
+
+    def take(self, order, blocksize=1 << 20):
+        """Creates a column of strings at positions ``order``. Strings are 
+        gathered ``blocksize`` strings at a time to bound temporary memory.
+        """
+        lengths = self.offsets[1:] - self.offsets[:-1]
+        offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        np.cumsum(lengths[order], out=offsets[1:])
+        pool = np.zeros(max(offsets[-1], 1), dtype=np.uint8)
+        for start in xrange(0, len(order), blocksize):
+            stop = min(start + blocksize, len(order))
+            positions = order[start:stop]
+            block_lengths = lengths[positions]
+            # a source position of each byte of the block
+            shifts = self.offsets[positions] - (offsets[start:stop] - 
+                                                offsets[start])
+            sources = np.repeat(shifts, block_lengths) + np.arange(
+                offsets[stop] - offsets[start])
+            pool[offsets[start]:offsets[stop]] = self.pool[sources]
+        return StringColumn(pool, offsets)
+
+    def slice(self, start, stop):
+        """Returns strings from ``start`` to ``stop`` as a list.
+        """
+        offsets = self.offsets[start:stop + 1].tolist()
+        data = self.pool[offsets[0]:offsets[-1]].tostring() if offsets else ''
+        base = offsets[0] if offsets else 0
+        return [data[offsets[i] - base:offsets[i + 1] - base]
+                for i in xrange(len(offsets) - 1)]
+
+    def tolist(self):
+        return self.slice(0, len(self))
+
+class Messages(object):
+    """Messages of a convthread in ascending order of popularity. It is a
+    read-only sequence of message records, which are created on access.
+    """
+    # optimization
+    __slots__ = ('store', 'position', 'convthread', 'message_ids', 'titles',
+                 'popularities', 'start', 'fragments')
+
+    def __init__(self, store, position, convthread, message_ids, titles,
+                 popularities, start=0, fragments=None):
+        """
+        : param store: a :class:`MessageStore` of the convthread
+        : param position: a position of the convthread in ``store``
+        : param convthread: a convthread record or ``None`` to read it from
+                            ``store`` on first use
+        : param message_ids: a :class:`StringColumn` of message ids
+        : param titles: a :class:`StringColumn` of message titles
+        : param popularities: popularities of the messages
+        : param start: a position of the first message in ``message_ids``
+                       and ``titles``
+        : param fragments: a :class:`StringColumn` of JSON fragments of the 
+                           messages from ``start``. See 
+                           :func:`message_fragments`.
+        """
+        self.store = store
+        self.position = position
+        self.convthread = convthread
+        self.message_ids = message_ids
+        self.titles = titles
+        #: popularities of the messages in ascending order
+        self.popularities = popularities
+        self.start = start
+        self.fragments = fragments
+
+    def __len__(self):
+        return len(self.popularities)
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError(position)
+        return {
+            "message_id": self.message_ids[self.start + position],
+            "title": self.titles[self.start + position],
+            "popularity": popularity_value(self.popularities[position]),
+            "convthread_id": self.convthread_record(),
+        }
+
+    def fragment(self, position):
+        """Returns the JSON of the message record at ``position``, which is 
+        assembled from fragments encoded in advance.
+        """
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError(position)
+        if None == self.position:
+            convthread = convthread_fragment(self.convthread_record())
+        else:
+            convthread = self.store.convthread_fragments[self.position]
+        return '{"convthread_id": %s, %s}' % (
+            convthread, self.fragments[self.start + position])
+
+    def __iter__(self):
+        for position in xrange(len(self)):
+            yield self[position]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def convthread_record(self):
+        """Returns the convthread record shared by the messages.
+        """
+        if None == self.convthread:
+            self.convthread = self.store.convthread_record(self.position)
+        return self.convthread
+
+    def columns(self):
+        """Returns message ids, titles and popularities as lists.
+        """
+        stop = self.start + len(self)
+        return (self.message_ids.slice(self.start, stop),
+                self.titles.slice(self.start, stop),
+                self.popularities.tolist())
+
+class MessageStore(object):
+    """Messages of all convthreads in flat columns. Convthreads are sorted
+    by ``convthread_id`` and found by a binary search.
+
+    Columns are never modified, as they may be memory-mapped or in use by a
+    search. Updated convthreads are kept in :attr:`updated` with columns of
+    their own.
+    """
+
+    def __init__(self, convthread_ids, latitudes, longitudes, titles,
+                 offsets, message_ids, message_titles, popularities,
+                 fragments=None, convthread_fragments=None):
+        """
+        : param convthread_ids: sorted convthread ids
+        : param latitudes: latitudes of convthreads
+        : param longitudes: longitudes of convthreads
+        : param titles: a :class:`StringColumn` of convthread titles
+        : param offsets: offsets of messages of each convthread
+        : param message_ids: a :class:`StringColumn` of message ids
+        : param message_titles: a :class:`StringColumn` of message titles
+        : param popularities: popularities of messages, sorted in ascending
+                              order within each convthread
+        : param fragments: an optional :class:`StringColumn` of JSON 
+                           fragments of messages. It is encoded if it is not
+                           given. See :func:`message_fragments`.
+        : param convthread_fragments: an optional :class:`StringColumn` of 
+                                      JSON of convthread records
+        """
+        self.convthread_ids = convthread_ids
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+        self.titles = titles
+        self.offsets = offsets
+        self.message_ids = message_ids
+        self.message_titles = message_titles
+        self.popularities = popularities
+
+        # searches respond with JSON of messages, which is encoded once here
+        if None == fragments:
+            fragments = message_fragments(message_ids.tolist(), 
+                                          message_titles.tolist(), 
+                                          popularities)
+        self.fragments = fragments
+        if None == convthread_fragments:
+            convthread_fragments = StringColumn.from_strings([
+                convthread_fragment(self.convthread_record(position))
+                for position in xrange(len(convthread_ids))])
+        self.convthread_fragments = convthread_fragments
+
+        #: :class:`Messages` of convthreads updated or added after creation
+        self.updated = {}
+        #: Ids of convthreads deleted after creation
+        self.deleted = set()
+
+    @classmethod
+    def from_dataframes(cls, convthreads_df, messages_df):
+        """Creates a store from the ``convthreads`` and ``messages`` tables.
+        Messages of unknown convthreads are dropped.
+        """
+        builder = MessageStoreBuilder(convthreads_df)
+        builder.add(messages_df)
+        return builder.build()
+
+    def position(self, convthread_id):
+        """Returns a position of ``convthread_id`` in convthread columns or
+        ``None`` if it does not exist.
+        """
+        convthread_ids = self.convthread_ids
+        if 'S' == convthread_ids.dtype.kind:
+            if not isinstance(convthread_id, basestring):
+                return None
+            convthread_id = encode_string(convthread_id)
+        position = np.searchsorted(convthread_ids, convthread_id)
+        if (position < len(convthread_ids) and
+                convthread_ids[position] == convthread_id):
+            return int(position)
+        return None
+
+    def convthread_record(self, position):
+        """Returns a record of the convthread at ``position``.
+        """
+        return dict(zip(CONVTHREAD_FIELDS, [
+            self.convthread_ids[position:position + 1].tolist()[0],
+            float(self.latitudes[position]),
+            float(self.longitudes[position]),
+            self.titles[position],
+        ]))
+
+    def __contains__(self, convthread_id):
+        if convthread_id in self.updated:
+            return True
+        if convthread_id in self.deleted:
+            return False
+        return None != self.position(convthread_id)
+
+    def get(self, convthread_id):
+        """Returns :class:`Messages` of ``convthread_id`` or ``None``.
+        """
+        messages = self.updated.get(convthread_id)
+        if messages is not None:
+            return messages
+        if convthread_id in self.deleted:
+            return None
+        position = self.position(convthread_id)
+        if None == position:
+            return None
+        start, stop = self.offsets[position:position + 2].tolist()
+        return Messages(self, position, None, self.message_ids,
+                        self.message_titles, self.popularities[start:stop],
+                        start, self.fragments)
+
+    def get_many(self, convthread_ids):
+        """Returns a list of :class:`Messages` or ``None`` for each of 
+        ``convthread_ids``. Convthreads are found by a single vectorized 
+        binary search.
+        """
+        results = [None] * len(convthread_ids)
+        if not self.updated and not self.deleted:
+            lookup = range(len(convthread_ids))
+            keys = list(convthread_ids)
+        else:
+            lookup = []
+            for i, convthread_id in enumerate(convthread_ids):
+                if convthread_id in self.updated:
+                    results[i] = self.updated[convthread_id]
+                elif convthread_id not in self.deleted:
+                    lookup.append(i)
+            keys = [convthread_ids[i] for i in lookup]
+        if 0 == len(lookup) or 0 == len(self.convthread_ids):
+            return results
+
+        positions, found = self.search_positions(keys)
+        found = found.tolist()
+        starts = self.offsets[positions].tolist()
+        stops = self.offsets[positions + 1].tolist()
+        positions = positions.tolist()
+
+        popularities = self.popularities
+        for j, i in enumerate(lookup):
+            if found[j]:
+                results[i] = Messages(self, positions[j], None, 
+                                      self.message_ids, self.message_titles,
+                                      popularities[starts[j]:stops[j]], 
+                                      starts[j], self.fragments)
+        return results
+
+    def search_positions(self, convthread_ids):
+        """Finds positions of ``convthread_ids`` in convthread columns by a 
+        single vectorized binary search. Returns an array of positions and a 
+        boolean array that tells whether each convthread is found. Updated 
+        and deleted convthreads are not considered.
+
+        : param convthread_ids: a non-empty list of convthread ids. The 
+                                store must not be empty.
+        """
+        if 'S' == self.convthread_ids.dtype.kind:
+            keys = np.array(convthread_ids)
+            if 'S' != keys.dtype.kind:
+                keys = np.array([encode_string(key) for key in keys.tolist()])
+        else:
+            keys = np.array(convthread_ids, dtype=object)
+        positions = np.searchsorted(self.convthread_ids, keys)
+        np.minimum(positions, len(self.convthread_ids) - 1, out=positions)
+        found = np.asarray(self.convthread_ids[positions] == keys, dtype=bool)
+        return positions, found
+
+    def max_popularities(self, convthread_ids):
+        """Returns an array of the maximum popularity of messages of each of
+        ``convthread_ids``. It is 0 for convthreads without messages, which 
+        are never popular.
+        """
+        convthread_ids = list(convthread_ids)
+        results = np.zeros(len(convthread_ids))
+        if 0 < len(convthread_ids) and 0 < len(self.convthread_ids):
+            positions, found = self.search_positions(convthread_ids)
+            stops = self.offsets[positions + 1]
+            found &= self.offsets[positions] < stops
+            results[found] = self.popularities[stops[found] - 1]
+
+        if self.updated or self.deleted:
+            for i, convthread_id in enumerate(convthread_ids):
+                messages = self.updated.get(convthread_id)
+                if messages is not None:
+                    results[i] = (messages.popularities[-1] 
+                                  if 0 < len(messages) else 0.0)
+                elif convthread_id in self.deleted:
+                    results[i] = 0.0
+        return results
+
+    def put(self, convthread_id, convthread, message_ids, titles,
+            popularities):
+        """Replaces messages of ``convthread_id``.
+
+        : param convthread: a convthread record
+        : param message_ids: message ids in ascending order of popularity
+        : param titles: message titles
+        : param popularities: popularities in ascending order
+        """
+        self.deleted.discard(convthread_id)
+        popularities = np.array(popularities, dtype=POPULARITY_DTYPE)
+        self.updated[convthread_id] = Messages(
+            self, None, convthread, StringColumn.from_strings(message_ids),
+            StringColumn.from_strings(titles), popularities, 0, 
+            message_fragments(message_ids, titles, popularities))
+
+    def delete(self, convthread_id):
+        """Removes messages of ``convthread_id``.
+        """
+        self.updated.pop(convthread_id, None)
+        self.deleted.add(convthread_id)
+
+    def items(self):
+        """Yields ``convthread_id`` and :class:`Messages` of all convthreads
+        in order of ``convthread_id``.
+        """
+        convthread_ids = set(self.updated)
+        convthread_ids.update(
+            convthread_id for convthread_id in self.convthread_ids.tolist()
+            if convthread_id not in self.deleted)
+        for convthread_id in sorted(convthread_ids):
+            yield convthread_id, self.get(convthread_id)
+
+    def compact(self):
+        """Returns a store that has updated convthreads in its columns. It 
+        is the store itself if no convthread is updated.
+        """
+        if not self.updated and not self.deleted:
+            return self
+
+        convthread_ids, convthreads, message_ids, titles = [], [], [], []
+        popularities = [np.empty(0, dtype=POPULARITY_DTYPE)]
+        offsets = [0]
+        for convthread_id, messages in self.items():
+            convthread_ids.append(convthread_id)
+            convthreads.append(messages.convthread_record())
+            columns = messages.columns()
+            message_ids.extend(columns[0])
+            titles.extend(columns[1])
+            popularities.append(messages.popularities)
+            offsets.append(offsets[-1] + len(messages))
+
+        convthread_ids_array = np.empty(len(convthread_ids), dtype=object)
+        convthread_ids_array[:] = convthread_ids
+        return MessageStore(
+            convthread_ids_array,
+            np.array([convthread["lat"] for convthread in convthreads], 
+                     dtype=np.float64),
+            np.array([convthread["lng"] for convthread in convthreads], 
+                     dtype=np.float64),
+            StringColumn.from_strings(
+                [convthread["title"] for convthread in convthreads]),
+            np.array(offsets, dtype=np.int64),
+            StringColumn.from_strings(message_ids),
+            StringColumn.from_strings(titles),
+            np.concatenate(popularities))
+
+class MessageStoreBuilder(object):
+    """Builds a :class:`MessageStore` from chunks of the ``messages`` table, 
+    so that the whole table is never in memory at once. Messages of unknown 
+    convthreads are dropped.
+    """
+
+    def __init__(self, convthreads_df):
+        """
+        : param convthreads_df: the ``convthreads`` table
+        """
+        convthreads_df = convthreads_df.drop_duplicates("convthread_id")
+        convthread_ids = convthreads_df["convthread_id"].values
+        # string ids are kept as fixed-size bytes, which are compared by the
+        # binary search much faster than objects.
+        if all(isinstance(convthread_id, basestring) 
+               for convthread_id in convthread_ids):
+            convthread_ids = np.array([encode_string(convthread_id) 
+                                       for convthread_id in convthread_ids],
+                                      dtype=str)
+        order = np.argsort(convthread_ids, kind='mergesort')
+        self.convthread_ids = convthread_ids[order]
+        self.latitudes = convthreads_df["lat"].values[order].astype(
+            np.float64)
+        self.longitudes = convthreads_df["lng"].values[order].astype(
+            np.float64)
+        self.titles = StringColumn.from_strings(
+            convthreads_df["title"].values[order])
+
+        #: Columns of each chunk
+        self.positions = []
+        self.popularities = []
+        self.message_ids = []
+        self.message_titles = []
+
+    def add(self, messages_df):
+        """Adds a chunk of the ``messages`` table.
+        """
+        convthread_ids = self.convthread_ids
+        message_convthread_ids = messages_df["convthread_id"].values
+        if 'S' == convthread_ids.dtype.kind:
+            message_convthread_ids = np.array(
+                [encode_string(convthread_id) 
+                 for convthread_id in message_convthread_ids], dtype=str)
+        positions = np.searchsorted(convthread_ids, message_convthread_ids)
+        known = positions < len(convthread_ids)
+        known[known] = (convthread_ids[positions[known]] ==
+                        message_convthread_ids[known])
+
+        self.positions.append(positions[known])
+        self.popularities.append(
+            messages_df["popularity"].values[known].astype(np.float64))
+        self.message_ids.append(StringColumn.from_strings(
+            messages_df["message_id"].values[known]))
+        self.message_titles.append(StringColumn.from_strings(
+            messages_df["message"].values[known]))
+
+    def build(self):
+        """Returns a :class:`MessageStore` of all chunks.
+        """
+        positions = np.concatenate([np.empty(0, dtype=np.int64)] + 
+                                   self.positions)
+        popularities = np.concatenate([np.empty(0)] + self.popularities)
+        self.positions = self.popularities = None
+
+        # a stable sort by convthread and popularity keeps the order of
+        # messages of the same popularity.
+        order = np.lexsort((popularities, positions))
+        offsets = np.zeros(len(self.convthread_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(positions, minlength=len(self.convthread_ids)),
+                  out=offsets[1:])
+        del positions
+
+        message_ids = StringColumn.concatenate(self.message_ids).take(order)
+        self.message_ids = None
+        message_titles = StringColumn.concatenate(
+            self.message_titles).take(order)
+        self.message_titles = None
+
+        return MessageStore(
+            self.convthread_ids, self.latitudes, self.longitudes, 
+            self.titles, offsets, message_ids, message_titles, 
+            popularities[order].astype(POPULARITY_DTYPE))
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+    metrics
+    ~~~~~~~
+
+    Aggregates latencies of each stage of searches and the number of
+    candidates they examine, and renders them in the Prometheus text format.
+
+    Instrumented code always calls :class:`Metrics`, and a disabled one does
+    nothing but return a shared no-op timer.
+
+"""
+
+import bisect
+import threading
+import time
+
+# Upper bounds of latency buckets
+# unit : second
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# Upper bounds of buckets of the number of candidates
+COUNT_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+class Histogram(object):
+    """A histogram of observed values. Buckets are not cumulative until it
+    is rendered.
+    """
+
+    def __init__(self, buckets):
+        #: Sorted upper bounds of buckets
+        self.buckets = buckets
+        #: The number of values of each bucket and of the overflow
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        """Returns lines of the histogram in the Prometheus text format.
+
+        : param name: a metric name
+        : param labels: a formatted label set without braces, e.g.
+                        ``stage="tags"``
+        """
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bound,
+                                                       cumulative))
+        lines.append('%s_sum{%s} %r' % (name, labels, float(self.sum)))
+        lines.append('%s_count{%s} %d' % (name, labels, self.count))
+        return lines
+
+class NullTimer(object):
+    """A timer of disabled :class:`Metrics`.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_TIMER = NullTimer()
+
+class StageTimer(object):
+    """Observes the time spent in a ``with`` block as a stage.
+    """
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe_stage(self.stage, time.time() - self.start)
+        return False
+
+class Metrics(object):
+    """Latencies of stages and candidates of searches.
+
+            metrics = Metrics()
+            with metrics.stage("tags"):
+                ...
+            metrics.observe_candidates("distance", examined, accepted)
+            print metrics.render()
+
+    """
+
+    def __init__(self, enabled=True):
+        """
+        : param enabled: if not set, nothing is observed
+        """
+        self.enabled = enabled
+
+        #: Latency histograms of each stage
+        self.stages = {}
+        #: Histograms of candidates examined and accepted by each stage
+        self.examined = {}
+        self.accepted = {}
+
+        # searches run in threads of a server
+        self.lock = threading.Lock()
+
+    def stage(self, name):
+        """Returns a context manager that observes the time spent in it as
+        stage ``name``.
+        """
+        if not self.enabled:
+            return NULL_TIMER
+        return StageTimer(self, name)
+
+    def observe_stage(self, name, seconds):
+        with self.lock:
+            histogram = self.stages.get(name)
+            if None == histogram:
+                histogram = self.stages[name] = Histogram(LATENCY_BUCKETS)
+            histogram.observe(seconds)
+
+    def observe_candidates(self, name, examined, accepted):
+        """Observes the number of candidates a stage examined and accepted.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            for histograms, value in [(self.examined, examined),
+                                      (self.accepted, accepted)]:
+                histogram = histograms.get(name)
+                if None == histogram:
+                    histogram = histograms[name] = Histogram(COUNT_BUCKETS)
+                histogram.observe(value)
+
+    def render(self, counters=None):
+        """Returns all metrics in the Prometheus text format.
+
+        : param counters: an optional dictionary of other counters to render
+                          such as hits of a cache
+        """
+        families = [
+            ("search_stage_duration_seconds", "Time spent in each stage of "
+             "searches.", self.stages),
+            ("search_candidates_examined", "Candidates examined by each stage "
+             "of searches.", self.examined),
+            ("search_candidates_accepted", "Candidates accepted by each stage "
+             "of searches.", self.accepted),
+        ]
+
+        lines = []
+        with self.lock:
+            for name, help, histograms in families:
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s histogram' % name)
+                for stage in sorted(histograms):
+                    lines.extend(histograms[stage].render(
+                        name, 'stage="%s"' % stage))
+
+        for name, value in sorted((counters or {}).items()):
+            lines.append('# TYPE %s counter' % name)
+            lines.append('%s %r' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+#: Disabled metrics, which searches use unless metrics are enabled
+NO_METRICS = Metrics(enabled=False)
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+    reload
+    ~~~~~~
+
+    Reloads the dataset of a running server without downtime.
+
+    A new database and search are built in a background thread while
+    requests keep using the current ones, and they are swapped in by a
+    single reference assignment. Requests take the search once when they
+    start, thus in-flight requests finish on the dataset they started with.
+
+"""
+
+import time
+import signal
+import warnings
+import threading
+
+class Reloader(object):
+    """Runs reloads in a background thread, one at a time.
+
+            reloader = Reloader(load, install)
+            reloader.reload()
+
+    """
+
+    def __init__(self, load, install):
+        """
+        : param load: a function that builds and returns a new tuple of
+                      :class:`~Database` and :class:`~Search`
+        : param install: a function that makes a tuple returned by ``load``
+                         current
+        """
+        self.load = load
+        self.install = install
+
+        #: The number of completed reloads
+        self.generation = 0
+        #: An error message of the last failed reload or ``None``
+        self.error = None
+        #: Seconds the last completed reload took
+        self.seconds = None
+
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def running(self):
+        thread = self.thread
+        return None != thread and thread.is_alive()
+
+    def reload(self):
+        """Starts a reload unless one is running. Returns ``True`` if it is
+        started.
+        """
+        with self.lock:
+            if self.running:
+                return False
+            self.thread = threading.Thread(target=self.run, name="reload")
+            # a reload never keeps a stopping server alive
+            self.thread.daemon = True
+            self.thread.start()
+            return True
+
+    def run(self):
+        """Loads and installs a new dataset. Errors are warned and kept in
+        :attr:`error`, and the current dataset is kept.
+        """
+        start = time.time()
+        try:
+            data, search = self.load()
+            self.install(data, search)
+        except Exception as e:
+            warnings.warn("Reload failed. %s" % e, Warning)
+            self.error = "%s" % e
+            return
+        self.seconds = time.time() - start
+        self.error = None
+        self.generation += 1
+
+    def join(self, timeout=None):
+        """Waits for a running reload to finish.
+        """
+        thread = self.thread
+        if None != thread:
+            thread.join(timeout)
+
+    def install_signal(self, name):
+        """Starts a reload whenever the process receives signal ``name``,
+        e.g. ``SIGHUP``. It must be called in the main thread.
+        """
+        signal.signal(getattr(signal, name),
+                      lambda signum, frame: self.reload())
+
+    def status(self):
+        """Returns a dictionary of the state of reloads.
+        """
+        return {
+            'running': self.running,
+            'generation': self.generation,
+            'error': self.error,
+            'seconds': self.seconds,
+        }
@@ -7,10 +7,31 @@
 
 """
 
-from flask import current_app
+import heapq
+import math
+import geohash
+import multiprocessing
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
 from server.spatialindex import SpatialIndexPoint, SpatialIndex
+from server.spatialindex import distances_to, gather_columns, in_sorted
+from server.spatialindex import box_mask, column_points, select_columns
+from server.spatialindex import circle_mask, distance_columns
+from server.spatialindex import bounds_mask, box_precision
+from server.kdtree import KDTreeIndex
+from server.spatialindex import cell_offsets, point_codes, point_columns
+from server.spatialindex import CELL_COLUMNS, EMPTY_CELL_COLUMNS
+from server.messages import popularity_value
+from server.metrics import NO_METRICS
 from server.data import Database
-from werkzeug.datastructures import ImmutableList
+from werkzeug.datastructures import ImmutableDict, ImmutableList
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    # python 2 requires the ``futures`` backport
+    ProcessPoolExecutor = None
 
 # Default radius size parameters
 RADIUS_SIZES = ImmutableList([
@@ -18,127 +39,802 @@ RADIUS_SIZES = ImmutableList([
     2000,
 ])
 
+# Backends of radius and nearest searches by name. A backend has the methods
+# of :class:`~SpatialIndex` to add, bulk-load and remove points and to find 
+# points within a radius and nearest ones. Searches of cells such as 
+# clusters and boxes are always served by the geohash spatial indexers.
+SPATIAL_INDEX_BACKENDS = ImmutableDict({
+    'geohash': SpatialIndex,
+    'kdtree': KDTreeIndex,
+})
+
+def code_partitions(codes, count):
+    """Splits points into at most ``count`` ranges of geohash codes of 
+    about the same number of points. Returns arrays of positions of points 
+    in each range, in ascending order of codes. Points of the same code are 
+    in the same range and their positions are ascending.
+
+    : param codes: an array of geohash codes of points
+    : param count: the number of ranges
+    """
+    if count <= 1 or len(codes) <= 1:
+        return [np.arange(len(codes))]
+
+    # quantiles of a sample of codes bound the ranges
+    sample = np.sort(codes[::max(1, len(codes) // (1024 * count))])
+    bounds = np.unique(sample[np.arange(1, count) * len(sample) // count])
+    ranges = np.searchsorted(bounds, codes, side='right')
+    return [np.flatnonzero(i == ranges) for i in xrange(len(bounds) + 1)]
+
+def sort_partition(partition):
+    """Returns columns of a partition of points sorted by geohash codes. It 
+    runs in a worker process of :func:`map_partitions`. References are left 
+    ``None`` to be filled by ``uid``s, as they are slow to pickle.
+
+    : param partition: a tuple of latitudes, longitudes, ``uid``s and codes
+                       arrays, ``uid``s in ascending order
+    """
+    latitudes, longitudes, uids, codes = partition
+    # a stable sort keeps points of the same code by ``uid``
+    order = np.argsort(codes, kind='mergesort')
+    return point_columns(latitudes[order], longitudes[order], None, 
+                         uids[order], codes[order])
+
+def map_partitions(function, partitions, workers=1):
+    """Applies ``function`` to each partition in ``workers`` processes. 
+    Returns a list of results in the order of ``partitions``.
+
+    : param function: a module-level function, which can be pickled
+    : param partitions: a list of arguments of ``function``
+    : param workers: the number of worker processes. If it is 1, partitions 
+                     are processed in this process.
+    """
+    if workers <= 1 or len(partitions) <= 1:
+        return map(function, partitions)
+    if None != ProcessPoolExecutor:
+        with ProcessPoolExecutor(workers) as executor:
+            return list(executor.map(function, partitions))
+    pool = multiprocessing.Pool(workers)
+    try:
+        return pool.map(function, partitions)
+    finally:
+        pool.close()
+        pool.join()
+
+class QueryCache(object):
+    """A least recently used cache of candidate convthreads of searches. 
+    Searches from the same geohash cell with radii of the same bucket share 
+    their candidates, which are filtered by true distance for each search. 
+    """
+
+    def __init__(self, size=1024, precision=7):
+        """
+        : param size: the maximum number of entries
+        : param precision: a geohash precision of cells that share entries
+        """
+        self.size = size
+        self.precision = precision
+
+        #: The number of lookups that found or missed an entry
+        self.hits = 0
+        self.misses = 0
+
+        #: The version of :class:`~Database` that entries are derived from
+        self.version = None
+
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Returns an entry of ``key`` or ``None`` and marks it as the most 
+        recently used one.
+        """
+        value = self.entries.pop(key, None)
+        if None == value:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        """Adds an entry and evicts the least recently used ones if there are 
+        more than ``size`` entries.
+        """
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while self.size < len(self.entries):
+            self.entries.popitem(last=False)
+
+    def invalidate(self, version=None):
+        """Removes all entries. 
+
+        : param version: the version of :class:`~Database` that new entries 
+                         are derived from.
+        """
+        self.entries.clear()
+        self.version = version
+
+class PopularityBounds(object):
+    """Upper bounds of popularity of messages of convthreads in cells of 
+    spatial indexers. A bound of a cell is computed on its first use and 
+    kept until convthreads or their messages change.
+    """
+
+    def __init__(self, max_popularities, version=None):
+        """
+        : param max_popularities: the maximum popularity of messages of each
+                                  convthread by ``uid``
+        : param version: the version of :class:`~Database` that 
+                         ``max_popularities`` are derived from
+        """
+        self.max_popularities = max_popularities
+        self.version = version
+
+        #: Bounds of each cell hash. Every indexer has all convthreads, thus 
+        #: cells of the same hash have the same convthreads in any of them.
+        self.cells = {}
+
+    def cell_bound(self, index, point_hash):
+        """Returns the maximum popularity of messages of convthreads in 
+        ``point_hash`` cell of ``index``.
+        """
+        bound = self.cells.get(point_hash)
+        if None == bound:
+            bound = 0.0
+            for columns in index.get_hash_columns(point_hash):
+                if 0 < len(columns['uids']):
+                    bound = max(bound, float(
+                        self.max_popularities[columns['uids']].max()))
+            self.cells[point_hash] = bound
+        return bound
+
 class Search(object):
     """Searches for nearby convthreads or conversation threads
     """
 
-    def __init__(self, data):
+    def __init__(self, data, spatial_indexers=None, tag_postings=None, 
+                 workers=1):
         """
         Initializes spatial indexers
 
         :param data: a data container. See :class `~Data` for more information. 
+        :param spatial_indexers: optional prebuilt spatial indexers such as 
+                                 the ones of a snapshot. 
+        :param tag_postings: optional prebuilt tag postings. It is required 
+                             if ``spatial_indexers`` is set.
+        :param workers: the number of processes to build spatial indexers
         """
 
-        #: A dictionary that contains the convthread indexers. 
+        #: The database that convthreads are indexed from. A search and its 
+        #: database are replaced together when the dataset is reloaded.
+        self.data = data
+
+        #: A dictionary that contains the convthread indexers for each radius 
+        #: size. All convthreads are indexed once for each radius size and 
+        #: identified by ``uid``, the position in ``data.convthreads()``. 
+        #: Convthreads added later get new ``uid``s.
         #: See :class: `~SpatialIndexer` for more information. 
-        self.spatial_indexers = self.create_spatial_indexers(data)
+        if None == spatial_indexers:
+            spatial_indexers = self.create_spatial_indexers(data, workers)
+        self.spatial_indexers = spatial_indexers
+
+        #: A dictionary that contains sorted ``uid`` arrays of convthreads 
+        #: for each ``tag_id``.
+        if None == tag_postings:
+            tag_postings = self.create_tag_postings(data)
+        self.tag_postings = tag_postings
+
+        #: An optional :class:`~QueryCache` of :meth:`convthreads_nearby_user`.
+        #: Searches are not cached if it is ``None``.
+        self.cache = None
+
+        #: A :class:`~Metrics` that observes stages of searches. It is 
+        #: disabled unless it is replaced.
+        self.metrics = NO_METRICS
 
-    def create_spatial_indexers(self, data):
+        #: :class:`~PopularityBounds` of :meth:`popular_messages_nearby`. It 
+        #: is created on first use and whenever convthreads or their messages
+        #: change.
+        self.popularity_bounds = None
+
+        #: An optional index of :data:`SPATIAL_INDEX_BACKENDS` other than the 
+        #: spatial indexers that serves radius and nearest searches. See 
+        #: :meth:`set_backend`.
+        self.backend = None
+
+        #: A dictionary that maps ``convthread_id`` to its indexed point. It 
+        #: is created from the spatial indexers on the first update.
+        self.convthread_points = None
+        #: ``uid`` of the next added convthread
+        self.next_uid = None
+
+    def create_spatial_indexers(self, data, workers=1):
         """Create spatial indexers for convthreads 
 
         :param data: a data container. See :class `~Data` for more information. 
+        :param workers: the number of processes that sort convthreads. Each 
+                        of them sorts a range of geohash codes.
         """
+        convthreads = data.convthreads()
+        convthread_ids = convthreads[:, 0]
+        latitudes = np.asarray(convthreads[:, 1], dtype=np.float64)
+        longitudes = np.asarray(convthreads[:, 2], dtype=np.float64)
+        codes = point_codes(latitudes, longitudes)
+
+        # Sorting and assembling columns are the most expensive parts of the 
+        # build. Points are partitioned by ranges of codes, thus columns 
+        # sorted by each worker are concatenated in the order of ranges.
+        partitions = [(latitudes[uids], longitudes[uids], uids, codes[uids])
+                      for uids in code_partitions(codes, workers)]
+        sorted_partitions = map_partitions(sort_partition, partitions, 
+                                           workers)
+        columns = {}
+        for name in CELL_COLUMNS:
+            if "refs" != name:
+                columns[name] = np.concatenate(
+                    [EMPTY_CELL_COLUMNS[name]] + 
+                    [partition[name] for partition in sorted_partitions])
+        columns['refs'] = convthread_ids[columns['uids']]
 
-        # Initialize indexers for each combination of radius size 
-        # and ``tag_id``s.
+        # Initialize indexers for each radius size. Tags are not indexed 
+        # separately but filtered by ``tag_postings`` at query time. Points 
+        # sorted by codes are grouped by cells of any precision, thus all 
+        # indexers share the same columns.
         spatial_indexers = {}
         for size in RADIUS_SIZES:
-            spatial_indexers[size] = SpatialIndex(size)
+            index = spatial_indexers[size] = SpatialIndex(size)
+            keys, offsets = cell_offsets(columns['codes'], index.precision)
+            index.set_columns(keys, offsets, columns)
+
+        return spatial_indexers
+
+    def create_tag_postings(self, data):
+        """Create postings that map ``tag_id`` to sorted ``uid`` array of 
+        convthreads tagged with it.
+
+        :param data: a data container. See :class `~Data` for more information. 
+        """
+
+        tag_postings = {}
         for tag_id in data.tag_ids():
-            spatial_indexers[tag_id] = {}
-            for size in RADIUS_SIZES:
-                spatial_indexers[tag_id][size] = SpatialIndex(size)
+            tag_postings[tag_id] = np.empty(0, dtype=np.int64)
 
-        # Add points for each indexer
-        for [convthread_id, lat, lng, title] in data.convthreads():
-            point = SpatialIndexPoint(lat, lng, ref=convthread_id)
+        taggings = data.taggings()
+        if 0 < len(taggings):
+            convthread_ids = pd.Index([convthread[0] 
+                                       for convthread in data.convthreads()])
+            uids = convthread_ids.get_indexer(taggings[:, 0])
+            tagged = 0 <= uids
+            uids = pd.Series(uids[tagged].astype(np.int64))
+            for tag_id, tag_uids in uids.groupby(taggings[tagged, 1]):
+                tag_postings[tag_id] = np.unique(tag_uids.values)
 
-            for size in RADIUS_SIZES:
-                spatial_indexers[size].add_point(point)
-                for tag_id in data.tag_ids(convthread_id):
-                    spatial_indexers[tag_id][size].add_point(point)
+        return tag_postings
 
-        return spatial_indexers
+    def set_backend(self, name):
+        """ Selects a backend of radius and nearest searches by its name of 
+        :data:`SPATIAL_INDEX_BACKENDS`. The geohash backend is the spatial 
+        indexers themselves, and the others are bulk-loaded from them.
+
+        : param name: a name of a backend, e.g. ``kdtree``
+        """
+        backend = SPATIAL_INDEX_BACKENDS.get(name)
+        if None == backend:
+            raise ValueError("Unknown spatial index backend : %s" % name)
+        if SpatialIndex is backend:
+            self.backend = None
+            return
+
+        index = self.spatial_indexers[min(RADIUS_SIZES)]
+        _, _, columns = index.get_columns()
+        self.backend = backend()
+        self.backend.add_points(columns['latitudes'], columns['longitudes'], 
+                                columns['refs'], columns['uids'])
+
+    def get_indexes(self):
+        """Returns the spatial indexers and :attr:`backend`, which have the 
+        same points.
+        """
+        indexes = list(self.spatial_indexers.values())
+        if None != self.backend:
+            indexes.append(self.backend)
+        return indexes
+
+    def get_convthread_points(self):
+        """Returns :attr:`convthread_points`. 
+        """
+        if None == self.convthread_points:
+            index = self.spatial_indexers[min(RADIUS_SIZES)]
+            _, _, columns = index.get_columns()
+            self.convthread_points = dict(
+                (point.ref, point) for point in column_points(columns))
+            uids = columns['uids']
+            self.next_uid = int(uids.max()) + 1 if 0 < len(uids) else 0
+        return self.convthread_points
+
+    def upsert_convthread(self, convthread_id, lat, lng, tag_ids=None):
+        """ Adds a convthread or updates its location and tags in every 
+        spatial indexer and tag posting. Only the cells and postings the 
+        convthread is in are changed.
+
+        : param convthread_id: a convthread id
+        : param lat: latitude of the convthread
+        : param lng: longitude of the convthread
+        : param tag_ids: if set, ``tag_ids`` of the convthread. Otherwise 
+                         the current tags are kept.
+        """
+        convthread_points = self.get_convthread_points()
+        point = convthread_points.get(convthread_id)
+        if point is None:
+            point = SpatialIndexPoint(lat, lng, ref=convthread_id, 
+                                      uid=self.next_uid)
+            self.next_uid += 1
+            for index in self.get_indexes():
+                index.add_point(point)
+        elif point.latitude != lat or point.longitude != lng:
+            moved_point = SpatialIndexPoint(lat, lng, ref=convthread_id, 
+                                            uid=point.uid)
+            for index in self.get_indexes():
+                index.remove_point(point)
+                index.add_point(moved_point)
+            point = moved_point
+        convthread_points[convthread_id] = point
+
+        if None != tag_ids:
+            self.update_tag_postings(point.uid, tag_ids)
+        self.popularity_bounds = None
+        if None != self.cache:
+            self.cache.invalidate()
+
+    def delete_convthread(self, convthread_id):
+        """ Removes a convthread from every spatial indexer and tag posting. 
+        Returns ``True`` if it is removed.
 
-    def convthreads_nearby_user(self, user_location, radius, tags=None):
+        : param convthread_id: a convthread id
+        """
+        point = self.get_convthread_points().pop(convthread_id, None)
+        if point is None:
+            return False
+
+        for index in self.get_indexes():
+            index.remove_point(point)
+        self.update_tag_postings(point.uid, ())
+        self.popularity_bounds = None
+        if None != self.cache:
+            self.cache.invalidate()
+        return True
+
+    def update_tag_postings(self, uid, tag_ids):
+        """ Makes ``uid`` be in the postings of ``tag_ids`` only. Postings are
+        replaced rather than modified, as they may be memory-mapped.
+        """
+        tag_ids = set(tag_ids)
+        for tag_id in tag_ids:
+            self.tag_postings.setdefault(tag_id, np.empty(0, dtype=np.int64))
+
+        for tag_id, uids in self.tag_postings.items():
+            position = np.searchsorted(uids, uid)
+            tagged = position < len(uids) and uid == uids[position]
+            if tag_id in tag_ids and not tagged:
+                self.tag_postings[tag_id] = np.insert(uids, position, uid)
+            elif tag_id not in tag_ids and tagged:
+                self.tag_postings[tag_id] = np.delete(uids, position)
+
+    def convthreads_nearby_user(self, user_location, radius, tags=None, 
+                                cell_caches=None):
         """ Finds all convthreads nearby user for given a user location 
-        as center point and a radius. 
+        as center point and a radius. Returns convthread ids in the order of 
+        cells that cover the search area, and each of them once.
 
         : param user_location: two-dimensional tuple (latidute, longitude). 
                                e.g. (59.33, 18.06) Stockholm!
         : param radius: the radius for search area. 
         : param tags: if set, this method will return convthreads have at least 
                       one of given tags. 
+        : param cell_caches: an optional dictionary to share cells of spatial 
+                             indexers between searches. See 
+                             :meth:`SpatialIndex.get_near_columns`.
         """
 
-        # currently only 500 and 2000 radius sizes are supported for searching
+        # every indexer covers any radius with cells of a suitable precision,
+        # but the finer indexer gathers fewer points for a small radius.
         radius_size = 500 if radius < 500 else 2000 
 
+        metrics = self.metrics
         user_point = SpatialIndexPoint(user_location[0], user_location[1])
-        convthread_ids = []
+        if None != self.cache:
+            with metrics.stage("candidates"):
+                columns = self.cached_candidates(user_point, radius, tags)
+            with metrics.stage("distance"):
+                positions = np.flatnonzero(box_mask(user_point, radius, 
+                                                    columns))
+                distances = distances_to(user_point, 
+                                         distance_columns(columns, positions))
+                convthread_ids = list(
+                    columns['refs'][positions[distances <= radius]])
+            metrics.observe_candidates("distance", len(columns['refs']), 
+                                       len(convthread_ids))
+            metrics.observe_candidates("exact", len(positions), 
+                                       len(convthread_ids))
+            return convthread_ids
+
+        cell_cache = None
+        if None != cell_caches:
+            cell_cache = cell_caches.setdefault(radius_size, {})
+
+        uids = None
+        if None != tags:
+            # a union of postings of all tags filters candidates of a single 
+            # scan, thus each convthread is examined once however many tags 
+            # it has.
+            with metrics.stage("tags"):
+                uids = self.tagged_uids(self.tag_ids(tags))
+
+        index = self.backend
+        if None == index:
+            index = self.spatial_indexers[radius_size]
+        return list(index.get_within_refs(user_point, radius, uids, 
+                                          cell_cache, metrics))
+
+    def convthreads_in_box(self, bounds, tags=None):
+        """ Finds all convthreads within a box such as the viewport of a map.
+        Returns convthread ids in the order of cells that cover the box. 
+
+        : param bounds: a tuple of ``(south, west, north, east)``. ``west`` 
+                        greater than ``east`` is a box across the 
+                        antimeridian.
+        : param tags: if set, this method will return convthreads have at 
+                      least one of given tags. 
+        """
+        # cells of the box are gathered from the indexer of the nearest 
+        # precision, which has the fewest cells to gather for each of them
+        precision = box_precision(bounds)
+        indexers = sorted(self.spatial_indexers.values(), 
+                          key=lambda index: index.precision)
+        index = indexers[-1]
+        for candidate in indexers:
+            if precision <= candidate.precision:
+                index = candidate
+                break
+
+        uids = None
+        if None != tags:
+            with self.metrics.stage("tags"):
+                uids = self.tagged_uids(self.tag_ids(tags))
+        return list(index.get_box_refs(bounds, uids, metrics=self.metrics))
 
-        if None == tags:
+    def convthreads_nearest_user(self, user_location, k, tags=None):
+        """ Finds ``k`` convthreads nearest to user for given a user location 
+        as center point, however far they are. Returns convthread ids in 
+        ascending order of distance.
+
+        : param user_location: two-dimensional tuple (latidute, longitude). 
+        : param k: the number of convthreads to find. 
+        : param tags: if set, only convthreads that have at least one of given 
+                      tags are considered. 
+        """
+
+        user_point = SpatialIndexPoint(user_location[0], user_location[1])
+        uids = None
+        if None != tags:
+            with self.metrics.stage("tags"):
+                uids = self.tagged_uids(self.tag_ids(tags))
+
+        # the finest indexer gathers the fewest points for the small radii 
+        # the search starts with.
+        index = self.backend
+        if None == index:
+            index = self.spatial_indexers[min(RADIUS_SIZES)]
+        refs, _ = index.get_k_nearest_arrays(user_point, k, uids, 
+                                             self.metrics)
+        return list(refs)
+
+    def cached_candidates(self, user_point, radius, tags=None):
+        """ Returns columns of candidate convthreads of a search from 
+        :attr:`cache`. Candidates are all convthreads within a radius of the 
+        radius bucket plus the size of the cell of ``user_point``, thus they 
+        contain all convthreads within ``radius`` of ``user_point``. 
+        See :meth:`convthreads_nearby_user` for parameters.
+        """
+
+        cache = self.cache
+        version = self.data.version
+        if version != cache.version:
+            cache.invalidate(version)
+
+        # radii are bucketed by the next power of two.
+        radius_bucket = 2 ** int(math.ceil(math.log(radius, 2)))
+        point_hash = geohash.encode(user_point.latitude, user_point.longitude,
+                                    cache.precision)
+        tag_ids = None if None == tags else tuple(self.tag_ids(tags))
+        key = (point_hash, radius_bucket, tag_ids)
+
+        columns = cache.get(key)
+        if None == columns:
+            # the farthest point of a cell from its center is one of the 
+            # corners closer to the equator.
+            bbox = geohash.bbox(point_hash)
+            center = SpatialIndexPoint((bbox['n'] + bbox['s']) / 2, 
+                                       (bbox['e'] + bbox['w']) / 2)
+            corner_lat = bbox['s'] if 0 <= center.latitude else bbox['n']
+            half_diagonal = center.distance_to(
+                SpatialIndexPoint(corner_lat, bbox['e']))
+            candidate_radius = radius_bucket + half_diagonal
+
+            radius_size = 500 if candidate_radius < 500 else 2000
             index = self.spatial_indexers[radius_size]
-            points = index.get_nearest_points(user_point, radius)
-            for point, _ in points:
-                convthread_ids.append(point.ref)
-        else :
-            for tag in tags:
-                tag_id = current_app.data.tag_id(tag)
-                convthread_ids_by_tag = []
-                if None != tag_id:
-                    index = self.spatial_indexers[tag_id][radius_size]
-                    points = index.get_nearest_points(user_point, radius)
-                    for point, _ in points:
-                        convthread_ids_by_tag.append(point.ref)
-                # recursively constructs union set of convthread_id 
-                convthread_ids = set(convthread_ids_by_tag) | set(convthread_ids)
-
-        return convthread_ids
-
-    def popular_messages(self, convthread_ids, count=10, min_quantity=1):
+            columns = gather_columns(index.get_near_columns(center, 
+                                                            candidate_radius))
+            within = circle_mask(center, candidate_radius, columns)
+            if None != tag_ids:
+                uids = self.tagged_uids(tag_ids)
+                within &= in_sorted(columns['uids'], uids)
+            columns = select_columns(columns, within)
+            cache.put(key, columns)
+
+        return columns
+
+    def tag_ids(self, tags):
+        """ Returns sorted unique ``tag_ids`` of known ``tags``.
+        """
+        tag_ids = set()
+        for tag in tags:
+            tag_id = self.data.tag_id(tag)
+            if None != tag_id:
+                tag_ids.add(tag_id)
+        return sorted(tag_ids)
+
+    def tagged_uids(self, tag_ids):
+        """ Returns a sorted ``uid`` array of convthreads that have at least 
+        one of ``tag_ids``.
+        """
+        tag_postings = []
+        for tag_id in tag_ids:
+            uids = self.tag_postings.get(tag_id)
+            if uids is not None and 0 < len(uids):
+                tag_postings.append(uids)
+        if 0 == len(tag_postings):
+            return np.empty(0, dtype=np.int64)
+        if 1 == len(tag_postings):
+            return tag_postings[0]
+
+        # a mask of ``uid``s unions postings without sorting them, so that 
+        # it costs little more for many tags than for one.
+        tagged = np.zeros(max(uids[-1] for uids in tag_postings) + 1, 
+                          dtype=bool)
+        for uids in tag_postings:
+            tagged[uids] = True
+        return np.flatnonzero(tagged)
+
+    def batch_nearby(self, queries, encoded=False):
+        """ Finds popular messages for each of many queries. Queries are 
+        evaluated together, so that queries sharing geohash cells share 
+        their candidate points. Yields popular messages of each query in 
+        order.
+
+        : param queries: an iterable of tuples ``(user_location, radius, 
+                         tags, count)``. See :meth:`convthreads_nearby_user` 
+                         and :meth:`popular_messages` for each parameter.
+        : param encoded: if set, messages are returned as JSON. See 
+                         :meth:`popular_messages`.
+        """
+        cell_caches = {}
+        for user_location, radius, tags, count in queries:
+            convthread_ids = self.convthreads_nearby_user(
+                user_location, radius, tags, cell_caches)
+            yield self.popular_messages(convthread_ids, count, 
+                                        encoded=encoded)
+
+    def get_popularity_bounds(self):
+        """Returns :attr:`popularity_bounds` of the current version of 
+        :class:`~Database`.
+        """
+        data = self.data
+        bounds = self.popularity_bounds
+        if None == bounds or bounds.version != data.version:
+            index = self.spatial_indexers[min(RADIUS_SIZES)]
+            _, _, columns = index.get_columns()
+            uids = columns['uids']
+            max_popularities = np.zeros(
+                int(uids.max()) + 1 if 0 < len(uids) else 0)
+            max_popularities[uids] = data.max_popularities(columns['refs'])
+            bounds = PopularityBounds(max_popularities, data.version)
+            self.popularity_bounds = bounds
+        return bounds
+
+    def popular_messages_nearby(self, user_location, radius, count=10, 
+                                tags=None, encoded=False):
+        """ Finds popular messages of convthreads nearby user without 
+        finding all of them. Cells that cover the search area are visited in
+        descending order of the popularity bound of their convthreads, and 
+        the search stops once no remaining cell can beat the ``count``-th 
+        popular convthread found. 
+
+        Returns the same messages as :meth:`popular_messages` of 
+        :meth:`convthreads_nearby_user`, and ties are broken by the order of 
+        convthreads that it returns.
+
+        : param user_location: two-dimensional tuple (latidute, longitude). 
+        : param radius: the radius for search area. 
+        : param count: the number of popular message to return 
+        : param tags: if set, only convthreads that have at least one of given 
+                      tags are considered. 
+        : param encoded: if set, messages are returned as JSON. See 
+                         :meth:`popular_messages`.
+        """
+        if None != self.cache or None != self.backend:
+            # cached candidates are filtered by distance only, and backends 
+            # have no cells to bound popularity of
+            return self.popular_messages(self.convthreads_nearby_user(
+                user_location, radius, tags), count, encoded=encoded)
+        if count <= 0:
+            return []
+
+        metrics = self.metrics
+        user_point = SpatialIndexPoint(user_location[0], user_location[1])
+        uids = None
+        if None != tags:
+            with metrics.stage("tags"):
+                uids = self.tagged_uids(self.tag_ids(tags))
+
+        radius_size = 500 if radius < 500 else 2000
+        index = self.spatial_indexers[radius_size]
+        with metrics.stage("candidates"):
+            bounds = self.get_popularity_bounds()
+            cells = index.get_covering_cells(user_point, radius)
+            visits = sorted((-bounds.cell_bound(index, point_hash), order)
+                            for order, (point_hash, _) in enumerate(cells))
+
+        # Each convthread has a message of its maximum popularity, thus the 
+        # ``count``-th largest maximum popularity of convthreads found is a 
+        # lower bound of the popularity of the ``count``-th message. 
+        # Convthreads below it are never popular enough.
+        threshold = 0.0
+        top = np.empty(0)
+        found = []
+        examined = 0
+        accepted = 0
+        with metrics.stage("distance"):
+            for negative_bound, order in visits:
+                # ties of the threshold may win by order, thus cells of the 
+                # same bound are visited.
+                if -negative_bound <= 0.0 or -negative_bound < threshold:
+                    break
+                point_hash, inner = cells[order]
+                columns = gather_columns(index.get_hash_columns(point_hash))
+                if uids is not None:
+                    columns = select_columns(columns, 
+                                             in_sorted(columns['uids'], uids))
+                popularities = bounds.max_popularities[columns['uids']]
+                positions = np.flatnonzero((0.0 < popularities) & 
+                                           (threshold <= popularities))
+                examined += len(positions)
+                if not inner:
+                    positions = positions[circle_mask(
+                        user_point, radius, 
+                        distance_columns(columns, positions))]
+                accepted += len(positions)
+                found.append((order, columns['refs'][positions], 
+                              popularities[positions]))
+
+                top = np.concatenate((top, popularities[positions]))
+                if count < len(top):
+                    top = np.partition(top, len(top) - count)[-count:]
+                if count == len(top):
+                    threshold = top.min()
+        metrics.observe_candidates("distance", examined, accepted)
+        metrics.observe_candidates("cells", len(cells), len(found))
+
+        convthread_ids = []
+        for order, refs, popularities in sorted(found):
+            convthread_ids.extend(refs[threshold <= popularities])
+        return self.popular_messages(convthread_ids, count, encoded=encoded)
+
+    def cluster_precision(self, precision):
+        """Limits ``precision`` of :meth:`clusters` to the cells of the 
+        finest spatial indexer, which clusters are summed from.
+        """
+        index = self.spatial_indexers[min(RADIUS_SIZES)]
+        return max(1, min(precision, index.precision))
+
+    def clusters(self, precision, bounds=None):
+        """ Aggregates convthreads in geohash cells at ``precision`` for
+        overviews of maps. Returns a list of dictionaries of each cell with
+        convthreads in the order of hashes: its ``hash``, the ``count`` of
+        convthreads, their centroid ``lat`` and ``lng``, and the maximum
+        ``popularity`` of their messages.
+
+        Cells are summed from totals kept in cells of the finest spatial
+        indexer, thus it costs O(cells) however many convthreads they have.
+
+        : param precision: a geohash precision of cells. It is limited by
+                           :meth:`cluster_precision`.
+        : param bounds: an optional tuple ``(south, west, north, east)``.
+                        If set, only cells whose centroids are within it
+                        are returned. ``west`` greater than ``east`` wraps
+                        around the antimeridian.
+        """
+        index = self.spatial_indexers[min(RADIUS_SIZES)]
+        precision = self.cluster_precision(precision)
+        with self.metrics.stage("clusters"):
+            hashes, starts, counts, latitude_sums, longitude_sums = (
+                index.get_cell_totals(precision))
+            popularity_bounds = self.get_popularity_bounds()
+            popularities = np.array([
+                popularity_bounds.cell_bound(index, point_hash)
+                for point_hash in index.sorted_hashes])
+            if 0 < len(starts):
+                popularities = np.maximum.reduceat(popularities, starts)
+            latitudes = latitude_sums / np.maximum(counts, 1)
+            longitudes = longitude_sums / np.maximum(counts, 1)
+
+            positions = np.arange(len(hashes))
+            if None != bounds:
+                positions = np.flatnonzero(bounds_mask(bounds, latitudes, 
+                                                       longitudes))
+        self.metrics.observe_candidates("clusters", len(hashes),
+                                        len(positions))
+
+        return [{
+            'hash': hashes[i],
+            'count': int(counts[i]),
+            'lat': float(latitudes[i]),
+            'lng': float(longitudes[i]),
+            'popularity': popularity_value(popularities[i]),
+        } for i in positions]
+
+    def popular_messages(self, convthread_ids, count=10, min_quantity=1,
+                         encoded=False):
         """ Finds popular messages of selected convthreads in descending order
 
         : param convthread_ids: convthreads ids 
         : param count: the number of popular message to return 
         : param min_quantity: a threshold for the minimum quantity of message 
                               candidates. 1 by default. 
+        : param encoded: if set, each message is returned as its JSON, which
+                         is assembled from fragments encoded at load time. 
+                         See :meth:`Messages.fragment`.
         """
 
-        convthreads_messages = []
-
-        # fetch popular messages for each convthread. they are sorted in ascending 
-        # order. 
-        for convthread_id in convthread_ids:
-            messages = current_app.data.popular_messages(convthread_id)
-            if messages != []:
-                convthreads_messages.append(messages)
-
-        # find the best messages in descending order. since all 
-        # ``convthread_messages`` are already sorted in ascending order, it simply 
-        # compares the last element as a possible candidates.
-        popular_messages = []
-        popular_threshold = 1.0
-        while (len(popular_messages) < count) :
-            target_convthread_messages = None
-            max_popularity = 0.0
-
-            for convthread_messages in convthreads_messages:
-                if 0 < len(convthread_messages):
-                    convthread_message = convthread_messages[-1]
-                    popularity = convthread_message["popularity"]
-
-                    if max_popularity < popularity:
-                        target_convthread_messages = convthread_messages
-                        max_popularity = popularity
-                        if popular_threshold <= popularity :
-                            break
-
-            if target_convthread_messages == None:
-                popular_threshold = max_popularity
-                break
+        with self.metrics.stage("popularity"):
+            # fetch popular messages for each convthread. they are sorted in 
+            # ascending order, so the cursor of each convthread starts from 
+            # the last message. The merge reads popularity columns only, and 
+            # message records are created for the popular messages returned.
+            heap = []
+            convthread_ids = list(convthread_ids)
+            for order, messages in enumerate(
+                    self.data.popular_messages_of(convthread_ids)):
+                if 0 < len(messages):
+                    position = len(messages) - 1
+                    heap.append((-messages.popularities.item(position), order,
+                                 position, messages))
+            heapq.heapify(heap)
+
+            # find the best messages in descending order with k-way merge. 
+            # ties are broken by the order of ``convthread_ids``.
+            popular_messages = []
+            while 0 < len(heap) and len(popular_messages) < count:
+                negative_popularity, order, position, messages = heap[0]
+                # messages without any popularity are not considered popular
+                if 0.0 <= negative_popularity:
+                    break
+                if encoded:
+                    popular_messages.append(messages.fragment(position))
+                else:
+                    popular_messages.append(messages[position])
 
-            popular_message = target_convthread_messages.pop()
-            popular_messages.append(popular_message)
+                if 0 < position:
+                    position -= 1
+                    heapq.heapreplace(heap, (
+                        -messages.popularities.item(position), order, 
+                        position, messages))
+                else:
+                    heapq.heappop(heap)
 
+        self.metrics.observe_candidates("popularity", len(convthread_ids), 
+                                        len(popular_messages))
         return popular_messages
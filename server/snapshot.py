@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+"""
+    snapshot
+    ~~~~~~~~
+
+    A versioned on-disk snapshot of the preprocessed database and spatial
+    indexes.
+
+    Every table, refined convthread messages and spatial index is stored as
+    flat column arrays plus offset tables in ``.npy`` files. They are opened
+    with ``numpy.memmap`` so that loading a snapshot costs almost nothing
+    and all worker processes share a single page cache copy.
+
+    A snapshot is built from the command line :
+
+        $ python -m server.snapshot ./data/ ./snapshot/
+
+"""
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+import argparse
+import subprocess
+from collections import MutableMapping
+from itertools import chain
+
+import numpy as np
+import pandas as pd
+
+from server.data import Database, DATAFILES
+from server.ingest import CHUNK_SIZE, find_datafile
+from server.messages import MessageStore, StringColumn, encode_string
+from server.search import Search
+from server.spatialindex import SpatialIndex, CELL_COLUMNS, EMPTY_CELL_COLUMNS
+from server.spatialindex import cell_offsets
+
+#: A version of snapshot format. Snapshots of other versions are rejected.
+SNAPSHOT_VERSION = 6
+
+#: A file that describes contents of a snapshot
+MANIFEST = "manifest.json"
+
+class SnapshotError(Exception):
+    """A snapshot is missing, broken or out of date.
+    """
+
+def fingerprint(datapath):
+    """Returns a fingerprint of datafiles in ``datapath``. It changes
+    whenever any datafile is replaced or modified.
+
+    : param datapath: a directory that contains datafiles
+    """
+    digest = hashlib.md5()
+    for key in sorted(DATAFILES):
+        filename = find_datafile(datapath, key)
+        stat = os.stat(filename)
+        digest.update("%s:%d:%d;" % (os.path.basename(filename), 
+                                      stat.st_size, int(stat.st_mtime)))
+    return digest.hexdigest()
+
+class SnapshotWriter(object):
+    """Writes arrays of a snapshot into a directory.
+    """
+
+    def __init__(self, path):
+        #: A directory to write arrays
+        self.path = path
+
+    def add_array(self, name, array):
+        np.save(os.path.join(self.path, name + '.npy'), np.asarray(array))
+
+    def add_strings(self, name, values):
+        """Stores strings as a pool of bytes and offsets of each string.
+        See :class:`~StringColumn`.
+        """
+        self.add_string_column(name, StringColumn.from_strings(values))
+
+    def add_string_column(self, name, column):
+        self.add_array(name + '.pool', column.pool)
+        self.add_array(name + '.offsets', column.offsets)
+
+class SnapshotReader(object):
+    """Opens arrays of a snapshot with ``numpy.memmap``.
+    """
+
+    def __init__(self, path):
+        #: A directory to read arrays
+        self.path = path
+
+    def array(self, name):
+        return np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+
+    def strings(self, name):
+        # slicing plain arrays is much cheaper than slicing memory maps
+        return StringColumn(self.array(name + '.pool').view(np.ndarray),
+                            self.array(name + '.offsets').view(np.ndarray))
+
+class SnapshotTables(MutableMapping):
+    """A replacement of ``Database.dfs`` backed by a snapshot. Tables are
+    materialized on first access. Updates are kept in memory and the
+    snapshot itself is never modified.
+    """
+
+    def __init__(self, reader, manifest):
+        self.reader = reader
+        #: Names and kinds of columns of each table
+        self.tables = manifest["tables"]
+        #: Materialized or updated tables
+        self.cache = {}
+        #: Tables deleted after loading
+        self.deleted = set()
+
+    def table(self, name):
+        columns = {}
+        names = []
+        for column, kind in self.tables[name]:
+            names.append(column)
+            if "strings" == kind:
+                columns[column] = self.reader.strings(
+                    "tables.%s.%s" % (name, column)).tolist()
+            else:
+                columns[column] = np.array(
+                    self.reader.array("tables.%s.%s" % (name, column)))
+        return pd.DataFrame(columns, columns=names)
+
+    def __getitem__(self, key):
+        if key in self.deleted:
+            raise KeyError(key)
+        if key not in self.cache:
+            if key not in self.tables:
+                raise KeyError(key)
+            self.cache[key] = self.table(key)
+        return self.cache[key]
+
+    def __setitem__(self, key, value):
+        self.deleted.discard(key)
+        self.cache[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.cache.pop(key, None)
+        self.deleted.add(key)
+
+    def __contains__(self, key):
+        if key in self.deleted:
+            return False
+        return key in self.cache or key in self.tables
+
+    def __iter__(self):
+        added = [key for key in self.cache if key not in self.tables]
+        return (key for key in chain(self.tables, added)
+                if key not in self.deleted)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+def write_database(writer, data):
+    tables = {}
+    for name, df in data.dfs.items():
+        if not isinstance(df, pd.DataFrame):
+            continue
+        tables[name] = []
+        for column in df.columns:
+            values = df[column].values
+            if values.dtype.kind in 'biufc':
+                kind = "array"
+                writer.add_array("tables.%s.%s" % (name, column), values)
+            else:
+                kind = "strings"
+                writer.add_strings("tables.%s.%s" % (name, column), values)
+            tables[name].append([column, kind])
+
+    return tables
+
+def write_message_store(writer, store):
+    store = store.compact()
+    writer.add_array("convthreads.ids", [encode_string(convthread_id) 
+                     for convthread_id in store.convthread_ids.tolist()])
+    writer.add_array("convthreads.lats", store.latitudes)
+    writer.add_array("convthreads.lngs", store.longitudes)
+    writer.add_string_column("convthreads.titles", store.titles)
+    writer.add_array("messages.offsets", store.offsets)
+    writer.add_string_column("messages.ids", store.message_ids)
+    writer.add_string_column("messages.titles", store.message_titles)
+    writer.add_array("messages.popularities", store.popularities)
+    writer.add_string_column("messages.fragments", store.fragments)
+    writer.add_string_column("convthreads.fragments", 
+                             store.convthread_fragments)
+
+def write_spatial_indexers(writer, spatial_indexers):
+    # all indexers hold the same points, so columns are written once and
+    # each indexer keeps only its cells over them
+    columns = dict((name, EMPTY_CELL_COLUMNS[name]) for name in CELL_COLUMNS)
+    if spatial_indexers:
+        _, _, columns = spatial_indexers[min(spatial_indexers)].get_columns()
+
+    indexes = []
+    index_offsets = [0]
+    keys = []
+    offsets = []
+    for size in sorted(spatial_indexers):
+        index = spatial_indexers[size]
+        indexes.append({"size": size, "precision": index.precision})
+        index_keys, index_offsets_ = cell_offsets(columns['codes'],
+                                                  index.precision)
+        keys.extend(index_keys)
+        index_offsets.append(len(keys))
+        offsets.append(index_offsets_)
+
+    writer.add_array("indexes.offsets", np.array(index_offsets,
+                                                 dtype=np.int64))
+    writer.add_array("cells.keys", np.array(keys, dtype=str))
+    writer.add_array("cells.offsets", np.concatenate(
+        [np.empty(0, dtype=np.int64)] + offsets))
+    for name in CELL_COLUMNS:
+        column = columns[name]
+        if "refs" == name:
+            column = [encode_string(ref) for ref in column]
+        writer.add_array("points.%s" % name, column)
+
+    return indexes
+
+def write_tag_postings(writer, tag_postings):
+    tag_ids = sorted(tag_postings)
+    offsets = np.zeros(len(tag_ids) + 1, dtype=np.int64)
+    np.cumsum([len(tag_postings[tag_id]) for tag_id in tag_ids],
+              out=offsets[1:])
+    writer.add_strings("postings.tag_ids", tag_ids)
+    writer.add_array("postings.offsets", offsets)
+    writer.add_array("postings.uids", np.concatenate(
+        [np.empty(0, dtype=np.int64)] +
+        [tag_postings[tag_id] for tag_id in tag_ids]))
+
+def build(path, data, search, datapath):
+    """Writes a snapshot of ``data`` and ``search`` into ``path``. An
+    existing snapshot in ``path`` is replaced at once.
+
+    : param path: a directory of the snapshot
+    : param data: a database. See :class:`~Database` for more information.
+    : param search: a search. See :class:`~Search` for more information.
+    : param datapath: a directory of datafiles ``data`` is created from
+    """
+    path = os.path.abspath(path)
+    workpath = tempfile.mkdtemp(prefix=".snapshot-",
+                                dir=os.path.dirname(path))
+    try:
+        writer = SnapshotWriter(workpath)
+        manifest = {
+            "version": SNAPSHOT_VERSION,
+            "fingerprint": fingerprint(datapath),
+            "tables": write_database(writer, data),
+            "indexes": write_spatial_indexers(writer,
+                                              search.spatial_indexers),
+        }
+        write_message_store(writer, data.messages)
+        write_tag_postings(writer, search.tag_postings)
+        with open(os.path.join(workpath, MANIFEST), 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+
+        # Open memory maps of an old snapshot stay valid after it is removed.
+        if os.path.exists(path):
+            oldpath = tempfile.mkdtemp(prefix=".snapshot-",
+                                       dir=os.path.dirname(path))
+            os.rename(path, os.path.join(oldpath, "old"))
+            os.rename(workpath, path)
+            shutil.rmtree(oldpath)
+        else:
+            os.rename(workpath, path)
+    except:
+        shutil.rmtree(workpath, ignore_errors=True)
+        raise
+
+def build_in_process(path, datapath, chunksize=CHUNK_SIZE, workers=1, 
+                     niceness=0):
+    """Builds a snapshot like :func:`build` in a child process, so that 
+    preprocessing never holds the interpreter lock of this process.
+
+    : param path: a directory of the snapshot
+    : param datapath: a directory of datafiles
+    : param chunksize: the number of rows of datafiles to process at once
+    : param workers: the number of processes to build spatial indexers
+    : param niceness: an increment of the scheduling niceness of the child 
+                      process, so that it yields processors to this one
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    command = [sys.executable, "-m", "server.snapshot", 
+               os.path.abspath(datapath), os.path.abspath(path),
+               "--chunksize", str(chunksize), "--workers", str(workers)]
+    process = subprocess.Popen(command, cwd=root, stdout=subprocess.PIPE, 
+                               stderr=subprocess.STDOUT,
+                               preexec_fn=lambda: os.nice(niceness))
+    output, _ = process.communicate()
+    if 0 != process.returncode:
+        lines = output.strip().splitlines() or [""]
+        raise SnapshotError("Cannot build snapshot : %s" % lines[-1])
+
+def read_manifest(path):
+    try:
+        with open(os.path.join(path, MANIFEST)) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (IOError, ValueError) as e:
+        raise SnapshotError("Cannot read snapshot manifest : %s" % e)
+
+    if SNAPSHOT_VERSION != manifest.get("version"):
+        raise SnapshotError("Unsupported snapshot version : %s" %
+                            manifest.get("version"))
+    return manifest
+
+def load(path, datapath=None):
+    """Loads a database and a search from a snapshot. Returns a tuple of
+    :class:`~Database` and :class:`~Search`.
+
+    : param path: a directory of the snapshot
+    : param datapath: if set, the snapshot must be built from datafiles in
+                      ``datapath`` as they are now.
+    """
+    manifest = read_manifest(path)
+    if None != datapath and fingerprint(datapath) != manifest["fingerprint"]:
+        raise SnapshotError("Snapshot is out of date : %s" % path)
+
+    reader = SnapshotReader(path)
+    messages = MessageStore(
+        reader.array("convthreads.ids").view(np.ndarray),
+        reader.array("convthreads.lats").view(np.ndarray),
+        reader.array("convthreads.lngs").view(np.ndarray),
+        reader.strings("convthreads.titles"),
+        reader.array("messages.offsets").view(np.ndarray),
+        reader.strings("messages.ids"),
+        reader.strings("messages.titles"),
+        reader.array("messages.popularities").view(np.ndarray),
+        reader.strings("messages.fragments"),
+        reader.strings("convthreads.fragments"))
+    data = Database(datapath, tables=SnapshotTables(reader, manifest),
+                    messages=messages)
+
+    index_offsets = reader.array("indexes.offsets").tolist()
+    keys = reader.array("cells.keys").tolist()
+    offsets = reader.array("cells.offsets")
+    columns = dict((name, reader.array("points.%s" % name))
+                   for name in CELL_COLUMNS)
+
+    spatial_indexers = {}
+    for i, entry in enumerate(manifest["indexes"]):
+        index = SpatialIndex(entry["size"])
+        index.precision = entry["precision"]
+        # each indexer has one more offset than cells
+        start, stop = index_offsets[i], index_offsets[i + 1]
+        index.set_columns(keys[start:stop], offsets[start + i:stop + i + 1],
+                          columns)
+
+        spatial_indexers[entry["size"]] = index
+
+    tag_postings = {}
+    tag_ids = reader.strings("postings.tag_ids").tolist()
+    tag_offsets = reader.array("postings.offsets").tolist()
+    tag_uids = reader.array("postings.uids").view(np.ndarray)
+    for i, tag_id in enumerate(tag_ids):
+        tag_postings[tag_id] = tag_uids[tag_offsets[i]:tag_offsets[i + 1]]
+
+    search = Search(data, spatial_indexers=spatial_indexers,
+                    tag_postings=tag_postings)
+    return data, search
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Builds a snapshot of preprocessed datafiles.")
+    parser.add_argument("datapath", help="a directory of datafiles")
+    parser.add_argument("path", help="a directory to write the snapshot")
+    parser.add_argument("--chunksize", type=int, default=CHUNK_SIZE,
+                        help="the number of rows of datafiles to process "
+                             "at once")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="the number of processes to build spatial "
+                             "indexers")
+    args = parser.parse_args(argv)
+
+    data = Database(args.datapath, chunksize=args.chunksize)
+    build(args.path, data, Search(data, workers=args.workers), args.datapath)
+
+if __name__ == '__main__':
+    main()
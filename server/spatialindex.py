@@ -8,16 +8,107 @@
 """
 
 import math
+import bisect
 import geohash
+import numpy as np
 from itertools import chain
 from werkzeug.datastructures import ImmutableDict
+from server.metrics import NO_METRICS
 
 # Default grid size parameters
 # unit : meter
 GEO_HASH_GRID_SIZE = ImmutableDict({
+    1: 5000000,
+    2: 1250000,
+    3: 156000,
+    4: 39100,
     5: 4800,
     6: 1220,
     7: 152,
+    8: 38.2,
+    9: 4.77,
+    10: 1.19,
+    11: 0.149,
+    12: 0.0372,
+})
+
+# Precision of geohash codes of points. A code is the integer value of the 
+# geohash of a point at this precision, thus codes of points within a cell 
+# are a contiguous range.
+CODE_PRECISION = 12
+
+# Margins that keep the prefilters of exact distances conservative against 
+# rounding errors. Points are compared with the bounding box of a circle 
+# extended by ``BOX_MARGIN`` degrees, which also covers points at the center 
+# by rounding. See :func:`distances_to`. Cells are accepted without exact 
+# distances of points if they are within the circle shrunk by ``CELL_MARGIN``.
+# unit : degree, meter
+BOX_MARGIN = 1e-6
+CELL_MARGIN = 1e-3
+
+# Points whose locations are the same when rounded to 6 decimal places are 
+# closer than this, i.e. the diagonal of 1e-6 degrees.
+# unit : meter
+SAME_POINT_DISTANCE = 0.2
+
+# The maximum number of cells to cover a search area. Coarser cells are used
+# if more cells are required, e.g. near the poles. Boxes are covered by the 
+# finest cells that keep within it.
+MAX_COVERING_CELLS = 64
+
+# Characters of geohash in the order of their values
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+BASE32_VALUES = dict((char, value) for value, char in enumerate(BASE32))
+BASE32_CHARS = np.array(list(BASE32), dtype='S1')
+
+# Shifts and masks that spread 32 bits to the even bits of 64 bits, which 
+# interleaves bits of latitudes and longitudes into geohash codes
+INTERLEAVE_MASKS = (
+    (16, 0x0000FFFF0000FFFF),
+    (8, 0x00FF00FF00FF00FF),
+    (4, 0x0F0F0F0F0F0F0F0F),
+    (2, 0x3333333333333333),
+    (1, 0x5555555555555555),
+)
+
+# geohash rounds coordinates of smaller magnitudes in its own way
+IRREGULAR_MAGNITUDE = 1e-15
+
+# coefficient : 69.09 * 1.609344 * 1000 
+# 69.09 : coefficient to convert geo-coordinate to mile
+# 1.609344 : mile to km
+# 1000 : km to meter
+DISTANCE_COEFFICIENT = 111189.57696
+
+# A radius that covers the whole earth
+# unit : meter
+EARTH_HALF_CIRCUMFERENCE = 180 * DISTANCE_COEFFICIENT
+
+# A radius that the k-nearest neighbour search starts with and the factor it
+# is grown by until the search area contains k points
+# unit : meter
+NEAREST_INITIAL_RADIUS = 100
+NEAREST_RADIUS_GROWTH = 4
+
+#: Names of the columns that :func:`distances_to` reads
+DISTANCE_COLUMNS = ('latitudes', 'longitudes', 'rad_latitudes', 
+                    'rad_longitudes', 'cos_latitudes')
+
+#: Names of the columns that a spatial index cell keeps for its points
+CELL_COLUMNS = ('refs', 'uids', 'codes', 'latitudes', 'longitudes', 
+                'rad_latitudes', 'rad_longitudes', 'cos_latitudes')
+
+# Columns of an empty cell. Columns are never modified in place, thus they are
+# shared by all empty cells.
+EMPTY_CELL_COLUMNS = ImmutableDict({
+    'refs': np.empty(0, dtype=object),
+    'uids': np.empty(0, dtype=np.int64),
+    'codes': np.empty(0, dtype=np.int64),
+    'latitudes': np.empty(0),
+    'longitudes': np.empty(0),
+    'rad_latitudes': np.empty(0),
+    'rad_longitudes': np.empty(0),
+    'cos_latitudes': np.empty(0),
 })
 
 class SpatialIndexPoint(object):
@@ -25,9 +116,9 @@ class SpatialIndexPoint(object):
     """
     # optimization
     __slots__ = ('latitude', 'longitude', 'rad_latitude', 'rad_longitude', 
-                 'ref')
+                 'ref', 'uid')
 
-    def __init__(self, latitude, longitude, ref=None):
+    def __init__(self, latitude, longitude, ref=None, uid=-1):
         #: latitude of point
         self.latitude = latitude
         #: longitude of point
@@ -38,6 +129,8 @@ class SpatialIndexPoint(object):
         self.rad_longitude = math.radians(self.longitude)
         #: a reference to associated object
         self.ref = ref
+        #: an integer id of point that is used to filter points, e.g. by tags
+        self.uid = uid
 
     def __eq__(self, target_point):
         assert isinstance(target_point, SpatialIndexPoint), (
@@ -55,21 +148,572 @@ class SpatialIndexPoint(object):
         if self == target_point:
             return 0.0
 
-        # coefficient : 69.09 * 1.609344 * 1000 
-        # 69.09 : coefficient to convert geo-coordinate to mile
-        # 1.609344 : mile to km
-        # 1000 : km to meter
-        coefficient = 111189.57696 
         theta = self.longitude - target_point.longitude
 
         distance = math.degrees(math.acos(
             math.sin(self.rad_latitude) * math.sin(target_point.rad_latitude) +
             math.cos(self.rad_latitude) * math.cos(target_point.rad_latitude) *
             math.cos(math.radians(theta))
-        )) * coefficient
+        )) * DISTANCE_COEFFICIENT
 
         return distance
 
+class SpatialIndexCell(object):
+    """ A geohash cell that keeps its points as contiguous columns.
+
+    Points are staged on :meth:`append` and moved into the columns on the
+    next :meth:`compact`, so that building an index does not reallocate the
+    columns for every point. Columns are sorted by geohash codes of points, 
+    thus points of any smaller cell within the cell are a contiguous slice.
+    """
+    # optimization
+    __slots__ = CELL_COLUMNS + ('pending', 'summary')
+
+    def __init__(self, columns=None):
+        """
+        : param columns: an optional dictionary of initial columns. See 
+                         :data:`CELL_COLUMNS` for the column names.
+        """
+        if None == columns:
+            columns = EMPTY_CELL_COLUMNS
+        #: references to associated objects
+        self.refs = columns['refs']
+        #: integer ids of points
+        self.uids = columns['uids']
+        #: geohash codes of points. See :data:`CODE_PRECISION`.
+        self.codes = columns['codes']
+        #: latitudes of points
+        self.latitudes = columns['latitudes']
+        #: longitudes of points
+        self.longitudes = columns['longitudes']
+        #: latitudes of points in radian
+        self.rad_latitudes = columns['rad_latitudes']
+        #: longitudes of points in radian
+        self.rad_longitudes = columns['rad_longitudes']
+        #: cosine of latitudes, precomputed for the haversine formula
+        self.cos_latitudes = columns['cos_latitudes']
+        #: points which are not moved into the columns yet
+        self.pending = []
+        #: a cached result of :meth:`totals`
+        self.summary = None
+
+    def __len__(self):
+        return len(self.refs) + len(self.pending)
+
+    def append(self, point):
+        """Add spatial point to the cell
+
+        : param point: a spatial index point
+        """
+        self.pending.append(point)
+        self.summary = None
+
+    def compact(self):
+        """Moves pending points into the columns and returns the cell.
+        """
+        if not self.pending:
+            return self
+
+        points, self.pending = self.pending, []
+        latitudes = np.array([point.latitude for point in points],
+                             dtype=np.float64)
+        longitudes = np.array([point.longitude for point in points],
+                              dtype=np.float64)
+        return self.extend(point_columns(
+            latitudes, longitudes, object_array([point.ref for point in points]),
+            np.array([point.uid for point in points], dtype=np.int64),
+            point_codes(latitudes, longitudes)))
+
+    def extend(self, columns):
+        """Adds points of columns to the cell and returns the cell. Points 
+        of the same geohash code are kept in the order they are added.
+
+        : param columns: a dictionary of columns. See :data:`CELL_COLUMNS`.
+        """
+        self.compact()
+        columns = dict((name, np.concatenate((getattr(self, name), 
+                                              columns[name])))
+                       for name in CELL_COLUMNS)
+
+        order = np.argsort(columns['codes'], kind='mergesort')
+        for name in CELL_COLUMNS:
+            setattr(self, name, columns[name][order])
+        self.summary = None
+        return self
+
+    def remove(self, point):
+        """Removes a point from the cell. The point is found by its geohash 
+        code and identified by ``uid``, or by ``ref`` if it has no ``uid``. 
+        Returns ``True`` if the point is removed.
+
+        : param point: a spatial index point
+        """
+        self.compact()
+        code = point_code(point.latitude, point.longitude)
+        start = np.searchsorted(self.codes, code, 'left')
+        stop = np.searchsorted(self.codes, code, 'right')
+        for position in xrange(start, stop):
+            if ((0 <= point.uid and point.uid == self.uids[position]) or
+                    (0 > point.uid and point.ref == self.refs[position])):
+                break
+        else:
+            return False
+
+        # columns may be shared or memory-mapped, thus they are replaced
+        for name in CELL_COLUMNS:
+            setattr(self, name, np.delete(getattr(self, name), position))
+        self.summary = None
+        return True
+
+    def totals(self):
+        """Returns a tuple of the number of points and sums of their 
+        latitudes and longitudes. It is kept until points are changed.
+        """
+        if None == self.summary:
+            self.compact()
+            self.summary = (len(self.refs), float(self.latitudes.sum()), 
+                            float(self.longitudes.sum()))
+        return self.summary
+
+    def columns(self):
+        """Returns a dictionary of columns of the cell.
+        """
+        self.compact()
+        return dict((name, getattr(self, name)) for name in CELL_COLUMNS)
+
+    def points(self):
+        """Returns points of the cell as :class:`SpatialIndexPoint` objects.
+        """
+        return column_points(self.columns())
+
+def object_array(values):
+    """Creates an one-dimensional object array from ``values``. Unlike
+    ``np.array``, it never turns sequences such as tuples into extra 
+    dimensions.
+    """
+    array = np.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        array[i] = value
+    return array
+
+def column_points(columns, selection=None):
+    """Creates :class:`SpatialIndexPoint` objects from columns.
+
+    : param columns: a dictionary of columns
+    : param selection: optional positions of points to create
+    """
+    if selection is not None:
+        columns = select_columns(columns, selection)
+    return [SpatialIndexPoint(latitude, longitude, ref=ref, uid=uid)
+            for latitude, longitude, ref, uid in zip(
+                columns['latitudes'].tolist(), columns['longitudes'].tolist(),
+                columns['refs'], columns['uids'].tolist())]
+
+def gather_columns(columns_list):
+    """Concatenates a list of columns. Returns a dictionary of columns.
+
+    : param columns_list: a list of dictionaries of columns
+    """
+    if 1 == len(columns_list):
+        return columns_list[0]
+    return dict((name, np.concatenate([EMPTY_CELL_COLUMNS[name]] + 
+                                      [columns[name] 
+                                       for columns in columns_list]))
+                for name in CELL_COLUMNS)
+
+def select_columns(columns, selection):
+    """Selects points of columns by a mask or positions.
+
+    : param columns: a dictionary of columns
+    : param selection: a boolean mask or an array of positions
+    """
+    return dict((name, column[selection]) for name, column in columns.items())
+
+def in_sorted(values, sorted_values):
+    """Returns a boolean mask of ``values`` that are in ``sorted_values``.
+
+    : param values: an array of values to test
+    : param sorted_values: a sorted array
+    """
+    if 0 == len(sorted_values):
+        return np.zeros(len(values), dtype=bool)
+    positions = np.searchsorted(sorted_values, values)
+    np.minimum(positions, len(sorted_values) - 1, out=positions)
+    return sorted_values[positions] == values
+
+def point_code(latitude, longitude):
+    """Returns the geohash code of a point. See :data:`CODE_PRECISION`.
+    """
+    return geohash.encode_uint64(latitude, longitude) >> (
+        64 - 5 * CODE_PRECISION)
+
+def interleave_bits(values):
+    """Spreads the lower 32 bits of each value to the even bits of 64 bits.
+
+    : param values: an array of ``np.uint64``
+    """
+    values = values & np.uint64(0xFFFFFFFF)
+    for shift, mask in INTERLEAVE_MASKS:
+        values = (values | (values << np.uint64(shift))) & np.uint64(mask)
+    return values
+
+def quantize(values, extent):
+    """Maps coordinates in ``[-extent / 2, extent / 2)`` to 32 bits integers 
+    the way :func:`geohash.encode_uint64` does.
+    """
+    return (np.floor(values / extent * 4294967296.0).astype(np.int64) + 
+            (1 << 31)).astype(np.uint64)
+
+def point_codes(latitudes, longitudes):
+    """Returns geohash codes of points as an array. Bits of latitudes and 
+    longitudes are interleaved for all points at once. See 
+    :func:`point_code`.
+
+    : param latitudes: an array of latitudes
+    : param longitudes: an array of longitudes
+    """
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    codes = ((interleave_bits(quantize(longitudes, 360.0)) << np.uint64(1) | 
+              interleave_bits(quantize(latitudes, 180.0))) >> 
+             np.uint64(64 - 5 * CODE_PRECISION)).astype(np.int64)
+
+    # Coordinates out of range are wrapped or rejected, and ones very close 
+    # to zero are rounded differently by geohash. They are left to 
+    # :func:`point_code`, so that codes always agree with ``geohash``.
+    irregular = ~(np.isfinite(latitudes) & np.isfinite(longitudes) &
+                  (-90.0 <= latitudes) & (latitudes < 90.0) & 
+                  (-180.0 <= longitudes) & (longitudes < 180.0))
+    for values in (latitudes, longitudes):
+        magnitudes = np.abs(values)
+        irregular |= (0 < magnitudes) & (magnitudes < IRREGULAR_MAGNITUDE)
+    for i in np.flatnonzero(irregular).tolist():
+        codes[i] = point_code(latitudes[i], longitudes[i])
+    return codes
+
+def point_columns(latitudes, longitudes, refs, uids, codes):
+    """Creates a dictionary of columns of points. See :data:`CELL_COLUMNS`.
+    """
+    rad_latitudes = np.radians(latitudes)
+    return {
+        'refs': refs,
+        'uids': uids,
+        'codes': codes,
+        'latitudes': latitudes,
+        'longitudes': longitudes,
+        'rad_latitudes': rad_latitudes,
+        'rad_longitudes': np.radians(longitudes),
+        'cos_latitudes': np.cos(rad_latitudes),
+    }
+
+def cell_offsets(codes, precision):
+    """Groups points sorted by geohash codes into cells at ``precision``. 
+    Returns sorted hashes of the cells and offsets of each cell, which are 
+    accepted by :meth:`SpatialIndex.set_columns`.
+
+    : param codes: a sorted array of geohash codes of points
+    : param precision: a precision of cells
+    """
+    cell_codes = codes >> (5 * (CODE_PRECISION - precision))
+    starts = np.flatnonzero(cell_codes[1:] != cell_codes[:-1]) + 1
+    offsets = np.concatenate(([0], starts, [len(codes)])).astype(np.int64)
+    if 0 == len(codes):
+        offsets = offsets[:1]
+    return code_hashes(cell_codes[offsets[:-1]], precision), offsets
+
+def hash_to_code(point_hash):
+    """Returns the integer value of ``point_hash``.
+    """
+    code = 0
+    for char in point_hash:
+        code = (code << 5) | BASE32_VALUES[char]
+    return code
+
+def code_hashes(codes, precision):
+    """Returns a list of hashes of ``precision`` characters whose integer 
+    values are ``codes``. It is the inverse of :func:`hash_to_code`.
+    """
+    shifts = 5 * np.arange(precision - 1, -1, -1, dtype=np.int64)
+    digits = (np.asarray(codes, dtype=np.int64)[:, None] >> shifts) & 31
+    chars = BASE32_CHARS[digits].reshape(len(codes), precision)
+    return chars.view('S%d' % precision).ravel().tolist()
+
+def hash_code_range(point_hash):
+    """Returns the range of geohash codes of points within ``point_hash`` 
+    cell. See :data:`CODE_PRECISION`.
+    """
+    shift = 5 * (CODE_PRECISION - len(point_hash))
+    code = hash_to_code(point_hash)
+    return code << shift, (code + 1) << shift
+
+def covering_hashes(latitude, longitude, radius, precision):
+    """Returns hashes of all cells at ``precision`` that intersect with the 
+    bounding box of a circle.
+
+    : param latitude: latitude of a center of the circle
+    : param longitude: longitude of a center of the circle
+    : param radius: a radius of the circle
+    : param precision: a precision of cells
+    """
+    rows, columns = covering_grid(latitude, longitude, radius, precision)
+    return grid_hashes(rows, columns, precision)
+
+def grid_hashes(rows, columns, precision):
+    """Returns hashes of cells at ``precision`` of each of ``rows`` and 
+    ``columns``. See :func:`covering_grid`.
+    """
+    cell_height, cell_width = grid_cell_size(precision)
+    return [geohash.encode(-90.0 + (row + 0.5) * cell_height,
+                           -180.0 + (column + 0.5) * cell_width, precision)
+            for row in rows for column in columns]
+
+def grid_cell_size(precision):
+    """Returns height and width of cells at ``precision`` in degree.
+    """
+    latitude_bits = 5 * precision // 2
+    longitude_bits = 5 * precision - latitude_bits
+    return 180.0 / (1 << latitude_bits), 360.0 / (1 << longitude_bits)
+
+def covering_grid(latitude, longitude, radius, precision):
+    """Returns rows and columns of cells at ``precision`` that intersect with 
+    the bounding box of a circle. See :func:`covering_hashes`.
+    """
+    cell_height, cell_width = grid_cell_size(precision)
+    row_count = int(round(180.0 / cell_height))
+    column_count = int(round(360.0 / cell_width))
+
+    south, north, longitude_angle = bounding_box(latitude, longitude, radius)
+    rows = range(min(int((south + 90.0) / cell_height), row_count - 1),
+                 min(int((north + 90.0) / cell_height), row_count - 1) + 1)
+
+    if None == longitude_angle:
+        return rows, range(column_count)
+    west = int(math.floor((longitude - longitude_angle + 180.0) / cell_width))
+    east = int(math.floor((longitude + longitude_angle + 180.0) / cell_width))
+    if column_count <= east - west + 1:
+        return rows, range(column_count)
+    return rows, [column % column_count for column in range(west, east + 1)]
+
+def bounding_box(latitude, longitude, radius):
+    """Returns the bounding box of a circle in degree space as a tuple of 
+    the south, the north and the longitude angle from the center. The 
+    longitude angle is ``None`` if the circle covers all longitudes.
+
+    : param latitude: latitude of a center of the circle
+    : param longitude: longitude of a center of the circle
+    : param radius: a radius of the circle
+    """
+    angle = radius / DISTANCE_COEFFICIENT
+    south = max(latitude - angle, -90.0)
+    north = min(latitude + angle, 90.0)
+
+    # A circle that contains a pole covers all longitudes. Otherwise, the 
+    # meridians tangent to the circle bound it, which are farther from the 
+    # center in longitude at higher latitudes.
+    if -90.0 == south or 90.0 == north or 90.0 <= angle:
+        return south, north, None
+    longitude_angle = math.degrees(math.asin(min(
+        math.sin(math.radians(angle)) / math.cos(math.radians(latitude)), 
+        1.0)))
+    return south, north, longitude_angle
+
+def box_mask(center_point, radius, columns):
+    """Returns a boolean mask of points of columns within the bounding box 
+    of a circle. It compares raw coordinates only, thus it is a cheap 
+    prefilter of :func:`distances_to`. Points within the circle are always 
+    within the box.
+
+    : param center_point: a center of the circle
+    : param radius: a radius of the circle
+    : param columns: a dictionary of columns
+    """
+    south, north, longitude_angle = bounding_box(
+        center_point.latitude, center_point.longitude, radius)
+    latitudes = columns['latitudes']
+    mask = ((south - BOX_MARGIN <= latitudes) & 
+            (latitudes <= north + BOX_MARGIN))
+    if None == longitude_angle:
+        return mask
+
+    longitudes = columns['longitudes']
+    west = center_point.longitude - longitude_angle - BOX_MARGIN
+    east = center_point.longitude + longitude_angle + BOX_MARGIN
+    if -180.0 <= west and east < 180.0:
+        mask &= (west <= longitudes) & (longitudes <= east)
+    else:
+        # differences of longitudes wrap around the antimeridian
+        longitude_differences = np.abs(np.remainder(
+            longitudes - center_point.longitude + 180.0, 360.0) - 180.0)
+        mask &= longitude_differences <= longitude_angle + BOX_MARGIN
+    return mask
+
+def cells_within(center_point, radius, rows, columns, precision):
+    """Returns a boolean array that tells whether each cell of a grid is 
+    entirely within a circle, in the order of :func:`grid_hashes`. The 
+    farthest point of a cell from the center is one of its corners, thus a 
+    cell is within the circle if all corners are.
+
+    : param center_point: a center of the circle
+    : param radius: a radius of the circle
+    : param rows: contiguous rows of the grid. See :func:`covering_grid`.
+    : param columns: columns of the grid
+    : param precision: a precision of cells
+    """
+    cell_height, cell_width = grid_cell_size(precision)
+    # a cell within the circle is also within its bounding box
+    south, north, longitude_angle = bounding_box(
+        center_point.latitude, center_point.longitude, radius)
+    fits = (math.ceil((south + 90.0) / cell_height) < 
+            math.floor((north + 90.0) / cell_height))
+    if None != longitude_angle:
+        west = center_point.longitude - longitude_angle + 180.0
+        east = center_point.longitude + longitude_angle + 180.0
+        fits &= math.ceil(west / cell_width) < math.floor(east / cell_width)
+    if not fits:
+        return np.zeros(len(rows) * len(columns), dtype=bool)
+
+    # corners are shared by adjacent rows, but not by columns which may wrap
+    # around the antimeridian.
+    latitudes = -90.0 + np.arange(rows[0], rows[-1] + 2) * cell_height
+    wests = -180.0 + np.array(columns, dtype=np.float64) * cell_width
+    longitudes = np.column_stack((wests, wests + cell_width)).ravel()
+    corners = point_columns(np.repeat(latitudes, len(longitudes)),
+                            np.tile(longitudes, len(latitudes)), 
+                            None, None, None)
+    distances = distances_to(center_point, corners).reshape(
+        len(rows) + 1, len(columns), 2).max(axis=2)
+    farthest = np.maximum(distances[:-1], distances[1:])
+    return farthest.ravel() <= radius - CELL_MARGIN
+
+def circle_mask(center_point, radius, columns):
+    """Returns a boolean mask of points of columns within a circle. Points 
+    out of the bounding box of the circle are dropped before exact 
+    distances.
+
+    : param center_point: a center of the circle
+    : param radius: a radius of the circle
+    : param columns: a dictionary of columns
+    """
+    mask = box_mask(center_point, radius, columns)
+    positions = np.flatnonzero(mask)
+    distances = distances_to(center_point, 
+                             distance_columns(columns, positions))
+    mask[positions] = distances <= radius
+    return mask
+
+def box_grid(bounds, precision):
+    """Returns rows and columns of cells at ``precision`` that intersect 
+    with a box. Columns of a box across the antimeridian wrap around.
+
+    : param bounds: a tuple of ``(south, west, north, east)`` in degree. 
+                    ``west`` greater than ``east`` is a box across the 
+                    antimeridian.
+    : param precision: a precision of cells
+    """
+    south, west, north, east = bounds
+    cell_height, cell_width = grid_cell_size(precision)
+    row_count = int(round(180.0 / cell_height))
+    column_count = int(round(360.0 / cell_width))
+
+    rows = range(min(int((south + 90.0) / cell_height), row_count - 1),
+                 min(int((north + 90.0) / cell_height), row_count - 1) + 1)
+    if east < west:
+        east += 360.0
+    first = int(math.floor((west + 180.0) / cell_width))
+    last = int(math.floor((east + 180.0) / cell_width))
+    if column_count <= last - first + 1:
+        return rows, range(column_count)
+    return rows, [column % column_count for column in range(first, last + 1)]
+
+def box_precision(bounds):
+    """Returns the finest precision of cells that cover a box with at most 
+    :data:`MAX_COVERING_CELLS` cells. See :func:`box_grid`.
+    """
+    precision = 1
+    while precision < CODE_PRECISION:
+        rows, columns = box_grid(bounds, precision + 1)
+        if MAX_COVERING_CELLS < len(rows) * len(columns):
+            break
+        precision += 1
+    return precision
+
+def box_cells_within(bounds, rows, columns, precision):
+    """Returns a boolean array that tells whether each cell of a grid is 
+    entirely within a box, in the order of :func:`grid_hashes`. 
+
+    : param bounds: a box. See :func:`box_grid`.
+    : param rows: rows of the grid
+    : param columns: columns of the grid
+    : param precision: a precision of cells
+    """
+    south, west, north, east = bounds
+    if east < west:
+        east += 360.0
+    cell_height, cell_width = grid_cell_size(precision)
+    souths = -90.0 + np.array(rows, dtype=np.float64) * cell_height
+    wests = -180.0 + np.array(columns, dtype=np.float64) * cell_width
+    rows_within = ((south <= souths - BOX_MARGIN) & 
+                   (souths + cell_height + BOX_MARGIN <= north))
+    # a cell west of the antimeridian is also 360 degrees to the east
+    columns_within = np.zeros(len(wests), dtype=bool)
+    for offset in [0.0, 360.0]:
+        columns_within |= ((west <= wests + offset - BOX_MARGIN) & 
+                           (wests + offset + cell_width + BOX_MARGIN <= east))
+    return np.outer(rows_within, columns_within).ravel()
+
+def bounds_mask(bounds, latitudes, longitudes):
+    """Returns a boolean mask of points within a box including its edges.
+
+    : param bounds: a box. See :func:`box_grid`.
+    : param latitudes: latitudes of points
+    : param longitudes: longitudes of points
+    """
+    south, west, north, east = bounds
+    mask = (south <= latitudes) & (latitudes <= north)
+    if west <= east:
+        mask &= (west <= longitudes) & (longitudes <= east)
+    else:
+        mask &= (west <= longitudes) | (longitudes <= east)
+    return mask
+
+def distance_columns(columns, selection):
+    """Selects points of columns by a mask or positions like 
+    :func:`select_columns`, but only the columns that :func:`distances_to` 
+    reads.
+    """
+    return dict((name, columns[name][selection]) for name in DISTANCE_COLUMNS)
+
+def distances_to(center_point, columns):
+    """Calculates distances between ``center_point`` and all points of 
+    ``columns`` at once with the haversine formula.
+
+    : param center_point: a center point
+    : param columns: a dictionary of columns
+    """
+    sin_half_dlat = np.sin(
+        (columns['rad_latitudes'] - center_point.rad_latitude) / 2)
+    sin_half_dlng = np.sin(
+        (columns['rad_longitudes'] - center_point.rad_longitude) / 2)
+    haversine = (sin_half_dlat * sin_half_dlat +
+                 math.cos(center_point.rad_latitude) * 
+                 columns['cos_latitudes'] * sin_half_dlng * sin_half_dlng)
+    distances = np.degrees(
+        2 * np.arcsin(np.sqrt(np.minimum(haversine, 1.0)))
+    ) * DISTANCE_COEFFICIENT
+
+    # Keeps the exact zero distance of :meth:`SpatialIndexPoint.__eq__`. 
+    # Points of the same rounded location are close to the center, thus only
+    # close points are compared.
+    close = np.flatnonzero(distances < SAME_POINT_DISTANCE)
+    if 0 < len(close):
+        same = ((np.round(columns['latitudes'][close], 6) == 
+                 round(center_point.latitude, 6)) &
+                (np.round(columns['longitudes'][close], 6) == 
+                 round(center_point.longitude, 6)))
+        distances[close[same]] = 0.0
+
+    return distances
+
 class SpatialIndex(object):
     """ Implements spatial search 
 
@@ -84,8 +728,14 @@ class SpatialIndex(object):
     def __init__(self, maximum_radius=2000):
         #: A precision that determines size of grid 
         self.precision = self.get_suggested_precision(maximum_radius)
-        #: A spatial points container
+        #: A spatial cells container
         self.data = {}
+        #: Sorted hashes of cells. ``None`` until cells are searched, and then
+        #: it is kept sorted as cells are added or removed.
+        self.sorted_hashes = None
+        #: Results of :meth:`get_cell_totals` of each precision. They are 
+        #: cleared whenever points are added or removed.
+        self.cell_totals = {}
 
     def get_suggested_precision(self, maximum_radius=2000):
         """Finds suggested precision for given radius.
@@ -95,7 +745,7 @@ class SpatialIndex(object):
         """ 
         
         suggested_precision = 1
-        for precision, grid_size in GEO_HASH_GRID_SIZE.items():
+        for precision, grid_size in sorted(GEO_HASH_GRID_SIZE.items()):
             #Because we are only going to fetch all points 4 neighborhood grids,
             #``maximum_radius`` is larger than ``grid_size / 2``.
             if maximum_radius > grid_size / 2: 
@@ -123,18 +773,474 @@ class SpatialIndex(object):
         )
 
         point_hash = self.get_point_hash(point)
-        points = self.data.setdefault(point_hash, [])
-        points.append(point)
+        cell = self.data.get(point_hash)
+        if None == cell:
+            cell = self.data[point_hash] = SpatialIndexCell()
+            if None != self.sorted_hashes:
+                bisect.insort(self.sorted_hashes, point_hash)
+        cell.append(point)
+        self.cell_totals = {}
+
+    def add_points(self, latitudes, longitudes, refs, uids=None):
+        """Add spatial points in bulk. Geohash codes of all points are 
+        computed at once and points are grouped by cells with one sort, thus 
+        points of each cell are added as a contiguous slice. The result is 
+        the same as :meth:`add_point` of each point in order.
+
+        : param latitudes: an array of latitudes
+        : param longitudes: an array of longitudes
+        : param refs: references to associated objects of points
+        : param uids: optional integer ids of points. -1 by default.
+        """
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        if not (isinstance(refs, np.ndarray) and object == refs.dtype):
+            refs = object_array(refs)
+        if uids is None:
+            uids = np.empty(len(latitudes), dtype=np.int64)
+            uids.fill(-1)
+
+        codes = point_codes(latitudes, longitudes)
+        order = np.argsort(codes, kind='mergesort')
+        columns = point_columns(latitudes[order], longitudes[order], 
+                                refs[order], 
+                                np.asarray(uids, dtype=np.int64)[order], 
+                                codes[order])
+
+        keys, offsets = cell_offsets(columns['codes'], self.precision)
+        offsets = offsets.tolist()
+        added = False
+        for i, key in enumerate(keys):
+            cell_columns = dict(
+                (name, columns[name][offsets[i]:offsets[i + 1]]) 
+                for name in CELL_COLUMNS)
+            cell = self.data.get(key)
+            if None == cell:
+                self.data[key] = SpatialIndexCell(cell_columns)
+                added = True
+            else:
+                cell.extend(cell_columns)
+        if added and None != self.sorted_hashes:
+            self.sorted_hashes = sorted(self.data)
+        self.cell_totals = {}
+
+    def remove_point(self, point):
+        """Remove spatial point from spatial index object. Only the cell of 
+        the point is changed. Returns ``True`` if the point is removed.
+
+        : param point: a spatial index point at its indexed location. See 
+                       :meth:`SpatialIndexCell.remove` for how it is found.
+        """
+        assert isinstance(point, SpatialIndexPoint), (
+            'Instance of point != SpatialIndexPoint.'
+        )
+
+        point_hash = self.get_point_hash(point)
+        cell = self.data.get(point_hash)
+        if None == cell or not cell.remove(point):
+            return False
+        self.cell_totals = {}
+
+        if 0 == len(cell):
+            del self.data[point_hash]
+            if None != self.sorted_hashes:
+                position = bisect.bisect_left(self.sorted_hashes, point_hash)
+                del self.sorted_hashes[position]
+        return True
+
+    def move_point(self, point, latitude, longitude):
+        """Move spatial point to a new location. Returns the moved point.
+
+        : param point: a spatial index point at its indexed location
+        : param latitude: a new latitude
+        : param longitude: a new longitude
+        """
+        self.remove_point(point)
+        moved_point = SpatialIndexPoint(latitude, longitude, ref=point.ref, 
+                                        uid=point.uid)
+        self.add_point(moved_point)
+        return moved_point
+
+    def get_columns(self):
+        """Returns all points as flat columns ordered by cell. Returns sorted 
+        cell hashes, offsets of each cell in the columns and a dictionary of 
+        columns. See :data:`CELL_COLUMNS` for the column names.
+        """
+        keys = sorted(self.data)
+        cells = [self.data[key].compact() for key in keys]
+
+        offsets = np.zeros(len(cells) + 1, dtype=np.int64)
+        np.cumsum([len(cell) for cell in cells], out=offsets[1:])
+        columns = {}
+        for name in CELL_COLUMNS:
+            columns[name] = np.concatenate(
+                [EMPTY_CELL_COLUMNS[name]] + 
+                [getattr(cell, name) for cell in cells])
+        return keys, offsets, columns
+
+    def set_columns(self, keys, offsets, columns):
+        """Replaces all points with flat columns returned by 
+        :meth:`get_columns`. Cells are slices of given columns, thus columns 
+        can be memory-mapped arrays.
+
+        : param keys: sorted cell hashes
+        : param offsets: offsets of each cell in the columns
+        : param columns: a dictionary of columns
+        """
+        # slicing plain arrays is much cheaper than slicing memory maps
+        columns = dict((name, columns[name].view(np.ndarray)) 
+                       for name in CELL_COLUMNS)
+        offsets = np.asarray(offsets).tolist()
+
+        self.data = {}
+        for i, key in enumerate(keys):
+            start, stop = offsets[i], offsets[i + 1]
+            self.data[key] = SpatialIndexCell(dict(
+                (name, columns[name][start:stop]) for name in CELL_COLUMNS))
+        self.sorted_hashes = sorted(self.data)
+        self.cell_totals = {}
+
+    def get_cell_totals(self, precision):
+        """Returns totals of points of cells at ``precision``, which must not 
+        be finer than the precision of the index. Totals of cells of the 
+        index are kept in the cells and summed by hash prefixes, thus it 
+        costs O(cells) rather than O(points). Results are kept until points 
+        are changed. Returns a tuple of
+
+          - sorted hashes of cells with points,
+          - offsets of each cell in :attr:`sorted_hashes`, which cells of 
+            the index it contains start from,
+          - and arrays of the number of points and sums of latitudes and 
+            longitudes of each cell.
+
+        : param precision: a precision of cells
+        """
+        assert precision <= self.precision, (
+            'Cells of precision %d are finer than the index.' % precision
+        )
+        totals = self.cell_totals.get(precision)
+        if None != totals:
+            return totals
+
+        if None == self.sorted_hashes:
+            self.sorted_hashes = sorted(self.data)
+        prefixes = [key[:precision] for key in self.sorted_hashes]
+        starts = [i for i, prefix in enumerate(prefixes) 
+                  if 0 == i or prefix != prefixes[i - 1]]
+        sums = np.array([self.data[key].totals() 
+                         for key in self.sorted_hashes], 
+                        dtype=np.float64).reshape(-1, 3)
+        if starts:
+            sums = np.add.reduceat(sums, starts)
+        totals = ([prefixes[i] for i in starts], 
+                  np.array(starts, dtype=np.int64), 
+                  sums[:, 0].astype(np.int64), sums[:, 1], sums[:, 2])
+        self.cell_totals[precision] = totals
+        return totals
+
+    def get_covering_precision(self, radius):
+        """Finds a precision of cells to cover a circle of ``radius``. Cells 
+        are about a half of the radius, so that the covering cells are 
+        close to the circle and still a few.
+
+        : param radius: a radius of the circle
+        """
+        covering_precision = 1
+        for precision, grid_size in sorted(GEO_HASH_GRID_SIZE.items()):
+            if grid_size < radius / 2.0:
+                break
+            covering_precision = precision
+        return covering_precision
+
+    def get_covering_hashes(self, center_point, radius):
+        """Returns hashes of cells that cover a circle generated from given 
+        center point and radius. A precision of the cells is chosen by the 
+        radius and it may differ from the precision of the index.
+
+        : param center_point: a center point
+        : param radius: a radius from a center point
+        """
+        return grid_hashes(*self.get_covering_grid(center_point, radius))
+
+    def get_covering_grid(self, center_point, radius):
+        """Returns rows, columns and a precision of cells that cover a 
+        circle. See :meth:`get_covering_hashes`.
+        """
+        precision = self.get_covering_precision(radius)
+        while True:
+            rows, columns = covering_grid(center_point.latitude, 
+                                          center_point.longitude, radius,
+                                          precision)
+            if (1 == precision or 
+                    len(rows) * len(columns) <= MAX_COVERING_CELLS):
+                return rows, columns, precision
+            precision -= 1
+
+    def get_covering_cells(self, center_point, radius):
+        """Returns pairs of a hash of each cell of :meth:`get_covering_hashes`
+        and whether the cell is entirely within the circle. See 
+        :func:`cells_within`.
+        """
+        rows, columns, precision = self.get_covering_grid(center_point, 
+                                                          radius)
+        return zip(grid_hashes(rows, columns, precision),
+                   cells_within(center_point, radius, rows, columns, 
+                                precision))
+
+    def get_box_cells(self, bounds):
+        """Returns pairs of a hash of each cell that intersects with a box 
+        and whether the cell is entirely within the box. Cells are the 
+        finest ones of :func:`box_precision`, thus the number of them is 
+        bounded whatever the size of the box is.
+
+        : param bounds: a box. See :func:`box_grid`.
+        """
+        precision = box_precision(bounds)
+        rows, columns = box_grid(bounds, precision)
+        return zip(grid_hashes(rows, columns, precision),
+                   box_cells_within(bounds, rows, columns, precision))
+
+    def get_hash_columns(self, point_hash):
+        """Returns a list of columns of all points within ``point_hash`` cell.
+        Cells larger than the cells of the index are gathered from the cells 
+        with the same prefix, and smaller ones are sliced out of the cell 
+        that contains them.
+
+        : param point_hash: a hash of cell at any precision
+        """
+        if None == self.sorted_hashes:
+            self.sorted_hashes = sorted(self.data)
+
+        if len(point_hash) <= self.precision:
+            start = bisect.bisect_left(self.sorted_hashes, point_hash)
+            stop = bisect.bisect_left(self.sorted_hashes, point_hash + '~',
+                                      start)
+            return [self.data[key].columns()
+                    for key in self.sorted_hashes[start:stop]]
+
+        cell = self.data.get(point_hash[:self.precision])
+        if None == cell:
+            return []
+        columns = cell.columns()
+        start, stop = np.searchsorted(columns['codes'], 
+                                      hash_code_range(point_hash))
+        if start == stop:
+            return []
+        return [select_columns(columns, slice(start, stop))]
+
+    def get_near_columns(self, center_point, radius=2000, cache=None):
+        """Returns columns of all points within cells that cover a circle 
+        generated from given center point and radius. 
+
+        : param center_point: a center point
+        : param radius: a radius from a center point. 2000 by default.
+        : param cache: an optional dictionary that keeps columns of each 
+                       cell. Queries that share the dictionary share columns 
+                       of the cells they have in common.
+        """
+        columns_list = []
+        for point_hash in self.get_covering_hashes(center_point, radius):
+            columns_list.extend(self.get_cached_hash_columns(point_hash, 
+                                                             cache))
+        return columns_list
+
+    def get_cached_hash_columns(self, point_hash, cache=None):
+        """Returns :meth:`get_hash_columns` of ``point_hash`` from ``cache``.
+        See :meth:`get_near_columns`.
+        """
+        if None == cache:
+            return self.get_hash_columns(point_hash)
+        hash_columns = cache.get(point_hash)
+        if None == hash_columns:
+            hash_columns = cache[point_hash] = self.get_hash_columns(
+                point_hash)
+        return hash_columns
 
     def get_near_points(self, center_point, radius=2000):
-        """A cheap filter that fetchs all points of 4 neighbor grids that are 
-        within a circle generated from given center point and radius.
+        """A cheap filter that fetchs all points of cells that cover a circle 
+        generated from given center point and radius.
         
         : param center_point: a center point
         : param radius: a radius from a center point. 2000 by default.
         """
-        me_and_neighbors = geohash.expand(self.get_point_hash(center_point))
-        return chain(*(self.data.get(key, []) for key in me_and_neighbors))
+        columns_list = self.get_near_columns(center_point, radius)
+        return chain(*(column_points(columns) for columns in columns_list))
+
+    def get_nearest_arrays(self, center_point, radius=2000, uids=None, 
+                           cache=None, metrics=NO_METRICS):
+        """A batch variant of :meth:`get_nearest_points` that calculates 
+        distances of all candidates in one pass. Returns references and 
+        distances of points within ``radius`` as arrays.
+
+        : param center_point: a center point
+        : param radius: a radius from a center point. 2000 by default.
+        : param uids: if set, only points whose ``uid`` is in this sorted 
+                      array are considered.
+        : param cache: an optional cache of cells. See 
+                       :meth:`get_near_columns`.
+        : param metrics: an optional :class:`~Metrics` that observes the 
+                         candidate fetch and the distance filter
+        """
+        with metrics.stage("candidates"):
+            columns = gather_columns(
+                self.get_near_columns(center_point, radius, cache))
+            if uids is not None:
+                columns = select_columns(columns, 
+                                         in_sorted(columns['uids'], uids))
+        with metrics.stage("distance"):
+            positions = np.flatnonzero(box_mask(center_point, radius, 
+                                                columns))
+            distances = distances_to(center_point, 
+                                     distance_columns(columns, positions))
+            within = distances <= radius
+            refs = columns['refs'][positions[within]]
+            distances = distances[within]
+        metrics.observe_candidates("distance", len(columns['refs']), 
+                                   len(refs))
+        metrics.observe_candidates("exact", len(positions), len(refs))
+        return refs, distances
+
+    def get_within_refs(self, center_point, radius=2000, uids=None, 
+                        cache=None, metrics=NO_METRICS):
+        """A variant of :meth:`get_nearest_arrays` that returns references 
+        of points within ``radius`` only. Points of cells entirely within 
+        the circle are accepted as they are, and the other points are 
+        filtered by the bounding box of the circle before exact distances. 
+        References are in the same order as :meth:`get_nearest_arrays`.
+
+        : param center_point: a center point
+        : param radius: a radius from a center point. 2000 by default.
+        : param uids: if set, only points whose ``uid`` is in this sorted 
+                      array are considered.
+        : param cache: an optional cache of cells. See 
+                       :meth:`get_near_columns`.
+        : param metrics: an optional :class:`~Metrics` that observes the 
+                         candidate fetch and the distance filter
+        """
+        with metrics.stage("candidates"):
+            columns_list = []
+            inner_list = []
+            for point_hash, inner in self.get_covering_cells(center_point, 
+                                                             radius):
+                for cell_columns in self.get_cached_hash_columns(point_hash, 
+                                                                 cache):
+                    columns_list.append(cell_columns)
+                    inner_list.append(inner)
+            columns = gather_columns(columns_list)
+            accepted = np.repeat(np.array(inner_list, dtype=bool), 
+                                 [len(cell_columns['refs']) 
+                                  for cell_columns in columns_list])
+            if uids is not None:
+                selection = in_sorted(columns['uids'], uids)
+                columns = select_columns(columns, selection)
+                accepted = accepted[selection]
+
+        with metrics.stage("distance"):
+            positions = np.flatnonzero(~accepted & 
+                                       box_mask(center_point, radius, columns))
+            distances = distances_to(center_point, 
+                                     distance_columns(columns, positions))
+            accepted[positions[distances <= radius]] = True
+            refs = columns['refs'][accepted]
+        metrics.observe_candidates("distance", len(accepted), len(refs))
+        metrics.observe_candidates("exact", len(positions), 
+                                   np.count_nonzero(distances <= radius))
+        return refs
+
+    def get_box_refs(self, bounds, uids=None, cache=None, 
+                     metrics=NO_METRICS):
+        """Returns references of points within a box. Points of cells 
+        entirely within the box are accepted as they are, and only the 
+        points of cells on its edges are compared with it. References are 
+        in the order of cells of :meth:`get_box_cells`.
+
+        : param bounds: a box. See :func:`box_grid`.
+        : param uids: if set, only points whose ``uid`` is in this sorted 
+                      array are considered.
+        : param cache: an optional cache of cells. See 
+                       :meth:`get_near_columns`.
+        : param metrics: an optional :class:`~Metrics` that observes the 
+                         candidate fetch and the box filter
+        """
+        with metrics.stage("candidates"):
+            columns_list = []
+            inner_list = []
+            for point_hash, inner in self.get_box_cells(bounds):
+                for cell_columns in self.get_cached_hash_columns(point_hash, 
+                                                                 cache):
+                    columns_list.append(cell_columns)
+                    inner_list.append(inner)
+            columns = gather_columns(columns_list)
+            accepted = np.repeat(np.array(inner_list, dtype=bool), 
+                                 [len(cell_columns['refs']) 
+                                  for cell_columns in columns_list])
+            if uids is not None:
+                selection = in_sorted(columns['uids'], uids)
+                columns = select_columns(columns, selection)
+                accepted = accepted[selection]
+
+        with metrics.stage("box"):
+            positions = np.flatnonzero(~accepted)
+            within = bounds_mask(bounds, columns['latitudes'][positions], 
+                                 columns['longitudes'][positions])
+            accepted[positions[within]] = True
+            refs = columns['refs'][accepted]
+        metrics.observe_candidates("box", len(accepted), len(refs))
+        return refs
+
+    def get_k_nearest_arrays(self, center_point, k, uids=None, 
+                             metrics=NO_METRICS):
+        """Finds ``k`` nearest points of ``center_point``. The search area 
+        grows outward until it contains ``k`` points, and then no point out 
+        of the area can be nearer than the k-th nearest one. Returns 
+        references and distances of the points as arrays in ascending order 
+        of distance.
+
+        : param center_point: a center point
+        : param k: the number of points to find
+        : param uids: if set, only points whose ``uid`` is in this sorted 
+                      array are considered.
+        : param metrics: an optional :class:`~Metrics` that observes the 
+                         search
+        """
+        with metrics.stage("nearest"):
+            refs, distances, examined = self.find_k_nearest(center_point, k, 
+                                                            uids)
+        metrics.observe_candidates("nearest", examined, len(refs))
+        return refs, distances
+
+    def find_k_nearest(self, center_point, k, uids=None):
+        """Implements :meth:`get_k_nearest_arrays`. Returns references and 
+        distances of the points and the number of candidates examined.
+        """
+        radius = NEAREST_INITIAL_RADIUS
+        examined = 0
+        while True:
+            columns = gather_columns(self.get_near_columns(center_point, 
+                                                           radius))
+            if uids is not None:
+                columns = select_columns(columns, 
+                                         in_sorted(columns['uids'], uids))
+            # points out of the bounding box are farther than ``radius``, 
+            # thus they are never the nearest ones when the search stops.
+            columns = select_columns(columns, 
+                                     box_mask(center_point, radius, columns))
+            distances = distances_to(center_point, columns)
+            examined += len(distances)
+
+            # Every point within ``radius`` is a candidate, thus the k-th 
+            # nearest candidate within ``radius`` is the k-th nearest point.
+            if (k <= np.count_nonzero(distances <= radius) or
+                    EARTH_HALF_CIRCUMFERENCE <= radius):
+                break
+            radius *= NEAREST_RADIUS_GROWTH
+
+        if k < len(distances):
+            nearest = np.argpartition(distances, k - 1)[:k]
+        else:
+            nearest = np.arange(len(distances))
+        nearest = nearest[np.argsort(distances[nearest], kind='mergesort')]
+        return columns['refs'][nearest], distances[nearest], examined
 
     def get_nearest_points(self, center_point, radius=2000):
         """A expensive filter that calculates precise distance between 
@@ -145,8 +1251,11 @@ class SpatialIndex(object):
         : param center_point: a center point
         : param radius: a radius from a center point. 2000 by default.
         """
-        target_points = self.get_near_points(center_point, radius)
-        for point in target_points:
-            distance = point.distance_to(center_point)
-            if distance <= radius:
+        for columns in self.get_near_columns(center_point, radius):
+            columns = select_columns(columns, 
+                                     box_mask(center_point, radius, columns))
+            distances = distances_to(center_point, columns)
+            within = np.flatnonzero(distances <= radius)
+            points = column_points(columns, within)
+            for point, distance in zip(points, distances[within].tolist()):
                 yield point, distance
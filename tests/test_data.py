@@ -9,8 +9,11 @@
 import pytest
 import unittest
 import cPickle as pickle
+import json
 import os
 
+import pandas as pd
+
 from server.data import Database
 
 class TestData(unittest.TestCase):
@@ -66,3 +69,99 @@ class TestData(unittest.TestCase):
             min_popularity = target_popularity
 
         assert [] == database.popular_products("-1")
+
+    def test_database_refined_messages(self):
+        database = Database("./data/")
+
+        messages = pd.read_pickle("./data/messages.pkl")
+        refined_count = 0
+        for convthread_id in database.dfs["convthreads"]["convthread_id"]:
+            records = database.popular_messages(convthread_id)
+            refined_count += len(records)
+            popularities = [record["popularity"] for record in records]
+            assert popularities == sorted(popularities)
+            for record in records:
+                assert record["convthread_id"]["convthread_id"] == convthread_id
+                message = messages[messages.message_id == record["message_id"]]
+                assert message["convthread_id"].values[0] == convthread_id
+        assert refined_count == len(messages)
+
+    def test_database_message_fragments(self):
+        database = Database("./data/")
+        convthread_id = database.dfs["convthreads"]["convthread_id"].values[0]
+        database.upsert_message(convthread_id, "new", u"New \u00e9 \"", 0.3)
+        database.upsert_convthread("added", 1, 2.5, "Added")
+        database.upsert_message("added", "first", "First message", 1.0)
+
+        for convthread_id in database.dfs["convthreads"]["convthread_id"]:
+            messages = database.popular_messages(convthread_id)
+            for position in range(len(messages)):
+                assert (json.loads(json.dumps(messages[position])) == 
+                        json.loads(messages.fragment(position)))
+
+    def test_database_popularity_precision(self):
+        database = Database("./data/")
+        convthread_id = database.dfs["convthreads"]["convthread_id"].values[0]
+        database.upsert_message(convthread_id, "new", "New message",
+                                0.4606936)
+
+        messages = database.popular_messages(convthread_id)
+        position = [record["message_id"]
+                    for record in messages].index("new")
+        assert '"popularity": 0.4606936,' in json.dumps(messages[position],
+                                                         sort_keys=True)
+        assert '"popularity": 0.4606936,' in messages.fragment(position)
+
+    def test_database_updates(self):
+        database = Database("./data/")
+        convthread_id = database.dfs["convthreads"]["convthread_id"].values[0]
+        tag_id = database.tag_ids()[0]
+
+        version = database.version
+        database.upsert_message(convthread_id, "new", "New message", 0.5)
+        database.upsert_message(convthread_id, "new", "New message", 0.75)
+        records = database.popular_messages(convthread_id)
+        popularities = [record["popularity"] for record in records]
+        assert popularities == sorted(popularities)
+        assert 1 == len([record for record in records 
+                         if "new" == record["message_id"]])
+        assert version < database.version
+
+        database.upsert_convthread(convthread_id, 10.0, 20.0, "Moved", 
+                                   [tag_id])
+        convthread = database.convthread(convthread_id)
+        assert [10.0, 20.0, "Moved"] == convthread.tolist()[1:]
+        assert [tag_id] == database.tag_ids(convthread_id).tolist()
+        for record in database.popular_messages(convthread_id):
+            assert 10.0 == record["convthread_id"]["lat"]
+
+        database.upsert_convthread("added", 1.0, 2.0, "Added")
+        database.upsert_message("added", "first", "First message", 1.0)
+        assert 1 == len(database.popular_messages("added"))
+        assert 4 == len(database.convthreads())
+
+        assert database.delete_convthread(convthread_id)
+        assert not database.delete_convthread(convthread_id)
+        assert [] == database.popular_messages(convthread_id)
+        assert 0 == len(database.tag_ids(convthread_id))
+        assert 3 == len(database.convthreads())
+        self.assertRaises(KeyError, database.upsert_message, convthread_id, 
+                          "new", "New message", 0.5)
+
+    def test_database_lookups(self):
+        database = Database("./data/")
+
+        df = database.dfs["tags"]
+        for tag, tag_id in df[["tag", "tag_id"]].values:
+            assert tag_id == database.tag_id(tag)
+
+        df = database.dfs["convthreads"]
+        for record in df.values:
+            assert record.tolist() == database.convthread(record[0]).tolist()
+
+        df = database.dfs["convthreads_with_tags"]
+        for convthread_id in database.dfs["convthreads"]["convthread_id"]:
+            expected = df[df.convthread_id == convthread_id]["tag_id"]
+            assert (sorted(expected.values.tolist()) == 
+                    sorted(database.tag_ids(convthread_id).tolist()))
+        assert 0 == len(database.tag_ids("-1"))
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.ingest
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    The chunked ingestion of datafiles.
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+from server import ingest
+from server.data import Database
+
+class TestIngest(unittest.TestCase):
+    def setUp(self):
+        self.datapath = "./data/"
+        self.path = tempfile.mkdtemp()
+        self.data = Database(self.datapath)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, extension):
+        for name in ingest.DATAFILES:
+            df = pd.read_pickle(os.path.join(self.datapath, name + '.pkl'))
+            path = os.path.join(self.path, name + extension)
+            if '.csv' == extension:
+                df.to_csv(path, index=False)
+            elif '.jsonl' == extension:
+                # json keeps floats exactly unlike ``DataFrame.to_json``
+                with open(path, 'w') as jsonl_file:
+                    for record in df.to_dict('records'):
+                        jsonl_file.write(json.dumps(record) + '\n')
+            else:
+                df.to_parquet(path)
+
+    def assert_same_database(self, data):
+        assert self.data.tag_ids() == data.tag_ids()
+        for tag_id in self.data.tag_ids():
+            assert (sorted(self.data.convthreads(tag_id).tolist()) ==
+                    sorted(data.convthreads(tag_id).tolist()))
+        for convthread_id in self.data.dfs["convthreads"]["convthread_id"]:
+            assert (self.data.popular_messages(convthread_id) ==
+                    data.popular_messages(convthread_id))
+
+    def test_ingest_pickle_chunks(self):
+        self.assert_same_database(Database(self.datapath, chunksize=1))
+
+    def test_ingest_csv(self):
+        self.write('.csv')
+        self.assert_same_database(Database(self.path, chunksize=1))
+
+    def test_ingest_jsonl(self):
+        self.write('.jsonl')
+        self.assert_same_database(Database(self.path, chunksize=3))
+
+    def test_ingest_parquet(self):
+        try:
+            import pyarrow
+        except ImportError:
+            raise unittest.SkipTest("pyarrow is not installed")
+        self.write('.parquet')
+        self.assert_same_database(Database(self.path, chunksize=2))
+
+    def test_ingest_missing_datafile(self):
+        self.write('.csv')
+        os.remove(os.path.join(self.path, "tags.csv"))
+        self.assertRaises(IOError, Database, self.path)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.reload
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Reloads of the dataset of a running server.
+"""
+
+import os
+import signal
+import shutil
+import tempfile
+import threading
+import unittest
+
+from server.app import create_app, reload_dataset
+from server.metrics import Metrics
+
+URL = '/search?lat=59.33258&lng=18.0649&radius=2000&count=10'
+
+class TestReload(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app({'TESTING': True})
+        self.client = self.app.test_client()
+
+    def test_reload_endpoint(self):
+        assert 404 == self.client.get('/admin/reload').status_code
+        self.app.config['RELOAD_ENDPOINT_ENABLED'] = True
+
+        data, search = self.app.data, self.app.search
+        expected = self.client.get(URL).json
+        status = self.client.post('/admin/reload').json
+        assert status['started']
+        self.app.reloader.join()
+
+        status = self.client.get('/admin/reload').json
+        assert not status['started'] and not status['running']
+        assert 1 == status['generation'] and None == status['error']
+        assert data is not self.app.data and search is not self.app.search
+        assert self.app.data is self.app.search.data
+        assert expected == self.client.get(URL).json
+
+    def test_reload_in_flight(self):
+        # a search taken before a reload keeps its own database
+        search = self.app.search
+        search.metrics = Metrics()
+        loaded = threading.Event()
+        proceed = threading.Event()
+
+        def load():
+            loaded.set()
+            proceed.wait()
+            return reload_dataset(self.app.config)
+
+        self.app.reloader.load = load
+        assert self.app.reloader.reload()
+        loaded.wait()
+        assert not self.app.reloader.reload()
+        assert search is self.app.search
+        proceed.set()
+        self.app.reloader.join()
+
+        assert search is not self.app.search
+        assert search.data is not self.app.data
+        assert search.metrics is self.app.search.metrics
+        assert (search.convthreads_nearby_user((59.33258, 18.0649), 2000) ==
+                self.app.search.convthreads_nearby_user((59.33258, 18.0649), 
+                                                        2000))
+
+    def test_reload_failure(self):
+        def load():
+            raise IOError("No datafile")
+
+        search = self.app.search
+        self.app.reloader.load = load
+        self.app.reloader.run()
+        assert search is self.app.search
+        assert 0 == self.app.reloader.generation
+        assert "No datafile" == self.app.reloader.error
+
+    def test_reload_install_failure(self):
+        search = self.app.search
+        self.app.config['SPATIAL_INDEX_BACKEND'] = 'rtree'
+        self.app.reloader.run()
+        assert search is self.app.search
+        assert 0 == self.app.reloader.generation
+        assert None != self.app.reloader.error
+
+    def test_reload_signal(self):
+        handler = signal.getsignal(signal.SIGUSR1)
+        try:
+            self.app.reloader.install_signal('SIGUSR1')
+            search = self.app.search
+            os.kill(os.getpid(), signal.SIGUSR1)
+            self.app.reloader.join()
+        finally:
+            signal.signal(signal.SIGUSR1, handler)
+        assert search is not self.app.search
+        assert 1 == self.app.reloader.generation
+
+    def test_reload_snapshot(self):
+        path = tempfile.mkdtemp()
+        try:
+            config = dict(self.app.config)
+            config['SNAPSHOT_PATH'] = os.path.join(path, "snapshot")
+            data, search = reload_dataset(config)
+            assert os.path.exists(config['SNAPSHOT_PATH'])
+            assert (self.app.search.convthreads_nearby_user(
+                        (59.33258, 18.0649), 2000) ==
+                    search.convthreads_nearby_user((59.33258, 18.0649), 2000))
+        finally:
+            shutil.rmtree(path)
+
+    def test_reload_without_snapshot(self):
+        path = tempfile.mkdtemp()
+        try:
+            config = dict(self.app.config)
+            config['RELOAD_SNAPSHOT_PATH'] = os.path.join(path, "snapshot")
+            data, search = reload_dataset(config)
+            assert None == config['SNAPSHOT_PATH']
+            assert os.path.exists(config['RELOAD_SNAPSHOT_PATH'])
+            assert (self.app.search.convthreads_nearby_user(
+                        (59.33258, 18.0649), 2000) ==
+                    search.convthreads_nearby_user((59.33258, 18.0649), 2000))
+
+            # the tables stay readable after the snapshot is replaced
+            shutil.rmtree(path)
+            assert (sorted(self.app.data.tag_ids()) == 
+                    sorted(data.tag_ids()))
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
@@ -27,3 +27,341 @@ def test_search_speed_performance(client):
     rv = client.get('/search?lat=59.33258&lng=18.0649&radius=2000&tags=&count=50')
     elapsed = time.time() - start
     assert elapsed < 0.3, "elapsed %f" % elapsed
+
+def test_search_repeatable(client):
+    url = '/search?lat=59.33258&lng=18.0649&radius=2000&tags=&count=50'
+    first = client.get(url).json
+    for _ in range(3):
+        assert first == client.get(url).json
+
+def test_search_tags(app, client):
+    url = '/search?lat=59.33258&lng=18.0649&radius=2000&count=50&tags=%s'
+    for tag in app.data.dfs["tags"]["tag"]:
+        tag_id = app.data.tag_id(tag)
+        for message in client.get(url % tag).json['messages']:
+            convthread_id = message['convthread_id']['convthread_id']
+            assert tag_id in app.data.tag_ids(convthread_id)
+
+    assert [] == client.get(url % 'unknown').json['messages']
+
+def test_search_tag_union(app):
+    search = app.search
+    user_location = (59.33258, 18.0649)
+    tags = list(app.data.dfs["tags"]["tag"])
+    convthread_ids = search.convthreads_nearby_user(user_location, 2000, 
+                                                    tags + ['unknown'])
+    assert len(set(convthread_ids)) == len(convthread_ids)
+
+    # the union keeps the order of the untagged search
+    union = set()
+    for tag in tags:
+        union.update(search.convthreads_nearby_user(user_location, 2000, 
+                                                    [tag]))
+    assert [convthread_id for convthread_id in 
+            search.convthreads_nearby_user(user_location, 2000)
+            if convthread_id in union] == convthread_ids
+
+def test_search_nearest(client):
+    url = '/search?lat=59.33258&lng=18.0649&nearest=%d&count=1000'
+    messages = client.get(url % 5).json['messages']
+    convthread_ids = set(message['convthread_id']['convthread_id'] 
+                         for message in messages)
+    assert 0 < len(convthread_ids) <= 5
+
+    rv = client.get('/search?lat=59.33258&lng=18.0649&nearest=-1&count=10')
+    assert 'error' in rv.json
+
+def test_search_batch(client):
+    import json
+    queries = [
+        {'lat': 59.33258, 'lng': 18.0649, 'radius': 500, 'count': 10},
+        {'lat': 59.33258, 'lng': 18.0649, 'radius': 2000, 'tags': '', 
+         'count': 2},
+        {'lat': 59.33, 'lng': 18.06, 'radius': 3000, 'count': 5},
+        {'lat': 59.33258, 'lng': 18.0649, 'radius': 0, 'count': 10},
+    ]
+    rv = client.post('/search/batch', data=json.dumps({'queries': queries}),
+                     content_type='application/json')
+    results = rv.json['results']
+    assert len(queries) == len(results)
+
+    for query, result in zip(queries[:3], results):
+        url = '/search?lat=%(lat)s&lng=%(lng)s&radius=%(radius)s&count=%(count)s'
+        url = url % query + '&tags=%s' % query.get('tags', '')
+        assert client.get(url).json == result
+    assert 'error' in results[3]
+
+    rv = client.post('/search/batch', data=json.dumps({'queries': 'x'}),
+                     content_type='application/json')
+    assert 'error' in rv.json
+
+def test_search_cache():
+    from numpy.random import RandomState
+    from server.data import Database
+    from server.search import QueryCache, Search
+    random = RandomState(4)
+
+    data = Database("./data/")
+    search = Search(data)
+    queries = [((59.33258 + 0.0001 * random.normal(), 
+                 18.0649 + 0.0001 * random.normal()), radius)
+               for radius in [100, 500, 1000, 2000] for _ in range(5)]
+    expected = [sorted(search.convthreads_nearby_user(*query)) 
+                for query in queries]
+
+    search.cache = QueryCache(size=2)
+    for query, convthread_ids in zip(queries, expected):
+        assert convthread_ids == sorted(
+            search.convthreads_nearby_user(*query))
+    assert 2 == len(search.cache)
+    assert 0 < search.cache.hits
+    assert len(queries) == search.cache.hits + search.cache.misses
+
+    data.version += 1
+    misses = search.cache.misses
+    search.convthreads_nearby_user(*queries[-1])
+    assert misses + 1 == search.cache.misses
+
+def test_search_updates(app):
+    from server.search import Search
+    search = Search(app.data)
+    user_location = (59.33258, 18.0649)
+    convthread_ids = search.convthreads_nearby_user(user_location, 2000)
+    assert 0 < len(convthread_ids)
+
+    # moves without tags keep the tags
+    tagged = search.convthreads_nearby_user(user_location, 2000, ['cafe'])[0]
+    search.upsert_convthread(tagged, 30.0, 40.0)
+    assert [tagged] == search.convthreads_nearby_user((30.0, 40.0), 10, 
+                                                      ['cafe'])
+
+    moved = convthread_ids[0]
+    search.upsert_convthread(moved, 10.0, 20.0, ['tag'])
+    assert moved not in search.convthreads_nearby_user(user_location, 2000)
+    assert [moved] == search.convthreads_nearby_user((10.0, 20.0), 10)
+    uid = search.convthread_points[moved].uid
+    assert [uid] == search.tag_postings['tag'].tolist()
+
+    search.upsert_convthread('added', 59.33258, 18.0649)
+    assert 'added' in search.convthreads_nearby_user(user_location, 10)
+    assert ['added'] == search.convthreads_nearest_user(user_location, 1)
+
+    assert search.delete_convthread(moved)
+    assert not search.delete_convthread(moved)
+    assert [] == search.convthreads_nearby_user((10.0, 20.0), 10)
+    assert [] == search.tag_postings['tag'].tolist()
+
+def test_search_clusters(app, client):
+    import geohash
+    from server.search import Search
+    search = Search(app.data)
+    convthreads = app.data.convthreads()
+    popularities = app.data.max_popularities(convthreads[:, 0])
+
+    def expected(precision, moved=None):
+        cells = {}
+        for convthread, popularity in zip(convthreads, popularities):
+            convthread_id, lat, lng = convthread[:3]
+            if convthread_id == moved:
+                lat, lng = 10.0, 20.0
+            cell = cells.setdefault(geohash.encode(lat, lng, precision), 
+                                    [0, 0.0, 0.0, 0.0])
+            cell[0] += 1
+            cell[1] += lat
+            cell[2] += lng
+            cell[3] = max(cell[3], popularity)
+        return sorted(cells.items())
+
+    def assert_clusters(precision, moved=None):
+        clusters = search.clusters(precision)
+        assert len(expected(precision, moved)) == len(clusters)
+        for cluster, (point_hash, cell) in zip(clusters, 
+                                               expected(precision, moved)):
+            assert point_hash == cluster['hash']
+            assert cell[0] == cluster['count']
+            assert abs(cell[1] / cell[0] - cluster['lat']) < 1e-9
+            assert abs(cell[2] / cell[0] - cluster['lng']) < 1e-9
+            assert abs(cell[3] - cluster['popularity']) < 1e-6
+
+    for precision in [1, 3, 5, 6]:
+        assert_clusters(precision)
+    assert search.clusters(6) == search.clusters(12)
+
+    # totals follow moved convthreads
+    moved = convthreads[0][0]
+    search.upsert_convthread(moved, 10.0, 20.0)
+    app.data.version += 1
+    for precision in [1, 4, 6]:
+        assert_clusters(precision, moved)
+
+    clusters = search.clusters(4, (59.0, 17.0, 60.0, 19.0))
+    assert 0 < len(clusters)
+    assert all(59.0 <= cluster['lat'] <= 60.0 and 
+               17.0 <= cluster['lng'] <= 19.0 for cluster in clusters)
+    assert [] == search.clusters(4, (59.0, 19.0, 60.0, 17.0))
+
+    rv = client.get('/clusters?zoom=10')
+    assert 5 == rv.json['precision']
+    assert len(convthreads) == sum(cluster['count'] 
+                                   for cluster in rv.json['clusters'])
+    rv = client.get('/clusters?zoom=20&bbox=17.0,59.0,19.0,60.0')
+    assert 6 == rv.json['precision']
+    assert 'error' in client.get('/clusters').json
+    assert 'error' in client.get('/clusters?zoom=10&bbox=1,2,3').json
+    assert 'error' in client.get('/clusters?zoom=10&bbox=0,60,1,59').json
+
+def test_search_box(app, client):
+    import json
+    from server.spatialindex import bounds_mask
+    search = app.search
+    convthreads = app.data.convthreads()
+    latitudes = convthreads[:, 1].astype(float)
+    longitudes = convthreads[:, 2].astype(float)
+    for bounds in [(59.3, 18.0, 59.4, 18.1), (59.33, 18.06, 59.34, 18.07), 
+                   (-90.0, -180.0, 90.0, 180.0), (59.0, 19.0, 60.0, 17.0)]:
+        expected = convthreads[bounds_mask(bounds, latitudes, longitudes), 0]
+        convthread_ids = search.convthreads_in_box(bounds)
+        assert sorted(expected) == sorted(convthread_ids)
+
+        for tags in [['school'], ['cafe', 'school']]:
+            tagged = set(search.convthreads_nearest_user(
+                (59.33, 18.06), len(convthreads), tags))
+            assert 0 < len(tagged)
+            assert (sorted(set(expected) & tagged) == 
+                    sorted(search.convthreads_in_box(bounds, tags)))
+
+    url = '/search?bbox=18.0,59.3,18.1,59.4&count=20'
+    expected = search.popular_messages(
+        search.convthreads_in_box((59.3, 18.0, 59.4, 18.1)), 20)
+    assert json.loads(json.dumps(expected)) == client.get(url).json['messages']
+    assert 'error' in client.get('/search?bbox=18.0,59.3,18.1&count=20').json
+    assert 'error' in client.get('/search?bbox=18.0,59.3,18.1,59.4').json
+
+def test_search_backends(app):
+    from server.search import Search
+    search = Search(app.data)
+    backend = Search(app.data)
+    backend.set_backend('kdtree')
+    assert None != backend.backend
+    pytest.raises(ValueError, backend.set_backend, 'rtree')
+
+    def assert_same():
+        for user_location in [(59.33258, 18.0649), (59.3, 18.1), (10.0, 20.0)]:
+            for radius in [10, 500, 2000, 20000]:
+                for tags in [None, ['school'], ['cafe', 'school']]:
+                    assert sorted(search.convthreads_nearby_user(
+                        user_location, radius, tags)) == sorted(
+                        backend.convthreads_nearby_user(user_location, 
+                                                        radius, tags))
+                    assert (search.popular_messages(
+                                search.convthreads_nearby_user(
+                                    user_location, radius, tags), 10) ==
+                            backend.popular_messages_nearby(
+                                user_location, radius, 10, tags))
+            for k in [1, 2, 10]:
+                assert (search.convthreads_nearest_user(user_location, k) == 
+                        backend.convthreads_nearest_user(user_location, k))
+    assert_same()
+
+    convthread_id = search.convthreads_nearby_user((59.33258, 18.0649), 
+                                                   2000)[0]
+    for updated in [search, backend]:
+        updated.upsert_convthread(convthread_id, 10.0, 20.0)
+    assert_same()
+    for updated in [search, backend]:
+        assert updated.delete_convthread(convthread_id)
+    assert_same()
+
+    backend.set_backend('geohash')
+    assert None == backend.backend
+
+def test_search_parallel_build(app):
+    from server.search import Search, RADIUS_SIZES
+    from server.spatialindex import SpatialIndexPoint, SpatialIndex
+    search = Search(app.data, workers=2)
+
+    for size in RADIUS_SIZES:
+        index = SpatialIndex(size)
+        for uid, convthread in enumerate(app.data.convthreads()):
+            index.add_point(SpatialIndexPoint(convthread[1], convthread[2], 
+                                              ref=convthread[0], uid=uid))
+        keys, offsets, columns = index.get_columns()
+        built_keys, built_offsets, built_columns = (
+            search.spatial_indexers[size].get_columns())
+        assert keys == built_keys
+        assert offsets.tolist() == built_offsets.tolist()
+        for name in columns:
+            assert columns[name].tolist() == built_columns[name].tolist()
+
+def test_search_code_partitions():
+    import numpy as np
+    from numpy.random import RandomState
+    from server.search import code_partitions
+    random = RandomState(5)
+    codes = random.randint(0, 50, 10000)
+
+    for count in [1, 2, 3, 8]:
+        partitions = code_partitions(codes, count)
+        assert 0 < len(partitions) <= count
+        assert (sorted(np.concatenate(partitions).tolist()) == 
+                range(len(codes)))
+        for first, second in zip(partitions[:-1], partitions[1:]):
+            assert codes[first].max() < codes[second].min()
+        for positions in partitions:
+            assert (np.diff(positions) > 0).all()
+
+def test_search_metrics(app, client):
+    from server.metrics import Metrics, NO_METRICS
+    assert 404 == client.get('/metrics').status_code
+
+    app.search.metrics = Metrics()
+    try:
+        client.get('/search?lat=59.33258&lng=18.0649&radius=2000&count=10')
+        client.get('/search?lat=59.33258&lng=18.0649&radius=2000&count=10'
+                   '&tags=cafe')
+        client.get('/search?lat=59.33258&lng=18.0649&nearest=2&count=10')
+        text = client.get('/metrics').data
+    finally:
+        app.search.metrics = NO_METRICS
+
+    lines = dict(line.rsplit(' ', 1) for line in text.splitlines() 
+                 if not line.startswith('#'))
+    for stage in ['search', 'tags', 'candidates', 'distance', 'nearest', 
+                  'popularity']:
+        assert 0 < int(lines['search_stage_duration_seconds_count'
+                             '{stage="%s"}' % stage])
+    assert '3' == lines['search_stage_duration_seconds_count'
+                        '{stage="search"}']
+    assert '3' == lines['search_stage_duration_seconds_bucket'
+                        '{stage="search",le="+Inf"}']
+    examined = float(lines['search_candidates_examined_sum'
+                           '{stage="distance"}'])
+    accepted = float(lines['search_candidates_accepted_sum'
+                           '{stage="distance"}'])
+    assert 0 < accepted <= examined
+
+def test_search_popular_nearby():
+    from numpy.random import RandomState
+    from server.data import Database
+    from server.search import Search
+    random = RandomState(7)
+
+    data = Database("./data/")
+    search = Search(data)
+    for radius in [100, 500, 2000, 20000]:
+        for count in [1, 3, 10, 1000]:
+            user_location = (59.33258 + 0.01 * random.normal(), 
+                             18.0649 + 0.01 * random.normal())
+            for tags in [None, ['cafe', 'school']]:
+                assert (search.popular_messages(
+                            search.convthreads_nearby_user(
+                                user_location, radius, tags), count) ==
+                        search.popular_messages_nearby(user_location, radius, 
+                                                       count, tags))
+
+    # bounds follow updated messages
+    user_location = (59.33258, 18.0649)
+    convthread_id = search.convthreads_nearby_user(user_location, 2000)[-1]
+    data.upsert_message(convthread_id, 'popular', 'Popular', 1000.0)
+    messages = search.popular_messages_nearby(user_location, 2000, 1)
+    assert 'popular' == messages[0]['message_id']
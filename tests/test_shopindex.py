@@ -47,3 +47,316 @@ class TestShopindex(unittest.TestCase):
         for point, distance in points:
             assert distance <= 2000
 
+
+    def test_shopindex_nearest_arrays(self):
+        from numpy.random import RandomState
+        random = RandomState(0)
+        lats = 59.33258 + 0.02 * random.normal(size=500)
+        lngs = 18.06490 + 0.02 * random.normal(size=500)
+
+        shopindex = SpatialIndex(2000)
+        for i, (lat, lng) in enumerate(zip(lats, lngs)):
+            shopindex.add_point(SpatialIndexPoint(lat, lng, ref=i))
+
+        user_point = SpatialIndexPoint(59.3325800, 18.0649000)
+        expected = {}
+        for point in shopindex.get_near_points(user_point):
+            distance = point.distance_to(user_point)
+            if distance <= 2000:
+                expected[point.ref] = distance
+        assert 0 < len(expected)
+
+        points = dict((point.ref, distance) for point, distance in 
+                      shopindex.get_nearest_points(user_point, 2000))
+        refs, distances = shopindex.get_nearest_arrays(user_point, 2000)
+        assert sorted(expected) == sorted(points) == sorted(refs)
+        for ref, distance in zip(refs, distances):
+            assert abs(expected[ref] - distance) < 1e-3
+            assert abs(points[ref] - distance) < 1e-9
+
+        # the center point itself has zero distance
+        shopindex.add_point(SpatialIndexPoint(59.3325800, 18.0649000, ref=-1))
+        refs, distances = shopindex.get_nearest_arrays(user_point, 2000)
+        assert 0.0 == distances[list(refs).index(-1)]
+
+    def test_shopindex_nearest_arrays_uids(self):
+        import numpy as np
+        from numpy.random import RandomState
+        random = RandomState(1)
+        lats = 59.33258 + 0.01 * random.normal(size=300)
+        lngs = 18.06490 + 0.01 * random.normal(size=300)
+
+        shopindex = SpatialIndex(2000)
+        for i, (lat, lng) in enumerate(zip(lats, lngs)):
+            shopindex.add_point(SpatialIndexPoint(lat, lng, ref=str(i), uid=i))
+
+        user_point = SpatialIndexPoint(59.3325800, 18.0649000)
+        refs, distances = shopindex.get_nearest_arrays(user_point, 2000)
+        uids = np.arange(0, 300, 3)
+        tagged_refs, tagged_distances = shopindex.get_nearest_arrays(
+            user_point, 2000, uids)
+        expected = [(ref, distance) for ref, distance in zip(refs, distances)
+                    if 0 == int(ref) % 3]
+        assert 0 < len(expected)
+        assert sorted(expected) == sorted(zip(tagged_refs, tagged_distances))
+
+        refs, _ = shopindex.get_nearest_arrays(
+            user_point, 2000, np.empty(0, dtype=np.int64))
+        assert 0 == len(refs)
+
+    def test_shopindex_any_radius(self):
+        from numpy.random import RandomState
+        random = RandomState(2)
+
+        for center in [(59.33258, 18.0649), (-33.86, 151.21), (0.0, 179.99),
+                       (89.99, 0.0)]:
+            lats = center[0] + 0.5 * random.normal(size=2000)
+            lngs = center[1] + 0.5 * random.normal(size=2000)
+            lats = lats.clip(-89.999, 89.999)
+            lngs = (lngs + 180) % 360 - 180
+
+            shopindex = SpatialIndex(2000)
+            points = []
+            for i, (lat, lng) in enumerate(zip(lats, lngs)):
+                point = SpatialIndexPoint(lat, lng, ref=i)
+                points.append(point)
+                shopindex.add_point(point)
+
+            user_point = SpatialIndexPoint(center[0], center[1])
+            for radius in [10, 100, 1000, 5000, 20000, 50000]:
+                expected = sorted(point.ref for point in points 
+                                  if point.distance_to(user_point) <= radius)
+                refs, distances = shopindex.get_nearest_arrays(user_point, 
+                                                               radius)
+                assert expected == sorted(refs), (center, radius)
+
+    def test_shopindex_k_nearest(self):
+        import numpy as np
+        from numpy.random import RandomState
+        random = RandomState(3)
+
+        for center in [(59.33258, 18.0649), (0.0, 179.99), (89.99, 0.0)]:
+            lats = center[0] + 2.0 * random.normal(size=1000)
+            lngs = center[1] + 2.0 * random.normal(size=1000)
+            lats = lats.clip(-89.999, 89.999)
+            lngs = (lngs + 180) % 360 - 180
+
+            shopindex = SpatialIndex(500)
+            points = []
+            for i, (lat, lng) in enumerate(zip(lats, lngs)):
+                point = SpatialIndexPoint(lat, lng, ref=i, uid=i)
+                points.append(point)
+                shopindex.add_point(point)
+
+            user_point = SpatialIndexPoint(center[0], center[1])
+            expected = sorted(point.distance_to(user_point) 
+                              for point in points)
+            for k in [1, 10, 100, 1000, 2000]:
+                refs, distances = shopindex.get_k_nearest_arrays(user_point, k)
+                assert min(k, len(points)) == len(refs)
+                assert np.allclose(expected[:k], distances), (center, k)
+                assert all(np.allclose(points[ref].distance_to(user_point), 
+                                       distance)
+                           for ref, distance in zip(refs, distances))
+
+            uids = np.arange(0, 1000, 7)
+            refs, distances = shopindex.get_k_nearest_arrays(user_point, 10, 
+                                                             uids)
+            expected = sorted((points[uid].distance_to(user_point), uid) 
+                              for uid in uids)[:10]
+            assert [ref for _, ref in expected] == list(refs)
+
+    def test_shopindex_remove_and_move(self):
+        shopindex = SpatialIndex(500)
+        points = [SpatialIndexPoint(59.33 + 0.001 * i, 18.06, ref=i, uid=i)
+                  for i in range(10)]
+        for point in points:
+            shopindex.add_point(point)
+        user_point = SpatialIndexPoint(59.33, 18.06)
+        assert 10 == len(shopindex.get_nearest_arrays(user_point, 2000)[0])
+
+        assert shopindex.remove_point(points[0])
+        assert not shopindex.remove_point(points[0])
+        refs, _ = shopindex.get_nearest_arrays(user_point, 2000)
+        assert range(1, 10) == sorted(refs)
+
+        moved_point = shopindex.move_point(points[1], 10.0, 20.0)
+        assert (1, 1) == (moved_point.ref, moved_point.uid)
+        refs, _ = shopindex.get_nearest_arrays(user_point, 2000)
+        assert range(2, 10) == sorted(refs)
+        refs, distances = shopindex.get_nearest_arrays(moved_point, 10)
+        assert [1] == list(refs) and [0.0] == list(distances)
+
+        for point in points[2:]:
+            assert shopindex.remove_point(point)
+        assert 0 == len(shopindex.get_nearest_arrays(user_point, 2000)[0])
+        shopindex.add_point(points[0])
+        refs, _ = shopindex.get_nearest_arrays(user_point, 2000)
+        assert [0] == list(refs)
+
+    def test_shopindex_add_points(self):
+        import geohash
+        import numpy as np
+        from numpy.random import RandomState
+        random = RandomState(2)
+        lats = np.concatenate((59.33258 + 0.05 * random.normal(size=2000),
+                               random.uniform(-90, 90, 200), [0.0, -1e-20]))
+        lngs = np.concatenate((18.06490 + 0.05 * random.normal(size=2000),
+                               random.uniform(-180, 180, 200), [0.0, 1e-20]))
+        lngs[:10] += 360.0
+
+        shopindex = SpatialIndex(500)
+        bulk_shopindex = SpatialIndex(500)
+        for i, (lat, lng) in enumerate(zip(lats, lngs)):
+            shopindex.add_point(SpatialIndexPoint(lat, lng, ref=str(i), uid=i))
+            if 1000 == i:
+                # cells filled by both bulks are merged
+                bulk_shopindex.add_points(lats[:i + 1], lngs[:i + 1], 
+                                          [str(j) for j in range(i + 1)],
+                                          np.arange(i + 1))
+        bulk_shopindex.add_points(lats[1001:], lngs[1001:], 
+                                  [str(j) for j in range(1001, len(lats))],
+                                  np.arange(1001, len(lats)))
+
+        keys, offsets, columns = shopindex.get_columns()
+        bulk_keys, bulk_offsets, bulk_columns = bulk_shopindex.get_columns()
+        assert keys == bulk_keys
+        assert offsets.tolist() == bulk_offsets.tolist()
+        for name in columns:
+            assert columns[name].tolist() == bulk_columns[name].tolist()
+
+        # cell keys are geohashes, thus neighbours are found by geohash
+        user_point = SpatialIndexPoint(59.3325800, 18.0649000)
+        user_hash = geohash.encode(59.3325800, 18.0649000, 
+                                   bulk_shopindex.precision)
+        assert any(key in bulk_shopindex.data 
+                   for key in geohash.expand(user_hash))
+        refs, distances = shopindex.get_nearest_arrays(user_point, 500)
+        bulk_refs, bulk_distances = bulk_shopindex.get_nearest_arrays(
+            user_point, 500)
+        assert refs.tolist() == bulk_refs.tolist()
+        assert distances.tolist() == bulk_distances.tolist()
+
+    def test_shopindex_prefilter(self):
+        import numpy as np
+        from numpy.random import RandomState
+        from server.spatialindex import distances_to
+        random = RandomState(3)
+        centers = [(59.33258, 18.06490), (89.9, 0.0), (-89.95, 179.9), 
+                   (0.0, 179.999), (0.0, -179.999)]
+        lats = np.concatenate([lat + 0.05 * random.normal(size=500) 
+                               for lat, _ in centers]).clip(-89.999, 89.999)
+        lngs = np.concatenate([lng + 0.05 * random.normal(size=500) 
+                               for _, lng in centers])
+        lngs = np.remainder(lngs + 180.0, 360.0) - 180.0
+
+        shopindex = SpatialIndex(2000)
+        shopindex.add_points(lats, lngs, range(len(lats)), 
+                             np.arange(len(lats)))
+        _, _, columns = shopindex.get_columns()
+        uids = np.arange(0, len(lats), 3)
+        for lat, lng in centers:
+            center = SpatialIndexPoint(lat, lng)
+            distances = distances_to(center, columns)
+            for radius in [1, 100, 1000, 5000, 20000]:
+                expected = sorted(columns['refs'][distances <= radius])
+                refs, nearest_distances = shopindex.get_nearest_arrays(
+                    center, radius)
+                assert expected == sorted(refs)
+                assert (nearest_distances <= radius).all()
+                within_refs = shopindex.get_within_refs(center, radius)
+                assert list(refs) == list(within_refs)
+
+                tagged = np.in1d(columns['uids'], uids) & (distances <= radius)
+                assert sorted(columns['refs'][tagged]) == sorted(
+                    shopindex.get_within_refs(center, radius, uids))
+
+    def test_shopindex_box(self):
+        import numpy as np
+        from numpy.random import RandomState
+        from server.spatialindex import bounds_mask
+        random = RandomState(5)
+        centers = [(59.33258, 18.06490), (89.9, 0.0), (0.0, 179.999), 
+                   (0.0, -179.999)]
+        lats = np.concatenate([lat + 0.05 * random.normal(size=500) 
+                               for lat, _ in centers]).clip(-89.999, 89.999)
+        lngs = np.concatenate([lng + 0.05 * random.normal(size=500) 
+                               for _, lng in centers])
+        lngs = np.remainder(lngs + 180.0, 360.0) - 180.0
+
+        for size in [500, 2000]:
+            shopindex = SpatialIndex(size)
+            shopindex.add_points(lats, lngs, range(len(lats)), 
+                                 np.arange(len(lats)))
+            _, _, columns = shopindex.get_columns()
+            uids = np.arange(0, len(lats), 3)
+            for bounds in [(59.3, 18.0, 59.4, 18.1), 
+                           (59.33, 18.06, 59.34, 18.07),
+                           (59.0, 17.0, 60.0, 19.0), 
+                           (89.0, -180.0, 90.0, 180.0),
+                           (-0.05, 179.95, 0.05, -179.95),
+                           (-90.0, -180.0, 90.0, 180.0)]:
+                mask = bounds_mask(bounds, columns['latitudes'], 
+                                   columns['longitudes'])
+                expected = sorted(columns['refs'][mask])
+                assert 0 < len(expected)
+                refs = shopindex.get_box_refs(bounds)
+                assert expected == sorted(refs)
+                assert len(expected) == len(refs)
+
+                tagged = np.in1d(columns['uids'], uids) & mask
+                assert sorted(columns['refs'][tagged]) == sorted(
+                    shopindex.get_box_refs(bounds, uids))
+
+    def test_shopindex_kdtree(self):
+        import numpy as np
+        from numpy.random import RandomState
+        from server.kdtree import KDTreeIndex
+        from server.spatialindex import distances_to
+        random = RandomState(3)
+        centers = [(59.33258, 18.06490), (89.9, 0.0), (-89.95, 179.9), 
+                   (0.0, 179.999), (0.0, -179.999)]
+        lats = np.concatenate([lat + 0.05 * random.normal(size=500) 
+                               for lat, _ in centers]).clip(-89.999, 89.999)
+        lngs = np.concatenate([lng + 0.05 * random.normal(size=500) 
+                               for _, lng in centers])
+        lngs = np.remainder(lngs + 180.0, 360.0) - 180.0
+
+        shopindex = SpatialIndex(2000)
+        shopindex.add_points(lats, lngs, range(len(lats)), 
+                             np.arange(len(lats)))
+        kdtree = KDTreeIndex(leaf_size=16)
+        kdtree.add_points(lats, lngs, range(len(lats)), np.arange(len(lats)))
+        _, _, columns = shopindex.get_columns()
+        uids = np.arange(0, len(lats), 3)
+        for lat, lng in centers:
+            center = SpatialIndexPoint(lat, lng)
+            distances = distances_to(center, columns)
+            for radius in [1, 100, 1000, 5000, 20000]:
+                expected = sorted(columns['refs'][distances <= radius])
+                assert expected == sorted(kdtree.get_within_refs(center, 
+                                                                 radius))
+                refs, nearest_distances = kdtree.get_nearest_arrays(center, 
+                                                                    radius)
+                assert expected == sorted(refs)
+                assert (nearest_distances <= radius).all()
+
+                tagged = np.in1d(columns['uids'], uids) & (distances <= radius)
+                assert sorted(columns['refs'][tagged]) == sorted(
+                    kdtree.get_within_refs(center, radius, uids))
+            for k in [1, 10, 100]:
+                _, expected = shopindex.get_k_nearest_arrays(center, k, uids)
+                _, nearest_distances = kdtree.get_k_nearest_arrays(center, k, 
+                                                                   uids)
+                assert np.allclose(expected, nearest_distances)
+
+        # removed and moved points are found until and after a rebuild
+        for ref in range(300):
+            point = SpatialIndexPoint(lats[ref], lngs[ref], ref=ref, uid=ref)
+            kdtree.move_point(point, 10.0, 20.0 + ref * 1e-4)
+            assert not kdtree.remove_point(point)
+            if 100 == ref:
+                assert 101 == kdtree.removed
+        assert len(lats) == len(kdtree)
+        assert range(300) == sorted(kdtree.get_within_refs(
+            SpatialIndexPoint(10.0, 20.015), 2000))
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+    tests.snapshot
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    The snapshot functionality.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from server import snapshot
+from server.data import Database
+from server.search import Search
+from server.spatialindex import SpatialIndexPoint
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.datapath = "./data/"
+        self.path = os.path.join(tempfile.mkdtemp(), "snapshot")
+        self.data = Database(self.datapath)
+        self.search = Search(self.data)
+        snapshot.build(self.path, self.data, self.search, self.datapath)
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.path))
+
+    def test_snapshot_database(self):
+        data, _ = snapshot.load(self.path, self.datapath)
+
+        for convthread_id in self.data.dfs["convthreads"]["convthread_id"]:
+            assert (self.data.popular_messages(convthread_id) ==
+                    data.popular_messages(convthread_id))
+        assert [] == data.popular_messages("-1")
+
+        for tag_id in self.data.tag_ids():
+            assert (len(self.data.convthreads(tag_id)) ==
+                    len(data.convthreads(tag_id)))
+        assert self.data.tag_ids() == data.tag_ids()
+
+    def test_snapshot_spatial_indexers(self):
+        _, search = snapshot.load(self.path, self.datapath)
+
+        user_point = SpatialIndexPoint(59.3325800, 18.0649000)
+        for size, index in self.search.spatial_indexers.items():
+            loaded_index = search.spatial_indexers[size]
+            assert index.precision == loaded_index.precision
+
+            refs, distances = index.get_nearest_arrays(user_point, size)
+            loaded_refs, loaded_distances = loaded_index.get_nearest_arrays(
+                user_point, size)
+            assert sorted(zip(refs, distances)) == sorted(
+                zip(loaded_refs, loaded_distances))
+
+        assert sorted(self.search.tag_postings) == sorted(search.tag_postings)
+        for tag_id, uids in self.search.tag_postings.items():
+            assert uids.tolist() == search.tag_postings[tag_id].tolist()
+
+    def test_snapshot_shared_columns(self):
+        from server.search import RADIUS_SIZES
+        from server.spatialindex import CELL_COLUMNS
+
+        reader = snapshot.SnapshotReader(self.path)
+        for name in CELL_COLUMNS:
+            assert (len(self.data.convthreads()) ==
+                    len(reader.array("points.%s" % name)))
+
+        _, search = snapshot.load(self.path, self.datapath)
+        assert len(RADIUS_SIZES) == len(search.spatial_indexers)
+        # cells of every indexer are views of the same memory map
+        assert 1 == len(set(id(cell.latitudes.base.base)
+                            for index in search.spatial_indexers.values()
+                            for cell in index.data.values()))
+
+    def test_snapshot_out_of_date(self):
+        datapath = tempfile.mkdtemp()
+        try:
+            for filename in os.listdir(self.datapath):
+                shutil.copy(os.path.join(self.datapath, filename), datapath)
+            with open(os.path.join(datapath, "tags.pkl"), 'ab') as pkl_file:
+                pkl_file.write('\0')
+            self.assertRaises(snapshot.SnapshotError, snapshot.load,
+                              self.path, datapath)
+        finally:
+            shutil.rmtree(datapath)
+
+    def test_snapshot_version(self):
+        manifest_path = os.path.join(self.path, snapshot.MANIFEST)
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        manifest["version"] = snapshot.SNAPSHOT_VERSION + 1
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        self.assertRaises(snapshot.SnapshotError, snapshot.load, self.path)
+
+    def test_snapshot_updates(self):
+        data, search = snapshot.load(self.path, self.datapath)
+        convthread_id = data.dfs["convthreads"]["convthread_id"].values[0]
+
+        data.upsert_message(convthread_id, "new", "New message", 0.5)
+        assert "new" in [record["message_id"] 
+                         for record in data.popular_messages(convthread_id)]
+
+        assert data.delete_convthread(convthread_id)
+        assert convthread_id not in data.messages
+        assert convthread_id not in dict(data.messages.items())
+        assert [] == data.popular_messages(convthread_id)
+
+        data.upsert_convthread(convthread_id, 1.0, 2.0, "Added")
+        assert convthread_id in data.messages
+        assert [] == data.popular_messages(convthread_id)
+
+        assert search.delete_convthread(convthread_id)
+        search.upsert_convthread(convthread_id, 1.0, 2.0)
+        assert [convthread_id] == search.convthreads_nearby_user((1.0, 2.0), 
+                                                                 10)
+
+    def test_snapshot_of_updates(self):
+        data, search = snapshot.load(self.path, self.datapath)
+        convthread_id = data.dfs["convthreads"]["convthread_id"].values[0]
+        data.upsert_message(convthread_id, "new", "New message", 0.5)
+        data.upsert_convthread("added", 1.0, 2.0, "Added")
+        data.upsert_message("added", "first", "First message", 1.0)
+
+        path = os.path.join(os.path.dirname(self.path), "updated")
+        snapshot.build(path, data, search, self.datapath)
+        loaded_data, _ = snapshot.load(path, self.datapath)
+        for convthread_id in [convthread_id, "added"]:
+            assert (data.popular_messages(convthread_id) == 
+                    loaded_data.popular_messages(convthread_id))